@@ -1,15 +1,36 @@
+import datetime
+import hashlib
+import hmac
 import json
+import math
 import os
+import string
+import time
 
-from flask import Flask, request, send_from_directory, jsonify, Response
+from flask import Flask, g, request, send_from_directory, send_file, jsonify, make_response, Response
 from flask_login import LoginManager
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, File, Field, Data
 
+import blobstore
 import filehandling
+import journaling
+import locking
+import metadata
+import metrics
+import profiler
+import quotas
+import retention
+import uploadsessions
 import userhandling
 from pathing import write_to_error_log, RESOURCE_DIR, ADMIN_FOLDER, UPLOAD_FOLDER, ERROR_LOG
 
 
 ALLOWED_EXTENSIONS = {'cio'}  # Our madeup fileext indicating that it has been encrypted; not to be confused with SWAT.
+LONG_POLL_MAX_SECONDS = 30  # Longest a list_changes request may wait for changes.
+MAX_BULK_UPLOAD_FILES = 5000  # Files in one upload_files request.
+MAX_ADDITIONAL_DATA_SIZE = 64 * 1024  # Bytes of an additional data part held in memory.
+PROFILE_HEADER = 'X-CloudIO-Profile'  # Carries the PROFILE_TOKEN config to profile a request or open a window.
+ADMIN_HEADER = 'X-CloudIO-Admin'  # Carries the ADMIN_TOKEN config to read the usage and the metrics.
 
 
 def bad_request(): return Response(status=400)
@@ -24,10 +45,110 @@ def internal_server_error_response(): return Response(status=500)
 def file_not_found_response(): return Response(status=404)
 
 
+def length_required_response(): return Response(status=411)
+
+
+def insufficient_storage_response(): return Response(status=507)  # Over quota.
+
+
 app = Flask(__name__)
 login_manager = LoginManager()
 
 
+@app.before_request
+def start_request_timer():
+    if metrics.ENABLED:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    if metrics.ENABLED and 'request_start' in g:
+        metrics.observe(metrics.REQUEST_SECONDS, time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not is_admin_request():
+        return file_not_found_response()
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+def is_profiling_request():
+    return carries_token(PROFILE_HEADER, app.config.get('PROFILE_TOKEN'))
+
+
+def is_admin_request():
+    return carries_token(ADMIN_HEADER, app.config.get('ADMIN_TOKEN'))
+
+
+def carries_token(header, token):
+    return token is not None and hmac.compare_digest(request.headers.get(header, ''), token)
+
+
+@app.before_request
+def start_request_profile():
+    profiler.enter_request()
+    if PROFILE_HEADER in request.headers and request.endpoint != 'profile_window' and is_profiling_request():
+        profiler.start_request_profile()
+
+
+@app.after_request
+def finish_request_profile(response):
+    profile_filename = profiler.finish_request_profile(request.endpoint or 'unknown')
+    if profile_filename is not None:
+        response.headers[PROFILE_HEADER + '-File'] = profile_filename
+    return response
+
+
+@app.teardown_request
+def leave_request_profile(error):
+    profiler.finish_request_profile(request.endpoint or 'unknown')  # Unless done already; the request failed.
+    profiler.leave_request()
+
+
+@app.route('/profile_window/<int:seconds>', methods=['POST'])
+def profile_window(seconds):
+    # Samples every request for the given number of seconds; answers the name the profile will have in admin/profiles.
+    if not is_profiling_request():
+        return file_not_found_response()
+    profile_filename = profiler.start_window(seconds)
+    if profile_filename is None:
+        return bad_request()  # One window at a time.
+    return jsonify({'profile': profile_filename})
+
+
+def over_quota_response(added_bytes, added_files, user: userhandling.UserMethodPack):
+    # None if an upload of this size fits in the user's quota. Asked before the body is read, so a body of unknown
+    # length (added_bytes None) is refused while there is a quota on bytes; it could only be measured by storing it.
+    if added_bytes is None and quotas.QUOTA_BYTES is not None:
+        return length_required_response()
+    if quotas.exceeds_quota(added_bytes or 0, added_files, user):
+        return insufficient_storage_response()
+    return None
+
+
+@app.route('/usage', methods=['GET'])
+def get_usage():
+    # Every user's usage and the quotas, from the counters; see quotas.py. None for users not counted yet.
+    if not is_admin_request():
+        return file_not_found_response()
+    return jsonify({'quota_bytes': quotas.QUOTA_BYTES, 'quota_files': quotas.QUOTA_FILES,
+                    'users': {userID: quotas.usage(userhandling.UserMethodPack(userID))
+                              for userID in metadata.backend().users()}})
+
+
+@app.route('/usage/<string:userID>', methods=['GET'])
+def get_user_usage(userID):
+    user = userhandling.UserMethodPack(userID)
+    if not is_admin_request() or not user.exists():
+        return file_not_found_response()
+    usage = quotas.usage(user) or {'bytes': None, 'files': None}  # Not counted yet.
+    return jsonify(dict(usage, quota_bytes=quotas.QUOTA_BYTES, quota_files=quotas.QUOTA_FILES))
+
+
 @app.route('/')
 def get_main_page():
     return send_from_directory(RESOURCE_DIR, 'gif.gif', mimetype='image/gif')
@@ -45,7 +166,31 @@ def list_files(userID: str):
     user = userhandling.UserMethodPack(userID)
     if not user.exists():
         return jsonify({'file_list': []})
-    return jsonify({'file_list': filehandling.list_live_files(user)})
+    # Every change to the listing moves the change cursor, so it names the listing. It is read before the listing
+    # is built, so the listing is never older than its ETag.
+    etag = 'list-' + str(filehandling.change_cursor(user))
+    if not_modified(etag):
+        return not_modified_response(etag)
+    response = jsonify({'file_list': filehandling.list_live_files(user)})
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/list_changes/<string:userID>', methods=['GET'])
+def list_changes(userID: str):
+    # Only what changed after the client's cursor. With 'wait', holds the request until something changes.
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        wait = min(float(request.args.get('wait', 0)), LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        return bad_request()
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return jsonify({'cursor': 0, 'changes': []})
+    if wait > 0:
+        filehandling.wait_for_changes(cursor, wait, user)
+    latest_cursor, changes = filehandling.list_changes_since(cursor, user)
+    return jsonify({'cursor': latest_cursor, 'changes': changes})
 
 
 @app.route('/upload_file/<string:userID>', methods=['POST'])
@@ -57,6 +202,10 @@ def upload_file(userID: str):
     user = userhandling.UserMethodPack(userID)
     if not user.exists():
         return bad_request()
+    # Would it fit in the user's quota? Asked before the body is read, so the body's length stands in for the file's.
+    quota_response = over_quota_response(request.content_length, 1, user)
+    if quota_response is not None:
+        return quota_response
     # Does it contain files?
     if len(request.files) == 0:  # No file
         write_to_error_log("Upload file request by " + userID + "without any file.")
@@ -71,30 +220,257 @@ def upload_file(userID: str):
         write_to_error_log("Upload file request by " + userID + "without additional data.")
         return bad_request()
     additional_data = json.loads(request.files['additional_data'].read().decode('utf-8'))
-    for field in list(additional_data.keys()):
-        if field not in ['n', 't', 'nonce1', 'nonce2']:
-            return bad_request()
-    for field in ['n', 't', 'nonce1', 'nonce2']:
-        if field not in list(additional_data.keys()):
-            return bad_request()
     filename = file.filename
-    # Does the additional data match?
-    additional_data_matches = filehandling.matching_additional_data(filename, additional_data)
-    # Is the filename secure?
-    is_acceptable_filename = filehandling.acceptable_filename(filename)
-    if not additional_data_matches or not is_acceptable_filename:
+    if not acceptable_upload(filename, additional_data):
         return bad_request()
     # If all this is, then we can start working; first we find an available name for local storage:
     avail_filename = filehandling.get_available_name(filename, additional_data['t'], user)
     # If we could not log the error and return.
     if avail_filename is None:
         return internal_server_error_logging('Could not find available name for file:' + filename)
-    # Save the file and the additional data under the filename.
-    filehandling.mark_file_as_live(filename, user)
+    # Save the file and the additional data under the filename, then mark it live; marking it records the change,
+    # and the change must not be seen before the version it announces.
     filehandling.save_file_and_additional_data(file, avail_filename, additional_data, user=user)
+    filehandling.mark_file_as_live(filename, user)
     return successful_request()  # TODO: Consider returning a receipt such that client can prove a file was stored.
 
 
+@app.route('/upload_files/<string:userID>', methods=['POST'])
+def upload_files(userID: str):
+    # Many files in one request: the i-th 'file_content' part goes with the i-th 'additional_data' part. The body is
+    # parsed as it is read, each file going straight to its temporary file. Each file is validated on its own, and the
+    # metadata of all accepted files is committed at once. Answers a status per file.
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return bad_request()
+    quota_response = over_quota_response(request.content_length, 1, user)  # The files are counted once read.
+    if quota_response is not None:
+        return quota_response
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+        return bad_request()
+    files, additional_data_parts = [], []  # [filename, temporary_path, content_hash], bytes
+    try:
+        if not receive_bulk_upload(request.stream, request.mimetype_params['boundary'].encode('latin-1'), files,
+                                   additional_data_parts, user) \
+                or not files or len(files) != len(additional_data_parts):
+            write_to_error_log("Bulk upload request by " + userID + " without matching files and additional data.")
+            return bad_request()
+        results = []
+        uploads = []
+        for (filename, temporary_path, content_hash), additional_data_part in zip(files, additional_data_parts):
+            try:
+                additional_data = json.loads(additional_data_part.decode('utf-8'))
+            except ValueError:
+                additional_data = None
+            if not acceptable_upload(filename, additional_data):
+                results.append({'filename': filename, 'status': 400})
+                continue
+            results.append({'filename': filename, 'status': 200})
+            uploads.append((filename, temporary_path, content_hash, additional_data))
+        if quotas.exceeds_quota(request.content_length or 0, len(uploads), user):
+            return insufficient_storage_response()
+        accepted = [result for result in results if result['status'] == 200]
+        for result, server_side_name in zip(accepted, filehandling.save_files_and_additional_data(uploads, user)):
+            if server_side_name is None:
+                write_to_error_log('Could not find available name for file:' + result['filename'])
+                result['status'] = 500
+        return jsonify({'results': results})
+    finally:
+        for filename, temporary_path, content_hash in files:  # Those of rejected files, or of a failed commit.
+            try:
+                os.remove(temporary_path)
+            except FileNotFoundError:  # Committed.
+                pass
+
+
+def receive_bulk_upload(stream, boundary, files, additional_data_parts, user: userhandling.UserMethodPack):
+    # Feeds the body through the multipart parser as it is read, like asgi.receive_upload. Each file goes straight to a
+    # temporary file, added to files, and the additional data parts are kept in memory; returns False if the body is
+    # malformed or too large.
+    decoder = MultipartDecoder(boundary, MAX_ADDITIONAL_DATA_SIZE)
+    part, temporary_file, content_hash, ended = None, None, None, False
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if ended:
+                    return False
+                chunk = stream.read(filehandling.STREAM_CHUNK_SIZE)
+                ended = not chunk
+                decoder.receive_data(chunk if chunk else None)
+            elif isinstance(event, Epilogue):
+                return True
+            elif isinstance(event, File) and event.name == 'file_content':
+                if len(files) == MAX_BULK_UPLOAD_FILES:
+                    return False
+                part = 'file_content'
+                temporary_path, temporary_file = filehandling.open_temporary_file(user)
+                files.append([event.filename, temporary_path, None])
+                content_hash = hashlib.sha256()
+            elif isinstance(event, (File, Field)):
+                part = event.name if event.name == 'additional_data' else None
+                if part is not None:
+                    if len(additional_data_parts) == MAX_BULK_UPLOAD_FILES:
+                        return False
+                    additional_data_parts.append(b'')
+            elif isinstance(event, Data):
+                if part == 'file_content':
+                    content_hash.update(event.data)
+                    temporary_file.write(event.data)
+                    if not event.more_data:
+                        metrics.count(metrics.BYTES_WRITTEN, temporary_file.tell(), stage='upload')
+                        temporary_file.close()
+                        files[-1][2] = content_hash.hexdigest()
+                elif part == 'additional_data':
+                    additional_data_parts[-1] += event.data
+                    if len(additional_data_parts[-1]) > MAX_ADDITIONAL_DATA_SIZE:
+                        return False
+    except ValueError:  # Not multipart after all.
+        return False
+    finally:
+        if temporary_file is not None and not temporary_file.closed:
+            temporary_file.close()
+
+
+@app.route('/upload_file_stream/<string:filename>/<string:userID>', methods=['POST'])
+def upload_file_stream(filename, userID):
+    # The raw file as the body and the additional data as a header, so it is validated before the body is read
+    # and the body can be streamed to disk with flat memory use.
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return bad_request()
+    if 'X-Additional-Data' not in request.headers:
+        write_to_error_log("Upload file request by " + userID + "without additional data.")
+        return bad_request()
+    try:
+        additional_data = json.loads(request.headers['X-Additional-Data'])
+    except ValueError:
+        return bad_request()
+    if not acceptable_upload(filename, additional_data):
+        return bad_request()
+    # A client that already knows the hash of the content can skip the transfer if we have the blob.
+    claimed_hash = request.headers.get('X-Content-SHA256', '').lower()
+    blob_size = None
+    if len(claimed_hash) == 64 and all(char in string.hexdigits for char in claimed_hash):
+        blob_size = blobstore.blob_size(claimed_hash, user)
+    quota_response = over_quota_response(request.content_length if blob_size is None else blob_size, 1, user)
+    if quota_response is not None:
+        return quota_response
+    temporary_path, content_hash = None, claimed_hash
+    if blob_size is None:
+        temporary_path, content_hash = filehandling.save_stream_to_temporary_file(request.stream, user)
+    avail_filename = filehandling.get_available_name(filename, additional_data['t'], user)
+    if avail_filename is None:
+        if temporary_path is not None:
+            os.remove(temporary_path)
+        return internal_server_error_logging('Could not find available name for file:' + filename)
+    if temporary_path is None and not filehandling.commit_known_blob(content_hash, avail_filename, additional_data,
+                                                                     user):
+        # Collected since it was found, so the content is read from the body after all.
+        temporary_path, content_hash = filehandling.save_stream_to_temporary_file(request.stream, user)
+        if content_hash != claimed_hash:
+            os.remove(temporary_path)
+            return bad_request()
+    if temporary_path is not None:
+        filehandling.commit_temporary_file(temporary_path, content_hash, avail_filename, additional_data, user)
+    filehandling.mark_file_as_live(filename, user)
+    return jsonify({'sha256': content_hash})
+
+
+@app.route('/create_upload_session/<string:userID>', methods=['POST'])
+def create_upload_session(userID):
+    # Resumable upload of one file: the body is {"filename", "additional_data", "size"}. The file's chunks are then
+    # sent to upload_chunk, and the file is stored once finish_upload_session finds every byte received.
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return bad_request()
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict) \
+            or not all(key in request_data for key in ['filename', 'additional_data', 'size']):
+        return bad_request()
+    size = request_data['size']
+    if not isinstance(request_data['filename'], str) or not isinstance(size, int) \
+            or not 0 <= size <= uploadsessions.MAX_SESSION_SIZE:
+        return bad_request()
+    if not acceptable_upload(request_data['filename'], request_data['additional_data']):
+        return bad_request()
+    if quotas.exceeds_quota(size, 1, user):
+        return insufficient_storage_response()
+    session_id = uploadsessions.create_session(request_data['filename'], request_data['additional_data'], size, user)
+    return jsonify({'session': session_id})
+
+
+@app.route('/upload_chunk/<string:session_id>/<string:userID>', methods=['PUT'])
+def upload_chunk(session_id, userID):
+    # The body is written at ?offset=; chunks may come in any order, in parallel and more than once.
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return bad_request()
+    user = userhandling.UserMethodPack(userID)
+    if not acceptable_session_id(session_id) or not user.exists():
+        return bad_request()
+    if uploadsessions.load_session(session_id, user) is None:
+        return file_not_found_response()
+    if uploadsessions.write_chunk(session_id, offset, request.stream, user) is None:
+        return bad_request()  # Does not fit in the file, or the session finished meanwhile.
+    return jsonify({'received': uploadsessions.received_ranges(session_id, user)})
+
+
+@app.route('/upload_session/<string:session_id>/<string:userID>', methods=['GET', 'DELETE'])
+def upload_session(session_id, userID):
+    # GET: the size and the [start, end) ranges received so far, for resuming. DELETE: abandons the session.
+    user = userhandling.UserMethodPack(userID)
+    if not acceptable_session_id(session_id) or not user.exists():
+        return bad_request()
+    if request.method == 'DELETE':
+        return successful_request() if uploadsessions.delete_session(session_id, user) else file_not_found_response()
+    session = uploadsessions.load_session(session_id, user)
+    if session is None:
+        return file_not_found_response()
+    return jsonify({'size': session['size'], 'received': uploadsessions.received_ranges(session_id, user)})
+
+
+@app.route('/finish_upload_session/<string:session_id>/<string:userID>', methods=['POST'])
+def finish_upload_session(session_id, userID):
+    user = userhandling.UserMethodPack(userID)
+    if not acceptable_session_id(session_id) or not user.exists():
+        return bad_request()
+    session = uploadsessions.load_session(session_id, user)
+    if session is not None and quotas.exceeds_quota(session['size'], 1, user):  # Other uploads may have come first.
+        return insufficient_storage_response()  # The session is kept, to be finished once there is room.
+    content_hash = uploadsessions.finish_session(session_id, user)
+    if content_hash is None:
+        return bad_request()  # Unknown, incomplete, or no name was available for the file.
+    return jsonify({'sha256': content_hash})
+
+
+def acceptable_session_id(session_id):
+    return len(session_id) == 32 and all(char in string.hexdigits for char in session_id)
+
+
+def acceptable_upload(filename, additional_data):
+    if not isinstance(additional_data, dict):
+        return False
+    for field in list(additional_data.keys()):
+        if field not in ['n', 't', 'nonce1', 'nonce2']:
+            return False
+    for field in ['n', 't', 'nonce1', 'nonce2']:
+        if field not in list(additional_data.keys()):
+            return False
+    # The timestamp becomes part of the server side name, so it has to be a number.
+    t = additional_data['t']
+    if isinstance(t, bool) or not isinstance(t, (int, float)) or not math.isfinite(t):
+        return False
+    if not isinstance(filename, str) or not isinstance(additional_data['n'], str):
+        return False
+    # Does the additional data match?
+    additional_data_matches = filehandling.matching_additional_data(filename, additional_data)
+    # Is the filename secure?
+    is_acceptable_filename = filehandling.acceptable_filename(filename)
+    return additional_data_matches and is_acceptable_filename
+
+
 @app.route('/get_file/<string:filename>/<string:userID>', methods=['GET'])
 def get_file(filename, userID):
     # Is the filename requested legit?
@@ -108,13 +484,38 @@ def get_file(filename, userID):
     latest_filename = filehandling.latest_filename_version(filename, user)
     if latest_filename is None:
         return file_not_found_response()
+    # Server side versions are never rewritten, so a client holding the latest one is answered without reading it.
+    if not_modified(latest_filename):
+        return not_modified_response(latest_filename, version_time(latest_filename))
     # return the file and its associated additional data. If this doesn't match our client will be sad :(
     file_path, additional_data = filehandling.load_file_path_and_additional_data(latest_filename, user)
     if file_path is None or additional_data is None:
         return file_not_found_response()
-    with open(file_path, 'rb') as file:
-        file_content = file.read().hex()
-    return json.dumps({'file': file_content, 'additional_data': additional_data})
+    file_content = filehandling.load_file_hex(file_path)
+    response = Response(json.dumps({'file': file_content, 'additional_data': additional_data}))
+    return with_validators(response, latest_filename, version_time(latest_filename))
+
+
+@app.route('/download_file/<string:filename>/<string:userID>', methods=['GET'])
+def download_file(filename, userID):
+    # Like get_file, but streams the raw blob (with Range and conditional request support) instead of hex in JSON.
+    is_filename_acceptable = filehandling.acceptable_filename(filename)
+    if request.method != 'GET' or not is_filename_acceptable:
+        return bad_request()
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return file_not_found_response()  # Obscure that user doens't exist
+    latest_filename = filehandling.latest_filename_version(filename, user)
+    if latest_filename is None:
+        return file_not_found_response()
+    file_path, additional_data = filehandling.load_file_path_and_additional_data(latest_filename, user)
+    if file_path is None or additional_data is None:
+        return file_not_found_response()
+    # Server side versions are never rewritten, so the name of the version is a strong ETag.
+    response = send_file(file_path, mimetype='application/octet-stream', conditional=True, etag=latest_filename)
+    metrics.count(metrics.BYTES_READ, response.content_length or 0, stage='download_file')
+    response.headers['X-Additional-Data'] = json.dumps(additional_data)
+    return response
 
 
 @app.route('/get_file_time/<string:filename>/<string:userID>', methods=['GET'])
@@ -126,10 +527,76 @@ def get_file_timestamp(filename, userID):
     user = userhandling.UserMethodPack(userID)
     if not user.exists():
         return file_not_found_response()
+    latest_filename = filehandling.latest_filename_version(filename, user)
+    if latest_filename is not None and not_modified(latest_filename):
+        return not_modified_response(latest_filename, version_time(latest_filename))
     timestamp = filehandling.load_latest_timestamp(filename, user)
     if timestamp is None:
         return file_not_found_response()
-    return timestamp
+    return with_validators(make_response(str(timestamp)), latest_filename, version_time(latest_filename))
+
+
+def version_time(server_side_name):
+    # When the version was stored, as the client stated it; None if it is no time HTTP can express.
+    try:
+        return datetime.datetime.fromtimestamp(filehandling.split_server_side_name(server_side_name)[1],
+                                               datetime.timezone.utc)
+    except (OverflowError, OSError, TypeError, ValueError):
+        return None
+
+
+def not_modified(etag):
+    # Does the client already hold the representation named by etag? Only If-None-Match is honoured: HTTP dates have
+    # whole seconds, while versions stored within one second, or again with the same time, differ.
+    return bool(request.if_none_match) and request.if_none_match.contains(etag)
+
+
+def not_modified_response(etag, last_modified=None):
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+@app.route('/get_file_times/<string:userID>', methods=['POST'])
+def get_file_timestamps(userID):
+    # Batch get_file_time: the body is {"filenames": [...]} or {"filenames": "all"}; files not found are left out.
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict) or 'filenames' not in request_data:
+        return bad_request()
+    filenames = request_data['filenames']
+    if filenames == 'all':
+        filenames = None
+    elif not isinstance(filenames, list) \
+            or not all(isinstance(filename, str) and filehandling.acceptable_filename(filename) for filename in filenames):
+        return bad_request()
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        return jsonify({'files': {}})
+    return jsonify({'files': filehandling.load_latest_file_metadata(user, filenames)})
+
+
+@app.route('/download_files/<string:userID>', methods=['POST'])
+def download_files(userID):
+    # Bulk get_file: the body is {"filenames": [...]} or {"filenames": "all"} for every live file. The latest versions
+    # are streamed raw, framed as described in filehandling, and read as they are sent.
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict) or 'filenames' not in request_data:
+        return bad_request()
+    filenames = request_data['filenames']
+    if filenames != 'all' and (not isinstance(filenames, list) or not all(
+            isinstance(filename, str) and filehandling.acceptable_filename(filename) for filename in filenames)):
+        return bad_request()
+    user = userhandling.UserMethodPack(userID)
+    if not user.exists():
+        filenames = []  # Obscure that user doens't exist
+    elif filenames == 'all':
+        filenames = [live_file[0] for live_file in filehandling.list_live_files(user)]
+    return Response(filehandling.stream_latest_versions(filenames, user), mimetype='application/octet-stream')
 
 
 @app.errorhandler(413)
@@ -208,10 +675,25 @@ def unregister_user(userID):
         return bad_request()
 
 
-if __name__ == '__main__':
+def create_app(config=None):
+    # Configures the app and prepares what it serves from. Servers call this once, before forking any workers.
     app.secret_key = 'super secret key'
     app.config['SESSION_TYPE'] = 'filesystem'
     app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024
+    app.config['METADATA_BACKEND'] = 'json'  # Or 'sqlite'; see metadata.py.
+    app.config['INTER_PROCESS_LOCKS'] = False  # Must be set when several processes serve the same folders.
+    app.config['RETENTION_WORKER'] = True  # Deletes the versions the retention rules below no longer keep.
+    app.config['KEEP_LAST_VERSIONS'] = None  # Of each file; None keeps them all. See retention.py.
+    app.config['KEEP_VERSIONS_NEWER_THAN'] = None  # Seconds.
+    app.config['PURGE_ARCHIVED_AFTER'] = None  # Seconds a file is archived before all its versions are deleted.
+    app.config['METRICS'] = False  # Time requests and their stages, for /metrics.
+    app.config['PROFILE_TOKEN'] = None  # Set to let requests carrying it in PROFILE_HEADER use the profiler.
+    app.config['ADMIN_TOKEN'] = None  # Set to let requests carrying it in ADMIN_HEADER read the usage and the metrics.
+    app.config['METADATA_CACHE_BYTES'] = 256 * 1024 * 1024  # Estimated memory of parsed logs per process; see journaling.py.
+    app.config['QUOTA_BYTES'] = None  # Stored per user at most; None for no limit. See quotas.py.
+    app.config['QUOTA_FILES'] = None  # Versions stored per user at most.
+    if config is not None:
+        app.config.update(config)
     login_manager.init_app(app)
 
     if not os.path.exists(ADMIN_FOLDER):
@@ -223,5 +705,19 @@ if __name__ == '__main__':
     if not os.path.isfile(ERROR_LOG):
         with open(ERROR_LOG, 'w') as error_log_file:  # Errorlog should exist.
             error_log_file.write(('-'*5 + ' CloudIO Error Log ' + '-'*5))  # Create the error log
-
-    app.run(host='0.0.0.0', port=8001, threaded=True)
+    locking.INTER_PROCESS = app.config['INTER_PROCESS_LOCKS']
+    metrics.ENABLED = app.config['METRICS']
+    journaling.MAX_CACHED_BYTES = app.config['METADATA_CACHE_BYTES']
+    quotas.QUOTA_BYTES = app.config['QUOTA_BYTES']
+    quotas.QUOTA_FILES = app.config['QUOTA_FILES']
+    retention.KEEP_LAST_VERSIONS = app.config['KEEP_LAST_VERSIONS']
+    retention.KEEP_VERSIONS_NEWER_THAN = app.config['KEEP_VERSIONS_NEWER_THAN']
+    retention.PURGE_ARCHIVED_AFTER = app.config['PURGE_ARCHIVED_AFTER']
+    metadata.use_backend(app.config['METADATA_BACKEND'])
+    if app.config['RETENTION_WORKER']:
+        retention.start_worker()
+    return app
+
+
+if __name__ == '__main__':  # Development server; see serve.py for production.
+    create_app().run(host='0.0.0.0', port=8001, threaded=True)
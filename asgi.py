@@ -0,0 +1,326 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import re
+
+from werkzeug.http import http_date, parse_etags, parse_options_header, quote_etag
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, File, Field, Data
+
+import app
+import filehandling
+import quotas
+import userhandling
+from pathing import write_to_error_log, flush_error_log
+
+# The file API as a plain ASGI application, for many concurrent slow clients in one process: a connection waiting on
+# the network holds no thread, only the disk work does, on a bounded pool. Bodies are streamed both ways a chunk at a
+# time. Answers are the same as the Flask routes in app.py give. Serve it with any ASGI server, e.g.
+#   uvicorn --factory asgi:create_asgi_app --port 8001
+EXECUTOR_THREADS = 32  # Disk work in flight at once, over all connections.
+EXECUTOR = {'executor': None, 'pid': None}
+ROUTES = []  # [(method, compiled path pattern, handler)], matched in order.
+
+
+def route(method, pattern):
+    def register(handler):
+        ROUTES.append((method, re.compile('^' + pattern + '$'), handler))
+        return handler
+    return register
+
+
+def executor():
+    # Threads are not inherited by forked workers, so each process starts its own pool.
+    if EXECUTOR['pid'] != os.getpid():
+        EXECUTOR['executor'] = concurrent.futures.ThreadPoolExecutor(EXECUTOR_THREADS, thread_name_prefix='asgi-disk')
+        EXECUTOR['pid'] = os.getpid()
+    return EXECUTOR['executor']
+
+
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor(), functools.partial(function, *args))
+
+
+async def respond(send, status, body=b'', content_type='text/html; charset=utf-8', headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_json(send, data, headers=()):
+    await respond(send, 200, json.dumps(data).encode('utf-8'), 'application/json', headers)
+
+
+def not_modified(scope, etag):
+    # As app.not_modified, from the raw headers.
+    headers = dict(scope['headers'])
+    return b'if-none-match' in headers and parse_etags(headers[b'if-none-match'].decode('latin-1')).contains(etag)
+
+
+def validators(etag, last_modified=None):
+    headers = [(b'etag', quote_etag(etag).encode('latin-1'))]
+    if last_modified is not None:
+        headers.append((b'last-modified', http_date(last_modified).encode('latin-1')))
+    return headers
+
+
+def bad_request(send): return respond(send, 400)
+
+
+def successful_request(send): return respond(send, 200)
+
+
+def file_not_found_response(send): return respond(send, 404)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await run_blocking(flush_error_log)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    for method, pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match is not None and method == scope['method']:
+            break
+    else:
+        write_to_error_log("404 Not Found: " + scope['path'])
+        return await bad_request(send)
+    try:
+        await handler(scope, receive, send, *match.groups())
+    except Exception as error:
+        write_to_error_log(error)
+        await respond(send, 500)
+
+
+@route('GET', '/list_files/([^/]+)')
+async def list_files(scope, receive, send, userID):
+    user = userhandling.UserMethodPack(userID)
+    if not await run_blocking(user.exists):
+        return await respond_json(send, {'file_list': []})
+    etag = 'list-' + str(await run_blocking(filehandling.change_cursor, user))  # See app.list_files.
+    if not_modified(scope, etag):
+        return await respond(send, 304, headers=validators(etag))
+    await respond_json(send, {'file_list': await run_blocking(filehandling.list_live_files, user)}, validators(etag))
+
+
+@route('POST', '/upload_file/([^/]+)')
+async def upload_file(scope, receive, send, userID):
+    user = userhandling.UserMethodPack(userID)
+    if not await run_blocking(user.exists):
+        return await bad_request(send)
+    headers = dict(scope['headers'])
+    content_type, options = parse_options_header(headers.get(b'content-type', b'').decode('latin-1'))
+    if content_type != 'multipart/form-data' or 'boundary' not in options:
+        write_to_error_log("Upload file request by " + userID + "without any file.")
+        return await bad_request(send)
+    content_length = int(headers[b'content-length']) if headers.get(b'content-length', b'').isdigit() else None
+    if content_length is None and quotas.QUOTA_BYTES is not None:  # See app.over_quota_response.
+        return await respond(send, 411)
+    if await run_blocking(quotas.exceeds_quota, content_length or 0, 1, user):
+        return await respond(send, 507)
+    upload = {'filename': None, 'temporary_path': None, 'content_hash': None, 'additional_data': None}
+    try:
+        if not await receive_upload(receive, options['boundary'].encode('latin-1'), upload, user):
+            return await bad_request(send)
+        if upload['temporary_path'] is None:
+            write_to_error_log("Upload file request by " + userID + "without file.")
+            return await bad_request(send)
+        if upload['additional_data'] is None:
+            write_to_error_log("Upload file request by " + userID + "without additional data.")
+            return await bad_request(send)
+        try:
+            additional_data = json.loads(upload['additional_data'].decode('utf-8'))
+        except ValueError:
+            return await bad_request(send)
+        if not app.acceptable_upload(upload['filename'], additional_data):
+            return await bad_request(send)
+        if not await run_blocking(commit_upload, upload, additional_data, user):
+            write_to_error_log('Could not find available name for file:' + upload['filename'])
+            return await respond(send, 500)
+        upload['temporary_path'] = None  # Committed.
+    finally:
+        if upload['temporary_path'] is not None:
+            await run_blocking(os.remove, upload['temporary_path'])
+    await successful_request(send)
+
+
+async def receive_upload(receive, boundary, upload, user: userhandling.UserMethodPack):
+    # Feeds the body through the multipart parser as it arrives. The file goes straight to a temporary file, the
+    # additional data is kept in memory; returns False if the body is malformed or too large.
+    decoder = MultipartDecoder(boundary, app.MAX_ADDITIONAL_DATA_SIZE)
+    part, temporary_file, content_hash, received = None, None, None, 0
+    limit = app.app.config['MAX_CONTENT_LENGTH']
+    more_body = True
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if not more_body:
+                    return False
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return False
+                chunk = message.get('body', b'')
+                received += len(chunk)
+                if limit is not None and received > limit:
+                    write_to_error_log("413 Request Entity Too Large")
+                    return False
+                more_body = message.get('more_body', False)
+                decoder.receive_data(chunk)
+                if not more_body:
+                    decoder.receive_data(None)
+            elif isinstance(event, Epilogue):
+                return True
+            elif isinstance(event, File) and event.name == 'file_content' and upload['temporary_path'] is None:
+                part = 'file_content'
+                upload['filename'] = event.filename
+                upload['temporary_path'], temporary_file = await run_blocking(filehandling.open_temporary_file, user)
+                content_hash = hashlib.sha256()
+            elif isinstance(event, (File, Field)):
+                part = event.name if event.name == 'additional_data' and upload['additional_data'] is None else None
+                if part is not None:
+                    upload['additional_data'] = b''
+            elif isinstance(event, Data):
+                if part == 'file_content':
+                    await run_blocking(write_chunk, temporary_file, content_hash, event.data)
+                    if not event.more_data:
+                        await run_blocking(temporary_file.close)
+                        upload['content_hash'] = content_hash.hexdigest()
+                elif part == 'additional_data':
+                    upload['additional_data'] += event.data
+                    if len(upload['additional_data']) > app.MAX_ADDITIONAL_DATA_SIZE:
+                        return False
+    except ValueError:  # Not multipart after all.
+        return False
+    finally:
+        if temporary_file is not None and not temporary_file.closed:
+            await run_blocking(temporary_file.close)
+
+
+def write_chunk(file, content_hash, chunk):
+    content_hash.update(chunk)
+    file.write(chunk)
+
+
+def commit_upload(upload, additional_data, user: userhandling.UserMethodPack):
+    if upload['content_hash'] is None:  # The file part never ended; the parser would have said so.
+        return False
+    avail_filename = filehandling.get_available_name(upload['filename'], additional_data['t'], user)
+    if avail_filename is None:
+        return False
+    filehandling.commit_temporary_file(upload['temporary_path'], upload['content_hash'], avail_filename,
+                                       additional_data, user)
+    filehandling.mark_file_as_live(upload['filename'], user)
+    return True
+
+
+@route('GET', '/get_file/([^/]+)/([^/]+)')
+async def get_file(scope, receive, send, filename, userID):
+    if not filehandling.acceptable_filename(filename):
+        return await bad_request(send)
+    user = userhandling.UserMethodPack(userID)
+    latest_filename = await run_blocking(latest_version, filename, user)
+    if latest_filename is None:
+        return await file_not_found_response(send)
+    headers = validators(latest_filename, app.version_time(latest_filename))
+    if not_modified(scope, latest_filename):
+        return await respond(send, 304, headers=headers)
+    file_path, additional_data = await run_blocking(filehandling.load_file_path_and_additional_data,
+                                                    latest_filename, user)
+    if file_path is None or additional_data is None:
+        return await file_not_found_response(send)
+    # The same JSON as app.get_file, with the hex written out as the file is read rather than built in memory.
+    prefix = b'{"file": "'
+    suffix = b'", "additional_data": ' + json.dumps(additional_data).encode('utf-8') + b'}'
+    with await run_blocking(open, file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/html; charset=utf-8'),
+                                (b'content-length', str(len(prefix) + 2 * size + len(suffix)).encode('latin-1'))]
+                               + headers})
+        await send({'type': 'http.response.body', 'body': prefix, 'more_body': True})
+        while True:
+            chunk = await run_blocking(file.read, filehandling.STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk.hex().encode('ascii'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': suffix})
+
+
+def latest_version(filename, user: userhandling.UserMethodPack):
+    if not user.exists():
+        return None  # Obscure that user doens't exist
+    return filehandling.latest_filename_version(filename, user)
+
+
+@route('GET', '/get_file_time/([^/]+)/([^/]+)')
+async def get_file_timestamp(scope, receive, send, filename, userID):
+    if not filehandling.acceptable_filename(filename):
+        return await bad_request(send)
+    user = userhandling.UserMethodPack(userID)
+    latest_filename = await run_blocking(latest_version, filename, user)
+    if latest_filename is None:
+        return await file_not_found_response(send)
+    headers = validators(latest_filename, app.version_time(latest_filename))
+    if not_modified(scope, latest_filename):
+        return await respond(send, 304, headers=headers)
+    timestamp = await run_blocking(filehandling.load_latest_timestamp, filename, user)
+    if timestamp is None:
+        return await file_not_found_response(send)
+    await respond(send, 200, str(timestamp).encode('utf-8'), headers=headers)
+
+
+@route('POST', '/archive_file/([^/]+)/([^/]+)')
+async def archive_file(scope, receive, send, filename, userID):
+    await set_file_liveness(send, filehandling.archive_file, filename, userID)
+
+
+@route('POST', '/resurrect_file/([^/]+)/([^/]+)')
+async def resurrect_file(scope, receive, send, filename, userID):
+    await set_file_liveness(send, filehandling.resurrect_file, filename, userID)
+
+
+async def set_file_liveness(send, set_liveness, filename, userID):
+    if not filehandling.acceptable_filename(filename):
+        return await bad_request(send)
+    user = userhandling.UserMethodPack(userID)
+    if not await run_blocking(user.exists):
+        return await file_not_found_response(send)
+    if await run_blocking(set_liveness, filename, user):
+        return await successful_request(send)
+    await file_not_found_response(send)
+
+
+@route('POST', '/register/([^/]+)')
+async def register_user(scope, receive, send, userID):
+    write_to_error_log("Warning - User was registered by self:" + userID)
+    user = userhandling.UserMethodPack(userID)
+    if await run_blocking(user.exists):
+        return await bad_request(send)
+    await run_blocking(user.register)
+    await successful_request(send)
+
+
+@route('POST', '/unregister/([^/]+)')
+async def unregister_user(scope, receive, send, userID):
+    write_to_error_log("Warning - User was unregistered by self:" + userID)
+    user = userhandling.UserMethodPack(userID)
+    if not await run_blocking(user.exists):
+        return await bad_request(send)
+    await run_blocking(user.unregister)
+    await successful_request(send)
+
+
+def create_asgi_app(config=None):
+    app.create_app(config)
+    return application
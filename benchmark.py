@@ -0,0 +1,298 @@
+import argparse
+import atexit
+import http.client
+import json
+import multiprocessing
+import os
+import pathlib as pl
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# pathing derives every folder from the working directory, so the benchmark runs from a throwaway CloudIOServer dir.
+BENCH_DIR = pl.Path(tempfile.mkdtemp(prefix='cloudio_bench_'), 'CloudIOServer')
+BENCH_DIR.mkdir()
+atexit.register(shutil.rmtree, BENCH_DIR.parent, True)
+os.chdir(BENCH_DIR)
+
+import app  # noqa: E402
+import filehandling  # noqa: E402
+import userhandling  # noqa: E402
+from pathing import ADMIN_FOLDER, UPLOAD_FOLDER  # noqa: E402
+
+FILE_COUNTS = [10, 100, 1000, 10000, 100000]
+VERSIONS_PER_FILE = 3
+WORKLOAD = {'list_files': 4, 'get_file': 3, 'get_file_time': 2, 'upload_file': 1}  # Mix of the API benchmark.
+
+
+def seed_user(userID, file_count, versions_per_file, blob_size=None):
+    # Writes the blobs and the logs directly; going through store_additional_data would make seeding quadratic.
+    user = userhandling.UserMethodPack(userID)
+    user.register()
+    for folder in [ADMIN_FOLDER, UPLOAD_FOLDER, user.admin_directory(), user.upload_directory()]:
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+    live_files = {}
+    additional_data = {}
+    for i in range(file_count):
+        filename = format(i, 'x') + '.cio'
+        for version in range(versions_per_file):
+            timestamp = float(version + 1)
+            server_side_name = filehandling.filename_to_server_side_name(filename, timestamp, 0)
+            with open(filehandling.prepare_version_path(server_side_name, user), 'wb') as file:
+                file.write(b'This is for a benchmark.' if blob_size is None else os.urandom(blob_size))
+            additional_data[server_side_name] = {'t': timestamp, 'n': filename, 'nonce1': 123, 'nonce2': 456}
+        live_files[filename] = True
+    with open(user.live_files_log_path(), 'w') as live_log:
+        json.dump(live_files, live_log)
+    with open(user.add_data_log_path(), 'w') as add_log:
+        json.dump(additional_data, add_log)
+    return user
+
+
+def legacy_list_live_files(user):
+    # The listing as it used to be: a directory listing and a log parse for every live file.
+    with open(user.live_files_log_path(), 'r') as live_files_log_file:
+        data = json.load(live_files_log_file)
+    live_files = []
+    for name, isLive in data.items():
+        if isLive:
+            add_dat = filehandling.load_additional_data(filehandling.latest_filename_version(name, user), user)
+            live_files.append([name, add_dat['nonce1'], add_dat["t"]])
+    return live_files
+
+
+def time_call(function, user, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(user)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_list_live_files(file_counts, versions_per_file, legacy_max, repeats):
+    results = []
+    for idx, file_count in enumerate(file_counts):
+        user = seed_user(format(idx + 1, 'x') * 8, file_count, versions_per_file)
+        result = {'files': file_count, 'versions_per_file': versions_per_file,
+                  'list_live_files': time_call(filehandling.list_live_files, user, repeats)}
+        if file_count <= legacy_max:
+            result['legacy_list_live_files'] = time_call(legacy_list_live_files, user, repeats)
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def request_list_files(port, userID, requests):
+    # One client process: keep-alive GETs of the file list, as fast as the server answers them.
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    for _ in range(requests):
+        connection.request('GET', '/list_files/' + userID)
+        connection.getresponse().read()
+    connection.close()
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("The server did not start listening on port " + str(port) + ".")
+
+
+def bench_worker_processes(worker_counts, file_count, clients, requests_per_client, port):
+    # Requests per second served by serve.py with 1..N worker processes, against concurrent client processes.
+    user = seed_user('f' * 8, file_count, 1)
+    results = []
+    for worker_count in worker_counts:
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+                                   '--host', '127.0.0.1', '--port', str(port), '--workers', str(worker_count)],
+                                  stderr=subprocess.DEVNULL)  # The request log.
+        try:
+            wait_for_port(port)
+            request_list_files(port, user.userID, 1)  # Warm up the caches.
+            start = time.perf_counter()
+            with multiprocessing.Pool(clients) as pool:
+                pool.starmap(request_list_files, [(port, user.userID, requests_per_client)] * clients)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        result = {'worker_processes': worker_count, 'clients': clients, 'files': file_count,
+                  'requests_per_second': clients * requests_per_client / elapsed}
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def api_requests(userIDs, file_count, blob_size, count, seed):
+    # The same mixed workload for a given seed: (operation, method, path, body, content type) per request.
+    generator = random.Random(seed)
+    operations = [operation for operation, weight in WORKLOAD.items() for _ in range(weight)]
+    requests = []
+    for i in range(count):
+        operation = generator.choice(operations)
+        userID = generator.choice(userIDs)
+        filename = format(generator.randrange(file_count), 'x') + '.cio'
+        if operation == 'list_files':
+            requests.append((operation, 'GET', '/list_files/' + userID, None, None))
+        elif operation == 'get_file':
+            requests.append((operation, 'GET', '/get_file/' + filename + '/' + userID, None, None))
+        elif operation == 'get_file_time':
+            requests.append((operation, 'GET', '/get_file_time/' + filename + '/' + userID, None, None))
+        else:
+            additional_data = {'t': 1000.0 + i, 'n': filename, 'nonce1': 123, 'nonce2': 456}
+            body, content_type = multipart_upload(filename, generator.randbytes(blob_size), additional_data)
+            requests.append((operation, 'POST', '/upload_file/' + userID, body, content_type))
+    return requests
+
+
+def multipart_upload(filename, content, additional_data):
+    boundary = uuid.uuid4().hex
+    body = b''.join([b'--' + boundary.encode() + b'\r\n',
+                     b'Content-Disposition: form-data; name="file_content"; filename="' + filename.encode() + b'"\r\n',
+                     b'Content-Type: application/octet-stream\r\n\r\n', content, b'\r\n',
+                     b'--' + boundary.encode() + b'\r\n',
+                     b'Content-Disposition: form-data; name="additional_data"; filename="additional_data"\r\n',
+                     b'Content-Type: application/json\r\n\r\n', json.dumps(additional_data).encode(), b'\r\n',
+                     b'--' + boundary.encode() + b'--\r\n'])
+    return body, 'multipart/form-data; boundary=' + boundary
+
+
+def drive_test_client(requests, latencies):
+    client = app.app.test_client()
+    for operation, method, path, body, content_type in requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        response.close()
+        latencies.append((operation, time.perf_counter() - start, response.status_code))
+
+
+def drive_socket(port, requests, latencies):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    for operation, method, path, body, content_type in requests:
+        start = time.perf_counter()
+        connection.request(method, path, body, {'Content-Type': content_type} if content_type else {})
+        response = connection.getresponse()
+        response.read()
+        latencies.append((operation, time.perf_counter() - start, response.status))
+    connection.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summarise(latencies, elapsed):
+    summary = {'requests': len(latencies), 'requests_per_second': len(latencies) / elapsed, 'operations': {}}
+    for operation in WORKLOAD:
+        times = sorted(latency for latency_operation, latency, status in latencies if latency_operation == operation)
+        if times:
+            summary['operations'][operation] = {'requests': len(times), 'p50_ms': 1000 * percentile(times, 0.5),
+                                                'p99_ms': 1000 * percentile(times, 0.99),
+                                                'errors': sum(1 for latency_operation, latency, status in latencies
+                                                              if latency_operation == operation and status >= 400)}
+    # The run's own peak: every run is measured in a process of its own (see measure_api_run).
+    summary['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux reports KiB.
+    return summary
+
+
+def measure_api_run(transport, requests, clients):
+    # In a freshly forked process, whose peak RSS starts from the benchmark's current size rather than its peak so far.
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(drive_api_run, (transport, requests, clients))
+
+
+def drive_api_run(transport, requests, clients):
+    latencies = []
+    start = time.perf_counter()
+    if transport == 'test_client':
+        drive_test_client(requests, latencies)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threads = [threading.Thread(target=drive_socket, args=(server.server_port, requests[i::clients], latencies))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+    return summarise(latencies, time.perf_counter() - start)
+
+
+def bench_api(user_counts, versions_per_file, blob_sizes, file_count, requests_per_run, clients, seed, config):
+    # Every combination of users, versions per file and blob size, seeded afresh, driven once through the test
+    # client and once over real sockets by concurrent clients, against the app as create_app configures it. The
+    # users are seeded as JSON logs, so the metadata backend is the JSON one.
+    app.create_app(dict(config, RETENTION_WORKER=False))
+    results = []
+    for run, (user_count, blob_size) in enumerate([(users, size) for users in user_counts for size in blob_sizes]):
+        userIDs = [format(run + 1, 'x') + format(i, 'x').rjust(8, '0') for i in range(user_count)]
+        for userID in userIDs:
+            seed_user(userID, file_count, versions_per_file, blob_size)
+        requests = api_requests(userIDs, file_count, blob_size, requests_per_run, seed)
+        for transport in ['test_client', 'socket']:
+            result = {'transport': transport, 'users': user_count, 'files_per_user': file_count,
+                      'versions_per_file': versions_per_file, 'blob_size': blob_size, 'clients': 1 if
+                      transport == 'test_client' else clients}
+            result.update(measure_api_run(transport, requests, clients))
+            results.append(result)
+            print(json.dumps(result))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CloudIO server file listing.')
+    parser.add_argument('--files', type=int, nargs='+', default=FILE_COUNTS, help='File counts per user.')
+    parser.add_argument('--versions', type=int, default=VERSIONS_PER_FILE, help='Versions stored per file.')
+    parser.add_argument('--legacy-max', type=int, default=1000,
+                        help='Largest file count to also time the per-file listing on (it is quadratic).')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per measurement; the best is reported.')
+    parser.add_argument('--worker-processes', type=int, nargs='+',
+                        help='Instead, time serve.py with each of these numbers of worker processes.')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client processes for --worker-processes.')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per client for --worker-processes.')
+    parser.add_argument('--port', type=int, default=8099, help='Port serve.py listens on for --worker-processes.')
+    parser.add_argument('--api', action='store_true',
+                        help='Instead, run the mixed API workload against seeded users, versions and blob sizes.')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10], help='User counts for --api.')
+    parser.add_argument('--blob-sizes', type=int, nargs='+', default=[1024, 1024 * 1024], help='Blob sizes for --api.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the --api workload.')
+    parser.add_argument('--metadata-cache-mb', type=int, default=256,
+                        help='Megabytes of memory the --api app keeps parsed logs in, estimated.')
+    parser.add_argument('--output', help='Also write the results, with the commit they were measured at, to this JSON file.')
+    args = parser.parse_args()
+    if args.api:
+        results = bench_api(args.users, args.versions, args.blob_sizes, args.files[0], args.requests, args.clients,
+                            args.seed, {'METADATA_CACHE_BYTES': args.metadata_cache_mb * 1024 * 1024})
+    elif args.worker_processes:
+        results = bench_worker_processes(args.worker_processes, args.files[0], args.clients, args.requests, args.port)
+    else:
+        results = bench_list_live_files(args.files, args.versions, args.legacy_max, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'commit': git_commit(), 'arguments': vars(args), 'results': results}, output, indent=1)
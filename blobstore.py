@@ -0,0 +1,127 @@
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+
+import filehandling
+import metadata
+import userhandling
+
+# Every distinct blob a user uploads is stored once, as blobs/USER<id>/<digest[:2]>/<digest>. Each stored version (see
+# filehandling.version_path) is a hard link to its blob, so versions are read exactly as before, and a blob's link
+# count tells how many versions reference it: a count of 1 means only the blob store itself does. Versions are linked
+# while sharing the user's blob store lock and blobs are collected while holding it alone, so no blob is collected
+# between being stored or found and being linked to.
+# Blobs are kept per user so one user's uploads never reveal what another user stores.
+HASH_CHUNK_SIZE = 64 * 1024
+# Why os.link may fail where a copy would not: across filesystems, no hard links there, or too many links to a blob.
+LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def blob_path(content_hash, user: userhandling.UserMethodPack):
+    return os.path.join(user.blob_directory(), content_hash[:2], content_hash)
+
+
+def has_blob(content_hash, user: userhandling.UserMethodPack):
+    return os.path.isfile(blob_path(content_hash, user))
+
+
+def blob_size(content_hash, user: userhandling.UserMethodPack):
+    # None if the user has no such blob.
+    try:
+        return os.path.getsize(blob_path(content_hash, user))
+    except FileNotFoundError:
+        return None
+
+
+def link_version(content_hash, version_path, user: userhandling.UserMethodPack, temporary_path=None):
+    # Make version_path a reference to the blob with the given hash. The temporary file holding the same bytes is
+    # moved into the store if the blob is new, and dropped if it is a duplicate.
+    path = blob_path(content_hash, user)
+    user.acquire_blob_store_lock(shared=True)
+    try:
+        try:
+            link_or_copy(path, version_path)
+        except FileNotFoundError:  # New blob, or collected between the caller's check and now.
+            if temporary_path is None:
+                raise
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temporary_path, path)
+            link_or_copy(path, version_path)
+            return
+        if temporary_path is not None:
+            os.remove(temporary_path)
+    finally:
+        user.release_blob_store_lock(shared=True)
+
+
+def link_or_copy(source_path, destination_path):
+    # Never replaces an existing destination; versions are immutable, so that raises FileExistsError.
+    try:
+        os.link(source_path, destination_path)
+    except OSError as error:
+        if error.errno not in LINK_UNSUPPORTED_ERRNOS:
+            raise
+        with open(source_path, 'rb') as source, open(destination_path, 'xb') as destination:
+            shutil.copyfileobj(source, destination)  # The version just gets its own copy.
+
+
+def references(content_hash, user: userhandling.UserMethodPack):
+    return os.stat(blob_path(content_hash, user)).st_nlink - 1
+
+
+def hash_file(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def collect_garbage(user: userhandling.UserMethodPack):
+    # Removes the blobs no version links to any more; returns the number of bytes freed.
+    freed = 0
+    if not os.path.isdir(user.blob_directory()):
+        return freed
+    for fan_out in os.listdir(user.blob_directory()):
+        fan_out_directory = os.path.join(user.blob_directory(), fan_out)
+        for content_hash in os.listdir(fan_out_directory):
+            path = os.path.join(fan_out_directory, content_hash)
+            if os.stat(path).st_nlink > 1:
+                continue
+            user.acquire_blob_store_lock()
+            stat = os.stat(path)  # Again; a version may have been linked to it meanwhile.
+            if stat.st_nlink == 1:
+                os.remove(path)
+                freed += stat.st_size
+            user.release_blob_store_lock()
+        user.acquire_blob_store_lock()
+        if not os.listdir(fan_out_directory):
+            os.rmdir(fan_out_directory)
+        user.release_blob_store_lock()
+    return freed
+
+
+def deduplicate(version_paths, user: userhandling.UserMethodPack):
+    # Moves versions stored before the blob store existed into it, replacing each by a link to its blob.
+    for version_path in version_paths:
+        if os.stat(version_path).st_nlink > 1:
+            continue  # Already a reference to a blob.
+        path = blob_path(hash_file(version_path), user)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.link(version_path, path)  # The version's bytes become the blob.
+            continue
+        temporary_path = os.path.join(os.path.dirname(version_path), '.dedup-' + uuid.uuid4().hex)
+        os.link(path, temporary_path)
+        os.replace(temporary_path, version_path)  # Readers see either the old copy or the link, never nothing.
+
+
+def deduplicate_all():
+    for userID in metadata.backend().users():
+        user = userhandling.UserMethodPack(userID)
+        deduplicate([path for server_side_name, path in filehandling.stored_versions(user)], user)
+
+if __name__ == '__main__':
+    deduplicate_all()
@@ -1,35 +1,36 @@
+import hashlib
 import json
 import os
 import string
+import struct
+import threading
+import time
+import uuid
 
 import app
+import blobstore
+import metadata
+import metrics
 import pathing
 import userhandling
 from pathing import write_to_error_log, ADMIN_FOLDER
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes held in memory at a time while an upload is streamed to disk.
+TEMPORARY_FILE_PREFIX = '.upload-'  # Uploads in progress; never parsed as a server side name.
+TEMPORARY_FILE_TIMEOUT = 60 * 60  # Seconds a temporary file may go unwritten before retention takes it for abandoned.
+CHANGES_CONDITION = threading.Condition()  # Notified whenever any user's files change, waking long polls.
+LONG_POLL_INTERVAL = 1.0  # Seconds between checks for changes made by other processes while long polling.
+# A bulk download is a sequence of frames: the length of a JSON header as 4 bytes, big endian, the header
+# {"filename", "additional_data", "size"}, then 'size' bytes of the file's latest version. A length of 0 ends it.
+FRAME_HEADER_LENGTH = struct.Struct('>I')
 
 
+@metrics.timed('list_live_files')
 def list_live_files(user: userhandling.UserMethodPack):  # In Admin there exists a file dict
     if not user.exists():
         return []
     if not os.path.isdir(user.admin_directory()):
         return []
-    user.acquire_live_files_log_lock()
-    # Does the log exist?
-    if not os.path.isfile(user.live_files_log_path()):
-        user.release_live_files_log_lock()
-        return []
-    with open(user.live_files_log_path(), 'r') as live_files_log_file:
-        data = json.load(live_files_log_file)
-    user.release_live_files_log_lock()
-    # Obtain the set of names 'live'.
-    live_files = []
-    for name, isLive in data.items():
-        if isLive:
-            add_dat = load_additional_data(
-                latest_filename_version(name, user), user
-            )
-            live_files.append([name, add_dat['nonce1'], add_dat["t"]])
-    return live_files
+    return metadata.backend().live_files(user)
 
 
 def set_file_liveness(filename: str, set_to: bool, user: userhandling.UserMethodPack):
@@ -38,24 +39,10 @@ def set_file_liveness(filename: str, set_to: bool, user: userhandling.UserMethod
     if not os.path.isdir(user.admin_directory()):
         write_to_error_log("File that shouldn't exist's status attempted to be changed by" + user.userID + ".")
         return False  # File doesn't exist.
-    user.acquire_live_files_log_lock()
-    # Does the log exist?
-    if not os.path.isfile(user.live_files_log_path()):
-        write_to_error_log("File that shouldn't exist's status attempted to be changed by" + user.userID + ".")
-        user.release_live_files_log_lock()
-        return False
-    with open(user.live_files_log_path(), 'r') as live_files_log_file:
-        data = json.load(live_files_log_file)
-    # Does the log contain the name?
-    if filename not in data.keys():
-        user.release_live_files_log_lock()
-        return False
-    # Set it to 'set_to'.
-    data[filename] = set_to
-    with open(user.live_files_log_path(), 'w') as live_files_log_file:
-        json.dump(data, live_files_log_file)
-    user.release_live_files_log_lock()
-    return True
+    changed = metadata.backend().set_file_liveness(filename, set_to, user)
+    if changed:
+        notify_changes()
+    return changed
 
 
 def archive_file(filename, user: userhandling.UserMethodPack):
@@ -67,55 +54,195 @@ def resurrect_file(filename, user:userhandling.UserMethodPack):
 
 
 def mark_file_as_live(filename, user: userhandling.UserMethodPack):
-    user.acquire_live_files_log_lock()
-    # Does the log exist?
+    prepare_admin_directory(user)  # Does the log exist?
+    metadata.backend().mark_files_as_live([filename], user)
+    notify_changes()
+
+
+def prepare_admin_directory(user: userhandling.UserMethodPack):
     if not os.path.isdir(ADMIN_FOLDER):
         os.mkdir(ADMIN_FOLDER)
-    if not os.path.isdir(user.admin_directory()):
-        os.mkdir(user.admin_directory())
-    if not os.path.isfile(user.live_files_log_path()):
-        with open(user.live_files_log_path(), 'w') as live_log:
-            json.dump({filename: True}, live_log)  # First entry.
-        user.release_live_files_log_lock()
-        return
-    with open(user.live_files_log_path(), 'r') as live_log:
-        data = json.load(live_log)
-    data[filename] = True
-    with open(user.live_files_log_path(), 'w') as live_log:
-        json.dump(data, live_log)
-    user.release_live_files_log_lock()
+    if not os.path.isdir(user.admin_directory()):  # If admin dir of user not created ...
+        os.mkdir(user.admin_directory())  # ... create it.
+
+
+def notify_changes():
+    with CHANGES_CONDITION:
+        CHANGES_CONDITION.notify_all()
+
+
+def change_cursor(user: userhandling.UserMethodPack):
+    # Moves with every upload, archive and resurrect of the user's files.
+    return metadata.backend().change_cursor(user)
+
+
+def list_changes_since(cursor, user: userhandling.UserMethodPack):
+    # The files uploaded, archived or resurrected after the cursor, as [name, isLive, nonce1, t], and the new cursor.
+    backend = metadata.backend()
+    if cursor > backend.change_cursor(user):
+        cursor = 0  # The client is ahead of us, e.g. after a restore from backup; start over.
+    latest_cursor, liveness = backend.changes_since(cursor, user)
+    changes = []
+    for filename, is_live in liveness.items():
+        add_dat = backend.additional_data(backend.latest_version(filename, user), user)
+        if add_dat is None:
+            continue
+        changes.append([filename, bool(is_live), add_dat['nonce1'], add_dat["t"]])
+    return latest_cursor, changes
+
+
+def wait_for_changes(cursor, timeout, user: userhandling.UserMethodPack):
+    deadline = time.monotonic() + timeout
+    backend = metadata.backend()
+    while backend.change_cursor(user) == cursor:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        with CHANGES_CONDITION:
+            CHANGES_CONDITION.wait(min(remaining, LONG_POLL_INTERVAL))
 
 
 def save_file_and_additional_data(file, avail_filename, additional_data, user: userhandling.UserMethodPack):  # TODO: How to test this?
-    user_upload_dir = user.upload_directory()
-    if not os.path.isdir(user_upload_dir):
-        os.mkdir(user_upload_dir)
-    file.save(os.path.join(user_upload_dir, avail_filename))
+    temporary_path, content_hash = save_stream_to_temporary_file(file.stream, user)
+    commit_temporary_file(temporary_path, content_hash, avail_filename, additional_data, user)
+
+
+def save_files_and_additional_data(uploads, user: userhandling.UserMethodPack):
+    # uploads are validated (filename, temporary_path, content_hash, additional_data). Every temporary file is linked as
+    # a version first, then the metadata of them all is committed with one write per log. Should either fail, the
+    # versions linked so far are deleted again, so none is left without its metadata. Returns each upload's server side
+    # name, or None where no name was available.
+    server_side_names = []
+    entries = {}
+    stored_bytes = 0
+    try:
+        for filename, temporary_path, content_hash, additional_data in uploads:
+            avail_filename = get_available_name(filename, additional_data['t'], user)  # Sees the versions linked so far.
+            if avail_filename is None:
+                os.remove(temporary_path)
+            else:
+                avail_filename, size = store_version(content_hash, avail_filename, user, temporary_path)
+                stored_bytes += size
+                entries[avail_filename] = additional_data
+            server_side_names.append(avail_filename)
+        if entries:
+            prepare_admin_directory(user)
+            metadata.backend().store_additional_data(entries, user)
+    except BaseException:
+        for server_side_name in entries:
+            delete_version(server_side_name, user)
+        raise
+    if entries:
+        metadata.backend().add_usage(stored_bytes, len(entries), user)
+        live_filenames = [upload[0] for upload, server_side_name in zip(uploads, server_side_names) if server_side_name]
+        metadata.backend().mark_files_as_live(list(dict.fromkeys(live_filenames)), user)  # After their versions.
+        notify_changes()
+    return server_side_names
+
+
+def save_stream_to_temporary_file(stream, user: userhandling.UserMethodPack):
+    # Copies the stream into a temporary file in the user's upload dir through a bounded buffer, hashing as it goes.
+    temporary_path, temporary_file = open_temporary_file(user)
+    content_hash = hashlib.sha256()
+    try:
+        with temporary_file:
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+                temporary_file.write(chunk)
+            metrics.count(metrics.BYTES_WRITTEN, temporary_file.tell(), stage='upload')
+    except BaseException:  # E.g. the client went away mid-upload.
+        os.remove(temporary_path)
+        raise
+    return temporary_path, content_hash.hexdigest()
+
+
+def open_temporary_file(user: userhandling.UserMethodPack):
+    os.makedirs(user.upload_directory(), exist_ok=True)
+    temporary_path = os.path.join(user.upload_directory(), TEMPORARY_FILE_PREFIX + uuid.uuid4().hex)
+    return temporary_path, open(temporary_path, 'wb')
+
+
+def remove_abandoned_temporary_files(user: userhandling.UserMethodPack, now=None):
+    # Removes the temporary files of uploads that died without cleaning up, e.g. with their process; returns how many.
+    now = time.time() if now is None else now
+    if not os.path.isdir(user.upload_directory()):
+        return 0
+    removed = 0
+    for entry in os.listdir(user.upload_directory()):
+        if not entry.startswith(TEMPORARY_FILE_PREFIX):
+            continue
+        path = os.path.join(user.upload_directory(), entry)
+        try:
+            if os.path.getmtime(path) <= now - TEMPORARY_FILE_TIMEOUT:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:  # Committed or removed meanwhile.
+            pass
+    return removed
+
+
+def commit_temporary_file(temporary_path, content_hash, avail_filename, additional_data,
+                          user: userhandling.UserMethodPack):
+    # The version becomes a link to the blob with the content's hash; the temporary file is only kept if it is new.
+    avail_filename, size = store_version(content_hash, avail_filename, user, temporary_path)
+    metadata.backend().add_usage(size, 1, user)
     store_additional_data(avail_filename, additional_data, user)
 
 
+def commit_known_blob(content_hash, avail_filename, additional_data, user: userhandling.UserMethodPack):
+    # Stores a version of a blob the user already has without it being uploaded again. False if the blob was collected
+    # since the caller found it; then the content has to be uploaded after all.
+    try:
+        avail_filename, size = store_version(content_hash, avail_filename, user)
+    except FileNotFoundError:
+        if blobstore.has_blob(content_hash, user):
+            raise
+        return False
+    metadata.backend().add_usage(size, 1, user)
+    store_additional_data(avail_filename, additional_data, user)
+    return True
+
+
+def store_version(content_hash, avail_filename, user: userhandling.UserMethodPack, temporary_path=None):
+    # Links the version to its blob; returns the server side name it was stored under and its size, for the user's
+    # usage (see quotas.py). Another upload, maybe in another process, can take the available name first; then the
+    # next available one is used. Deleting a version can remove the directories it was in (see delete_version) between
+    # their creation and the link; then they are made again.
+    filename = server_side_name_to_filename(avail_filename)
+    timestamp = avail_filename.rsplit('_', 2)[1]  # As in the name, so the next names are spelled alike.
+    while True:
+        path = prepare_version_path(avail_filename, user)
+        try:
+            blobstore.link_version(content_hash, path, user, temporary_path)
+            return avail_filename, os.path.getsize(path)
+        except FileExistsError:
+            taken = True
+        except FileNotFoundError:
+            if os.path.isdir(os.path.dirname(path)):
+                raise
+            taken = False
+        if temporary_path is not None and not os.path.isfile(temporary_path):
+            temporary_path = None  # Already moved into the blob store.
+        if not taken:
+            continue
+        avail_filename = get_available_name(filename, timestamp, user)
+        if avail_filename is None:
+            if temporary_path is not None:
+                os.remove(temporary_path)
+            raise Exception("No available name left for file: " + filename)
+
+
 def store_additional_data(server_side_name, additional_data, user: userhandling.UserMethodPack):
-    user_admin_dir = user.admin_directory()
-    if not os.path.isdir(ADMIN_FOLDER):
-        os.mkdir(ADMIN_FOLDER)
-    if not os.path.isdir(user_admin_dir):  # If admin dir of user not created ...
-        os.mkdir(user_admin_dir)  # ... create it.
-    user_add_log_loc = user.add_data_log_path()
-    if not os.path.isfile(user_add_log_loc):
-        # If the file doesn't already exist, just dump a simple map into it.
-        with open(user_add_log_loc, 'w') as add_log:
-            json.dump({server_side_name: additional_data}, add_log)
-        return
-    with open(user_add_log_loc, 'r') as add_log:
-        data = json.load(add_log)
-    data[server_side_name] = additional_data
-    with open(user_add_log_loc, 'w') as add_log:
-        json.dump(data, add_log)
+    prepare_admin_directory(user)
+    metadata.backend().store_additional_data({server_side_name: additional_data}, user)
 
 
 def load_file_path_and_additional_data(server_side_name, user: userhandling.UserMethodPack):
-    filepath = os.path.join(user.upload_directory(), server_side_name)
-    if not os.path.isfile(filepath):
+    filepath = find_version_path(server_side_name, user)
+    if filepath is None:
         return None, None
     additional_data = load_additional_data(server_side_name, user)
     if additional_data is None:
@@ -123,19 +250,21 @@ def load_file_path_and_additional_data(server_side_name, user: userhandling.User
     return filepath, additional_data
 
 
+@metrics.timed('hex_encode')
+def load_file_hex(file_path):
+    # The whole file as hex, as get_file sends it.
+    with open(file_path, 'rb') as file:
+        content = file.read()
+    metrics.count(metrics.BYTES_READ, len(content), stage='get_file')
+    return content.hex()
+
+
 def load_additional_data(filename, user: userhandling.UserMethodPack):
-    user.acquire_additional_data_log_lock()
-    # Does the log exist?
-    if not os.path.isfile(user.add_data_log_path()):
-        user.release_additional_data_log_lock()
-        return None
-    with open(user.add_data_log_path(), 'r') as add_log:
-        data = json.load(add_log)
-    user.release_additional_data_log_lock()
-    # Does the log contain an entry for our filename?
-    if filename not in data.keys():
-        return None
-    return data[filename]
+    return metadata.backend().additional_data(filename, user)
+
+
+def load_additional_data_log(user: userhandling.UserMethodPack):
+    return metadata.backend().additional_data_log(user)
 
 
 def load_latest_timestamp(filename, user: userhandling.UserMethodPack):
@@ -146,12 +275,56 @@ def load_latest_timestamp(filename, user: userhandling.UserMethodPack):
     return additional_data_of_file['t']
 
 
+def load_latest_file_metadata(user: userhandling.UserMethodPack, filenames=None):
+    # One pass over the metadata for many files: filename -> latest timestamp, nonces and liveness.
+    # All files the user ever marked live are included when no filenames are given.
+    backend = metadata.backend()
+    liveness = backend.liveness(user)
+    latest_versions = backend.latest_versions(user)
+    additional_data_log = backend.additional_data_log(user)
+    if filenames is None:
+        filenames = list(liveness.keys())
+    file_metadata = {}
+    for filename in filenames:
+        additional_data_of_file = additional_data_log.get(latest_versions.get(filename.split('.')[0]))
+        if additional_data_of_file is None:
+            continue
+        file_metadata[filename] = {'t': additional_data_of_file['t'],
+                                   'nonce1': additional_data_of_file['nonce1'],
+                                   'nonce2': additional_data_of_file['nonce2'],
+                                   'live': liveness.get(filename, False)}
+    return file_metadata
+
+
+def stream_latest_versions(filenames, user: userhandling.UserMethodPack):
+    # Generates the frames of a bulk download one chunk at a time; files that cannot be found are left out.
+    for filename in filenames:
+        latest_filename = latest_filename_version(filename, user)
+        if latest_filename is None:
+            continue
+        file_path, additional_data = load_file_path_and_additional_data(latest_filename, user)
+        if file_path is None:
+            continue
+        try:
+            file = open(file_path, 'rb')
+        except FileNotFoundError:  # Deleted since it was looked up.
+            continue
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            metrics.count(metrics.BYTES_READ, size, stage='download_files')
+            header = json.dumps({'filename': filename, 'additional_data': additional_data, 'size': size}).encode('utf-8')
+            yield FRAME_HEADER_LENGTH.pack(len(header)) + header
+            for chunk in iter(lambda: file.read(STREAM_CHUNK_SIZE), b''):
+                yield chunk
+    yield FRAME_HEADER_LENGTH.pack(0)
+
+
 def get_available_name(filename, timestamp, user: userhandling.UserMethodPack):
     for i in range(100):
         avail_filename = filename_to_server_side_name(filename, timestamp, i)
-        if not os.path.isfile(os.path.join(user.upload_directory(), avail_filename)):
+        if find_version_path(avail_filename, user) is None:
             break
-    if os.path.isfile(os.path.join(user.upload_directory(), avail_filename)):
+    if find_version_path(avail_filename, user) is not None:
         return None
     return avail_filename
 
@@ -191,15 +364,131 @@ def server_side_name_to_filename(server_side_name):
     return filename + '.' + file_ext
 
 
+def split_server_side_name(server_side_name):
+    # '<name>_<timestamp>_<index>.<ext>' -> (name, timestamp, index); None if not a server side name.
+    fragments = server_side_name.rsplit('_', 2)
+    if len(fragments) != 3 or not all(char in string.hexdigits for char in fragments[0]):
+        return None
+    try:
+        return fragments[0], float(fragments[1]), int(fragments[2].split('.')[0])
+    except ValueError:
+        return None
+
+
+@metrics.timed('latest_version')
 def latest_filename_version(filename, user: userhandling.UserMethodPack):
-    files = os.listdir(user.upload_directory())
-    filename_prefix = filename.split('.')[0]  # name part of request
-    curr_timestamp = 0.0  # 1970, 1st of january, 0:00
-    curr_latest_filename = None
-    for filename_in_list in files:
-        if filename_prefix == filename_in_list.rsplit('_', 2)[0]:  # name == name
-            file_timestamp = float(filename_in_list.rsplit('_', 2)[1])
-            if curr_latest_filename is None or curr_timestamp < file_timestamp:
-                curr_latest_filename = filename_in_list
-                curr_timestamp = file_timestamp
-    return curr_latest_filename
+    return metadata.backend().latest_version(filename, user)
+
+
+def latest_filename_versions(user: userhandling.UserMethodPack):
+    # Maps the name part of every file stored by the user to the server side name of its latest version.
+    return metadata.backend().latest_versions(user)
+
+
+# Versions are stored as uploads/USER<id>/<h[:2]>/<h[2:4]>/<name>/<ts>_<idx>.<ext>, h being the SHA-256 of the name,
+# so no directory grows with the number of files. Versions stored flat in uploads/USER<id> before this layout are
+# still found there until migrate_to_sharded_layout has moved them.
+def version_directory(filename, user: userhandling.UserMethodPack):
+    name = filename.split('.')[0]
+    name_hash = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return os.path.join(user.upload_directory(), name_hash[:2], name_hash[2:4], name)
+
+
+def version_path(server_side_name, user: userhandling.UserMethodPack):
+    name, version = safe_server_side_name(server_side_name).split('_', 1)
+    return inside_upload_directory(os.path.join(version_directory(name, user), version), user)
+
+
+def flat_version_path(server_side_name, user: userhandling.UserMethodPack):
+    return inside_upload_directory(os.path.join(user.upload_directory(), safe_server_side_name(server_side_name)), user)
+
+
+def safe_server_side_name(server_side_name):
+    if split_server_side_name(server_side_name) is None or os.sep in server_side_name \
+            or (os.altsep is not None and os.altsep in server_side_name):
+        raise Exception("Server was asked for the path of an unsafe server side name; won't do that.")
+    return server_side_name
+
+
+def inside_upload_directory(path, user: userhandling.UserMethodPack):
+    if not os.path.abspath(path).startswith(os.path.abspath(user.upload_directory()) + os.sep):
+        raise Exception("Server was asked for a path outside the upload directory; won't do that.")
+    return path
+
+
+def find_version_path(server_side_name, user: userhandling.UserMethodPack):
+    for path in [version_path(server_side_name, user), flat_version_path(server_side_name, user)]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def prepare_version_path(server_side_name, user: userhandling.UserMethodPack):
+    path = version_path(server_side_name, user)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def stored_versions(user: userhandling.UserMethodPack):
+    # Every version stored for the user, as (server side name, path), in either layout. Directories removed during the
+    # walk, with the last version deleted from them (see delete_version), are skipped.
+    for entry in list_directory(user.upload_directory()):
+        entry_path = os.path.join(user.upload_directory(), entry)
+        if split_server_side_name(entry) is not None:
+            yield entry, entry_path
+        elif len(entry) == 2 and os.path.isdir(entry_path):
+            for second_level in list_directory(entry_path):
+                second_level_path = os.path.join(entry_path, second_level)
+                for name in list_directory(second_level_path):
+                    for version in list_directory(os.path.join(second_level_path, name)):
+                        if split_server_side_name(name + '_' + version) is not None:
+                            yield name + '_' + version, os.path.join(second_level_path, name, version)
+
+
+def list_directory(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+
+def delete_version(server_side_name, user: userhandling.UserMethodPack):
+    # Returns the size of the version deleted, or None if it was not stored.
+    path = find_version_path(server_side_name, user)
+    if path is None:
+        return None
+    size = os.path.getsize(path)
+    os.remove(path)
+    if path == version_path(server_side_name, user):
+        directory = os.path.dirname(path)
+        for level in range(3):  # The name's directory, then the two shard directories above it, once empty.
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+    return size
+
+
+def migrate_to_sharded_layout(user: userhandling.UserMethodPack):
+    # Safe while serving: each version is linked into place before its flat name is removed, and lookups try the
+    # sharded path first, so every version stays reachable throughout.
+    migrated = 0
+    for server_side_name, path in list(stored_versions(user)):
+        if path != flat_version_path(server_side_name, user):
+            continue
+        sharded_path = prepare_version_path(server_side_name, user)
+        if not os.path.isfile(sharded_path):
+            os.link(path, sharded_path)
+        os.remove(path)
+        migrated += 1
+    return migrated
+
+
+def migrate_all_to_sharded_layout():
+    for userID in metadata.backend().users():
+        migrate_to_sharded_layout(userhandling.UserMethodPack(userID))
+
+
+if __name__ == '__main__':
+    migrate_all_to_sharded_layout()
@@ -0,0 +1,227 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+
+import locking
+import metrics
+from pathing import ADMIN_FOLDER, JOURNAL_EXTENSION, LIVE_FILES_LOG_FILENAME, ADDITIONAL_DATA_LOG_FILENAME, \
+    CHANGE_LOG_FILENAME, ARCHIVE_LOG_FILENAME
+
+# A log is a JSON snapshot (the format the logs always had) plus an append-only journal of one JSON record per line,
+# '[key, value]', or '[key]' when the key was removed. Writes append to the journal; once it holds COMPACTION_THRESHOLD records it is folded into the
+# snapshot. Callers hold the owning user's lock for the log while reading or writing it; readers may share that lock,
+# so bringing the replayed state up to date is also serialised per log by replay_lock.
+# The replayed states are kept, least recently used first, until the memory they take adds up to more than
+# MAX_CACHED_BYTES (app.create_app sets it from the METADATA_CACHE_BYTES config). That memory is estimated as
+# PARSED_SIZE_FACTOR times the bytes of log a state was parsed from; parsed, the logs measure about 2.5 to 4 times their
+# size. A state is validated against the files on every use, so logs changed by another process are reread.
+COMPACTION_THRESHOLD = 1000
+FSYNC_JOURNAL = True
+MAX_CACHED_BYTES = 256 * 1024 * 1024
+PARSED_SIZE_FACTOR = 4
+REPLAY_STATES = collections.OrderedDict()  # dict[snapshot_path->dict], the replayed content of each log and how far the journal was read.
+CACHED = {'bytes': 0}
+CACHE_LOCK = threading.Lock()
+REPLAY_LOCKS = locking.LockRegistry(inter_process=False)  # 'REPLAY' + snapshot_path; idle ones are evicted.
+
+
+def journal_path(snapshot_path):
+    return str(snapshot_path) + JOURNAL_EXTENSION
+
+
+def log_exists(snapshot_path):
+    return os.path.isfile(snapshot_path) or os.path.isfile(journal_path(snapshot_path))
+
+
+def has_journal(snapshot_path):
+    # Are there records not yet compacted into the snapshot?
+    signature = file_signature(journal_path(snapshot_path))
+    return signature is not None and signature[2] > 0
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextlib.contextmanager
+def replay_lock(snapshot_path):
+    REPLAY_LOCKS.acquire('REPLAY' + str(snapshot_path))
+    try:
+        yield
+    finally:
+        REPLAY_LOCKS.release('REPLAY' + str(snapshot_path))
+
+
+@metrics.timed('log_replay')
+def replay(snapshot_path):
+    # Callers hold replay_lock(snapshot_path). Bring the replayed state of the log up to date, reading only the journal records not seen yet.
+    state = REPLAY_STATES.get(snapshot_path)
+    snapshot_signature = file_signature(snapshot_path)
+    journal_signature = file_signature(journal_path(snapshot_path))
+    if state is None or state['snapshot'] != snapshot_signature or not journal_continues(state, journal_signature):
+        data = {}
+        if snapshot_signature is not None:
+            with open(snapshot_path, 'r') as snapshot:
+                data = json.load(snapshot)
+        state = {'snapshot': snapshot_signature, 'journal_inode': None, 'offset': 0, 'records': 0, 'data': data,
+                 'bytes': 0}
+    if journal_signature is None or journal_signature[2] == state['offset']:
+        return cache(snapshot_path, state)
+    records, consumed = read_records(snapshot_path, state['offset'])
+    for record in records:
+        apply_record(state['data'], record)
+    state['records'] += len(records)
+    state['offset'] += consumed
+    state['journal_inode'] = journal_signature[0]
+    return cache(snapshot_path, state)
+
+
+def read_records(snapshot_path, offset):
+    # The complete journal records from offset on, and the bytes they take.
+    with open(journal_path(snapshot_path), 'rb') as journal:
+        journal.seek(offset)
+        unread = journal.read()
+    consumed = unread.rfind(b'\n') + 1  # A trailing partial record is still being (or was never fully) written.
+    records = []
+    for line in unread[:consumed].splitlines():
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            continue  # Torn write from a crash; the rest of the journal is intact.
+    return records, consumed
+
+
+def cache(snapshot_path, state):
+    # Callers hold replay_lock(snapshot_path). Makes the state the most recently used one, accounted by its estimated
+    # size in memory, and drops the least recently used others while the cache holds more than MAX_CACHED_BYTES.
+    with CACHE_LOCK:
+        previous = REPLAY_STATES.pop(snapshot_path, None)
+        if previous is not None:
+            CACHED['bytes'] -= previous['bytes']
+        state['bytes'] = PARSED_SIZE_FACTOR * ((state['snapshot'][2] if state['snapshot'] is not None else 0)
+                                               + state['offset'])
+        REPLAY_STATES[snapshot_path] = state
+        CACHED['bytes'] += state['bytes']
+        while CACHED['bytes'] > MAX_CACHED_BYTES and len(REPLAY_STATES) > 1:
+            CACHED['bytes'] -= REPLAY_STATES.popitem(last=False)[1]['bytes']
+    return state
+
+
+def journal_continues(state, journal_signature):
+    # Is the journal on disk the one the state has read a prefix of?
+    if journal_signature is None:
+        return state['offset'] == 0
+    if state['journal_inode'] not in [None, journal_signature[0]]:
+        return False
+    return state['offset'] <= journal_signature[2]
+
+
+def apply_record(data, record):
+    if len(record) == 1:
+        data.pop(record[0], None)
+    else:
+        data[record[0]] = record[1]
+
+
+def load(snapshot_path):
+    with replay_lock(snapshot_path):
+        return dict(replay(snapshot_path)['data'])
+
+
+def load_entry(snapshot_path, key):
+    with replay_lock(snapshot_path):
+        return replay(snapshot_path)['data'].get(key)
+
+
+def log_size(snapshot_path):
+    with replay_lock(snapshot_path):
+        return len(replay(snapshot_path)['data'])
+
+
+def log_position(snapshot_path):
+    # Where the log currently ends, for records_since.
+    with replay_lock(snapshot_path):
+        state = replay(snapshot_path)
+        return state['snapshot'], state['journal_inode'], state['offset']
+
+
+def records_since(snapshot_path, position):
+    # The records appended to the log after log_position returned position, and the position after them; None when the
+    # log was compacted or replaced since, so the records in between are no longer in its journal.
+    snapshot_signature, journal_inode, offset = position
+    if file_signature(snapshot_path) != snapshot_signature:
+        return None
+    journal_signature = file_signature(journal_path(snapshot_path))
+    if not journal_continues({'journal_inode': journal_inode, 'offset': offset}, journal_signature):
+        return None
+    if journal_signature is None or journal_signature[2] == offset:
+        return [], position
+    records, consumed = read_records(snapshot_path, offset)
+    return records, (snapshot_signature, journal_signature[0], offset + consumed)
+
+
+def append(snapshot_path, updates: dict, removals=()):
+    records = b''.join(json.dumps([key, value]).encode('utf-8') + b'\n' for key, value in updates.items())
+    records += b''.join(json.dumps([key]).encode('utf-8') + b'\n' for key in removals)
+    with open(journal_path(snapshot_path), 'a+b') as journal:
+        journal.seek(0, os.SEEK_END)
+        if journal.tell() > 0:
+            journal.seek(-1, os.SEEK_END)
+            if journal.read(1) != b'\n':  # Terminate a torn record so it cannot swallow ours.
+                records = b'\n' + records
+        journal.write(records)
+        journal.flush()
+        if FSYNC_JOURNAL:
+            os.fsync(journal.fileno())
+    with replay_lock(snapshot_path):
+        records_in_journal = replay(snapshot_path)['records']  # Write-through; only reads back the records just appended.
+    if records_in_journal >= COMPACTION_THRESHOLD:
+        compact(snapshot_path)
+
+
+def compact(snapshot_path):
+    # Fold the journal into a new snapshot. Replaying a journal over a snapshot already containing it is harmless,
+    # so a crash between replacing the snapshot and truncating the journal loses nothing.
+    with replay_lock(snapshot_path):
+        data = replay(snapshot_path)['data']
+        temporary_path = str(snapshot_path) + '.tmp'
+        with open(temporary_path, 'w') as snapshot:
+            json.dump(data, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary_path, snapshot_path)
+        if os.path.isfile(journal_path(snapshot_path)):
+            with open(journal_path(snapshot_path), 'wb'):
+                pass
+        forget(snapshot_path)
+
+
+def forget(snapshot_path):
+    with CACHE_LOCK:
+        state = REPLAY_STATES.pop(snapshot_path, None)
+        if state is not None:
+            CACHED['bytes'] -= state['bytes']
+
+
+def migrate_all():
+    # Existing JSON logs already are valid snapshots; compacting them folds in any journal and normalises the files.
+    if not os.path.isdir(ADMIN_FOLDER):
+        return
+    for user_directory in os.listdir(ADMIN_FOLDER):
+        if not user_directory.startswith('USER'):
+            continue
+        for log_filename in [LIVE_FILES_LOG_FILENAME, ADDITIONAL_DATA_LOG_FILENAME, CHANGE_LOG_FILENAME,
+                             ARCHIVE_LOG_FILENAME]:
+            snapshot_path = os.path.join(ADMIN_FOLDER, user_directory, log_filename)
+            if log_exists(snapshot_path):
+                compact(snapshot_path)
+
+
+if __name__ == '__main__':
+    migrate_all()
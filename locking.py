@@ -0,0 +1,157 @@
+import collections
+import os
+import threading
+import time
+
+try:
+    import fcntl  # Only needed for INTER_PROCESS mode, which is unavailable where there is no flock (Windows).
+except ImportError:
+    fcntl = None
+
+import metrics
+from pathing import LOCK_FOLDER
+
+# Per-user locks over the metadata logs. Readers share a lock while writers hold it alone, locks are created
+# atomically on first use, and the locks of idle users are evicted least recently used first once more than
+# MAX_IDLE_LOCKS are kept. With INTER_PROCESS set each lock also takes a flock on admin/locks/<name>.lock, so worker
+# processes exclude each other the same way threads do, unless the registry only guards memory of its own process.
+# Locks over short-lived things flock a file of the thing itself instead (lock_path), so no lock file outlives it.
+MAX_IDLE_LOCKS = 1024
+INTER_PROCESS = False
+# Lock names are one of these kinds followed by a user's or a session's ID, which metrics must not reveal.
+LOCK_KINDS = ('LIVE', 'ADD', 'USAGE', 'SESSION', 'RANGES', 'CATALOG', 'INDEX', 'REPLAY', 'BLOBS')
+
+
+class ReadWriteLock:
+    # Any number of readers or one writer. Waiting writers keep new readers out, so writers are never starved.
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+
+    def release_write(self):
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+
+class LockRegistry:
+    def __init__(self, inter_process=True):
+        self.inter_process = inter_process  # False where INTER_PROCESS must not add flocks.
+        self.registry_lock = threading.Lock()
+        self.locks = collections.OrderedDict()  # name -> [ReadWriteLock, holders and waiters], least recent first
+        self.local = threading.local()  # The flock file descriptors this thread holds, per lock name.
+
+    def acquire(self, name, shared=False, lock_path=None):
+        # lock_path, if given, is flocked rather than a lock file; FileNotFoundError once it is gone.
+        start = time.perf_counter() if metrics.ENABLED else None
+        with self.registry_lock:
+            entry = self.locks.get(name)
+            if entry is None:
+                entry = self.locks[name] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            self.locks.move_to_end(name)
+        if shared:
+            entry[0].acquire_read()
+        else:
+            entry[0].acquire_write()
+        if INTER_PROCESS and self.inter_process:
+            try:
+                self.acquire_file_lock(name, shared, lock_path)
+            except BaseException:
+                with self.registry_lock:
+                    entry[1] -= 1
+                    if shared:
+                        entry[0].release_read()
+                    else:
+                        entry[0].release_write()
+                raise
+        if start is not None:
+            acquired = time.perf_counter()
+            metrics.observe(metrics.LOCK_WAIT_SECONDS, acquired - start, **lock_labels(name))
+            self.hold_starts().setdefault(name, []).append(acquired)
+
+    def release(self, name, shared=False):
+        if metrics.ENABLED and self.hold_starts().get(name):
+            metrics.observe(metrics.LOCK_HOLD_SECONDS, time.perf_counter() - self.hold_starts()[name].pop(),
+                            **lock_labels(name))
+        if INTER_PROCESS and self.inter_process:
+            self.release_file_lock(name)
+        with self.registry_lock:
+            entry = self.locks[name]
+            entry[1] -= 1
+            if shared:
+                entry[0].release_read()
+            else:
+                entry[0].release_write()
+            self.evict_idle()
+
+    def evict_idle(self):
+        # Callers hold registry_lock. An entry nobody holds or waits for can be dropped and recreated later.
+        idle = len(self.locks) - MAX_IDLE_LOCKS
+        if idle <= 0:
+            return
+        for name in list(self.locks.keys()):
+            if idle <= 0:
+                return
+            if self.locks[name][1] == 0:
+                del self.locks[name]
+                idle -= 1
+
+    def acquire_file_lock(self, name, shared, lock_path=None):
+        if fcntl is None:
+            raise Exception("Inter-process locking needs fcntl, which this platform does not have.")
+        if lock_path is None:
+            os.makedirs(LOCK_FOLDER, exist_ok=True)
+            lock_file = os.open(os.path.join(LOCK_FOLDER, name + '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        else:
+            lock_file = os.open(lock_path, os.O_RDONLY)  # Never created here.
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self.file_locks().setdefault(name, []).append(lock_file)
+
+    def release_file_lock(self, name):
+        lock_file = self.file_locks()[name].pop()
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        os.close(lock_file)
+
+    def file_locks(self):
+        if not hasattr(self.local, 'file_locks'):
+            self.local.file_locks = {}
+        return self.local.file_locks
+
+    def hold_starts(self):
+        # When this thread acquired each lock it holds, while metrics are enabled.
+        if not hasattr(self.local, 'hold_starts'):
+            self.local.hold_starts = {}
+        return self.local.hold_starts
+
+
+def lock_labels(name):
+    for kind in LOCK_KINDS:
+        if name.startswith(kind):
+            return {'lock': kind}
+    return {'lock': 'other'}
+
+
+USER_LOCKS = LockRegistry()
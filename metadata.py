@@ -0,0 +1,599 @@
+from __future__ import annotations  # userhandling and metadata import each other.
+
+import bisect
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import filehandling
+import journaling
+import locking
+import userhandling
+from pathing import USER_CATALOG, METADATA_DATABASE
+
+# Where the users, the additional data of every version and the liveness of every file are kept. The JSON text logs
+# are the default; SQLite can be chosen with use_backend('sqlite') before the app starts serving.
+METADATA_BACKENDS = {}  # dict[name->backend class]
+ACTIVE_BACKEND = []  # [backend], set lazily so the default costs nothing to import.
+
+
+def backend():
+    if not ACTIVE_BACKEND:
+        ACTIVE_BACKEND.append(JsonMetadataBackend())
+    return ACTIVE_BACKEND[0]
+
+
+def use_backend(name, *args):
+    if name not in METADATA_BACKENDS:
+        raise Exception("No metadata backend named " + str(name) + ".")
+    ACTIVE_BACKEND[:] = [METADATA_BACKENDS[name](*args)]
+    return ACTIVE_BACKEND[0]
+
+
+class JsonMetadataBackend:
+    # users.txt, and per user LIVE_FILES.txt, ADD_DATA_LOG.txt and USAGE.txt (journaled), guarded by the user locks.
+    # Versions are found from the upload directory, indexed in memory per user. With inter-process locking on, each
+    # index remembers the signature of the additional data log it is in sync with and the position in it it has read
+    # up to; once another process has written the log, the records appended since are applied to the index, which is
+    # only rebuilt when the log was compacted meanwhile. Each user's index has its own lock, and is built without it.
+    def __init__(self):
+        self.user_catalog_cache = {'signature': None, 'users': {}}  # Parsed catalog and the signature it was read at.
+        # dict[userID->{'versions': dict[name->list[(timestamp, index, server_side_name)]], sorted,
+        #               'signature': add_data_log_signature, 'position': journaling.log_position}]
+        self.version_indexes = {}
+        self.version_index_locks = locking.LockRegistry(inter_process=False)  # 'INDEX' + userID, 'INDEXBUILD' + userID
+
+    # Users
+    def load_user_catalog(self):
+        # One stat per call; the catalog is only parsed again once it has been replaced on disk, maybe by another process.
+        signature = journaling.file_signature(USER_CATALOG)
+        if signature is None:
+            return {}
+        if self.user_catalog_cache['signature'] != signature:
+            with open(USER_CATALOG, 'r') as catalog:
+                users = json.load(catalog)
+            self.user_catalog_cache.update({'signature': signature, 'users': users})
+        return self.user_catalog_cache['users']
+
+    def write_user_catalog(self, users: dict):
+        # Written to the side and renamed into place, so readers never see a half-written catalog and the new inode
+        # invalidates every process's cache.
+        temporary_path = str(USER_CATALOG) + '.tmp'
+        with open(temporary_path, 'w') as catalog:
+            json.dump(users, catalog)
+        os.replace(temporary_path, USER_CATALOG)
+        self.user_catalog_cache.update({'signature': journaling.file_signature(USER_CATALOG), 'users': users})
+
+    def user_exists(self, userID):
+        return userID in self.load_user_catalog()
+
+    def users(self):
+        return sorted(set(self.load_user_catalog().values()))
+
+    def register_user(self, userID):
+        locking.USER_LOCKS.acquire('CATALOG')  # Held while the catalog is read, modified and written back.
+        users = dict(self.load_user_catalog())
+        users[userID] = userID
+        self.write_user_catalog(users)
+        locking.USER_LOCKS.release('CATALOG')
+
+    def unregister_user(self, userID):
+        locking.USER_LOCKS.acquire('CATALOG')
+        users: dict = dict(self.load_user_catalog())
+        keysToPop = []
+        for key in users.keys():  # For each key make sure it doesn't point at the user we're deleting, ...
+            if users[key] == userID or users[key] not in users.keys():  # ... or at something not contained...
+                keysToPop.append(key)  # ... as these are all aliases of our user.
+        for key in keysToPop:
+            users.pop(key)
+        self.write_user_catalog(users)
+        locking.USER_LOCKS.release('CATALOG')
+
+    def forget(self, user: userhandling.UserMethodPack):
+        self.version_index_locks.acquire('INDEX' + user.userID)
+        self.version_indexes.pop(user.userID, None)
+        self.version_index_locks.release('INDEX' + user.userID)
+        journaling.forget(user.live_files_log_path())
+        journaling.forget(user.add_data_log_path())
+        journaling.forget(user.change_log_path())
+        journaling.forget(user.archive_log_path())
+        journaling.forget(user.usage_log_path())
+
+    def compact(self, user: userhandling.UserMethodPack):
+        user.acquire_live_files_log_lock()
+        for log_path in [user.live_files_log_path(), user.archive_log_path(), user.change_log_path()]:
+            if journaling.has_journal(log_path):
+                journaling.compact(log_path)
+        user.release_live_files_log_lock()
+        user.acquire_additional_data_log_lock()
+        if journaling.has_journal(user.add_data_log_path()):
+            self.write_additional_data_log(lambda: journaling.compact(user.add_data_log_path()), user)
+        user.release_additional_data_log_lock()
+
+    # Liveness
+    def liveness(self, user: userhandling.UserMethodPack):
+        user.acquire_live_files_log_lock(shared=True)
+        data = journaling.load(user.live_files_log_path())
+        user.release_live_files_log_lock(shared=True)
+        return data
+
+    def mark_files_as_live(self, filenames, user: userhandling.UserMethodPack):
+        user.acquire_live_files_log_lock()
+        updates = {filename: True for filename in filenames
+                   if journaling.load_entry(user.live_files_log_path(), filename) is not True}  # Re-uploads need none.
+        if updates:
+            journaling.append(user.live_files_log_path(), updates)
+            self.unmark_archived(updates.keys(), user)
+        self.record_changes(filenames, user)  # But they are changes all the same.
+        user.release_live_files_log_lock()
+
+    def set_file_liveness(self, filename, set_to, user: userhandling.UserMethodPack):
+        user.acquire_live_files_log_lock()
+        # Does the log contain the name?
+        if journaling.load_entry(user.live_files_log_path(), filename) is None:
+            user.release_live_files_log_lock()
+            return False
+        journaling.append(user.live_files_log_path(), {filename: set_to})
+        if set_to:
+            self.unmark_archived([filename], user)
+        else:
+            journaling.append(user.archive_log_path(), {filename: time.time()})
+        self.record_changes([filename], user)
+        user.release_live_files_log_lock()
+        return True
+
+    def unmark_archived(self, filenames, user: userhandling.UserMethodPack):
+        # Callers hold the live files log lock.
+        removals = [filename for filename in filenames
+                    if journaling.load_entry(user.archive_log_path(), filename) is not None]
+        if removals:
+            journaling.append(user.archive_log_path(), {}, removals)
+
+    def archived_files(self, user: userhandling.UserMethodPack):
+        # Archived filename -> when it was archived.
+        user.acquire_live_files_log_lock(shared=True)
+        data = journaling.load(user.archive_log_path())
+        user.release_live_files_log_lock(shared=True)
+        return data
+
+    def purge_file(self, filename, archived_before, user: userhandling.UserMethodPack):
+        # Forgets an archived file, unless it was resurrected or archived again after 'archived_before'.
+        user.acquire_live_files_log_lock()
+        archived_at = journaling.load_entry(user.archive_log_path(), filename)
+        if archived_at is None or archived_at > archived_before \
+                or journaling.load_entry(user.live_files_log_path(), filename) is not False:
+            user.release_live_files_log_lock()
+            return False
+        journaling.append(user.live_files_log_path(), {}, [filename])
+        journaling.append(user.archive_log_path(), {}, [filename])
+        user.release_live_files_log_lock()
+        return True
+
+    # Change feed
+    def record_changes(self, filenames, user: userhandling.UserMethodPack):
+        # Callers hold the live files log lock, which orders the sequence numbers.
+        cursor = journaling.log_size(user.change_log_path())
+        changes = {str(cursor + offset + 1): filename for offset, filename in enumerate(filenames)}
+        if changes:
+            journaling.append(user.change_log_path(), changes)
+
+    def change_cursor(self, user: userhandling.UserMethodPack):
+        user.acquire_live_files_log_lock(shared=True)
+        cursor = journaling.log_size(user.change_log_path())
+        user.release_live_files_log_lock(shared=True)
+        return cursor
+
+    def changes_since(self, cursor, user: userhandling.UserMethodPack):
+        # The sequence numbers are 1..cursor, so only the entries after the client's cursor are looked at.
+        user.acquire_live_files_log_lock(shared=True)
+        latest_cursor = journaling.log_size(user.change_log_path())
+        filenames = [journaling.load_entry(user.change_log_path(), str(sequence_number))
+                     for sequence_number in range(max(cursor, 0) + 1, latest_cursor + 1)]
+        liveness = {filename: journaling.load_entry(user.live_files_log_path(), filename) for filename in filenames}
+        user.release_live_files_log_lock(shared=True)
+        return latest_cursor, liveness
+
+    # Versions and their additional data
+    def store_additional_data(self, entries: dict, user: userhandling.UserMethodPack):
+        self.append_additional_data(entries, (), user)
+        for server_side_name in entries:
+            self.register_version(server_side_name, user)
+
+    def delete_versions(self, server_side_names, user: userhandling.UserMethodPack):
+        with self.version_index(user) as index:
+            for server_side_name in server_side_names:
+                remove_from_index(index, server_side_name)
+        self.append_additional_data({}, server_side_names, user)
+
+    def append_additional_data(self, entries: dict, removals, user: userhandling.UserMethodPack):
+        user.acquire_additional_data_log_lock()
+        self.write_additional_data_log(lambda: journaling.append(user.add_data_log_path(), entries, removals), user)
+        user.release_additional_data_log_lock()
+
+    def write_additional_data_log(self, write, user: userhandling.UserMethodPack):
+        # Callers hold the additional data log lock. An index in sync with the log before our own write stays in sync
+        # after it; the write's changes are made to the index by the caller.
+        self.version_index_locks.acquire('INDEX' + user.userID)
+        entry = self.version_indexes.get(user.userID)
+        in_sync = entry is not None and entry['signature'] == self.add_data_log_signature(user)
+        self.version_index_locks.release('INDEX' + user.userID)
+        write()
+        if in_sync:
+            self.version_index_locks.acquire('INDEX' + user.userID)
+            if self.version_indexes.get(user.userID) is entry:
+                entry['signature'] = self.add_data_log_signature(user)
+                entry['position'] = journaling.log_position(user.add_data_log_path())  # After the signature.
+            self.version_index_locks.release('INDEX' + user.userID)
+
+    def add_data_log_signature(self, user: userhandling.UserMethodPack):
+        log_path = user.add_data_log_path()
+        return journaling.file_signature(log_path), journaling.file_signature(journaling.journal_path(log_path))
+
+    def versions(self, user: userhandling.UserMethodPack):
+        # Name -> the server side names of all its versions, oldest first.
+        with self.version_index(user) as index:
+            return {name: [version[2] for version in versions] for name, versions in index.items()}
+
+    def additional_data(self, server_side_name, user: userhandling.UserMethodPack):
+        user.acquire_additional_data_log_lock(shared=True)
+        additional_data = journaling.load_entry(user.add_data_log_path(), server_side_name)
+        user.release_additional_data_log_lock(shared=True)
+        return additional_data
+
+    def additional_data_log(self, user: userhandling.UserMethodPack):
+        user.acquire_additional_data_log_lock(shared=True)
+        data = journaling.load(user.add_data_log_path())
+        user.release_additional_data_log_lock(shared=True)
+        return data
+
+    def latest_version(self, filename, user: userhandling.UserMethodPack):
+        with self.version_index(user) as index:
+            versions = index.get(filename.split('.')[0])
+            if not versions:
+                return None
+            return versions[-1][2]
+
+    def latest_versions(self, user: userhandling.UserMethodPack):
+        with self.version_index(user) as index:
+            return {name: versions[-1][2] for name, versions in index.items() if versions}
+
+    def live_files(self, user: userhandling.UserMethodPack):
+        # Read the upload dir and the additional data log once rather than once per live file.
+        data = self.liveness(user)
+        latest_versions = self.latest_versions(user)
+        additional_data_log = self.additional_data_log(user)
+        live_files = []
+        for name, isLive in data.items():
+            if isLive:
+                add_dat = additional_data_log.get(latest_versions.get(name.split('.')[0]))
+                if add_dat is None:  # Live, but no version (or its additional data) is stored.
+                    continue
+                live_files.append([name, add_dat['nonce1'], add_dat["t"]])
+        return live_files
+
+    # Usage
+    def usage(self, user: userhandling.UserMethodPack):
+        # {'bytes', 'files'} of the versions stored, or None until they have been counted; see quotas.py.
+        user.acquire_usage_log_lock(shared=True)
+        usage = journaling.load(user.usage_log_path())
+        user.release_usage_log_lock(shared=True)
+        return usage or None
+
+    def add_usage(self, added_bytes, added_files, user: userhandling.UserMethodPack):
+        # Nothing to add to until the usage has been counted; counting it will include these.
+        user.acquire_usage_log_lock()
+        usage = journaling.load(user.usage_log_path())
+        if usage:
+            journaling.append(user.usage_log_path(), {'bytes': usage['bytes'] + added_bytes,
+                                                      'files': usage['files'] + added_files})
+        user.release_usage_log_lock()
+
+    def set_usage(self, usage: dict, user: userhandling.UserMethodPack):
+        filehandling.prepare_admin_directory(user)
+        user.acquire_usage_log_lock()
+        journaling.append(user.usage_log_path(), {'bytes': usage['bytes'], 'files': usage['files']})
+        user.release_usage_log_lock()
+
+    @contextlib.contextmanager
+    def version_index(self, user: userhandling.UserMethodPack):
+        # Yields the user's index while holding its lock. The index is built from the stored versions on first access,
+        # without the lock and once at a time, then caught up with the records written to the log meanwhile and
+        # installed.
+        while True:
+            self.version_index_locks.acquire('INDEX' + user.userID)
+            entry = self.version_indexes.get(user.userID)
+            if entry is not None and (not locking.INTER_PROCESS or self.catch_up(entry, user)):
+                break
+            self.version_indexes.pop(user.userID, None)
+            self.version_index_locks.release('INDEX' + user.userID)
+            self.version_index_locks.acquire('INDEXBUILD' + user.userID)
+            if user.userID not in self.version_indexes:  # Not installed by the build this one waited for.
+                entry = self.build_version_index(user)
+                self.version_index_locks.acquire('INDEX' + user.userID)
+                if user.userID not in self.version_indexes and self.catch_up(entry, user):
+                    self.version_indexes[user.userID] = entry
+                self.version_index_locks.release('INDEX' + user.userID)
+            self.version_index_locks.release('INDEXBUILD' + user.userID)
+        try:
+            yield entry['versions']
+        finally:
+            self.version_index_locks.release('INDEX' + user.userID)
+
+    def build_version_index(self, user: userhandling.UserMethodPack):
+        # The signature before the position and both before the scan, so a write made meanwhile is read again.
+        entry = {'signature': self.add_data_log_signature(user), 'versions': {}}
+        entry['position'] = journaling.log_position(user.add_data_log_path())
+        for server_side_name, path in filehandling.stored_versions(user):
+            name, file_timestamp, file_index = filehandling.split_server_side_name(server_side_name)
+            entry['versions'].setdefault(name, []).append((file_timestamp, file_index, server_side_name))
+        for versions in entry['versions'].values():
+            versions.sort()
+        return entry
+
+    def catch_up(self, entry, user: userhandling.UserMethodPack):
+        # Callers hold the user's index lock, or are the only ones to know the entry. Applies the records appended to the additional data log since the
+        # index last read it; False when they are gone from the log because it was compacted meanwhile.
+        signature = self.add_data_log_signature(user)
+        if entry['signature'] == signature:
+            return True
+        records = journaling.records_since(user.add_data_log_path(), entry['position'])
+        if records is None:
+            return False
+        records, entry['position'] = records
+        for record in records:
+            if len(record) == 1:
+                remove_from_index(entry['versions'], record[0])
+            else:
+                add_to_index(entry['versions'], record[0])
+        entry['signature'] = signature
+        return True
+
+    def register_version(self, server_side_name, user: userhandling.UserMethodPack):
+        self.version_index_locks.acquire('INDEX' + user.userID)
+        entry = self.version_indexes.get(user.userID)
+        if entry is not None:  # Otherwise it is not built yet; it will pick the version up once it is.
+            add_to_index(entry['versions'], server_side_name)
+        self.version_index_locks.release('INDEX' + user.userID)
+
+
+def add_to_index(index, server_side_name):
+    split_name = filehandling.split_server_side_name(server_side_name)
+    if split_name is None:
+        return
+    name, file_timestamp, file_index = split_name
+    versions = index.setdefault(name, [])
+    version = (file_timestamp, file_index, server_side_name)
+    position = bisect.bisect_left(versions, version)
+    if position == len(versions) or versions[position] != version:
+        versions.insert(position, version)
+
+
+def remove_from_index(index, server_side_name):
+    split_name = filehandling.split_server_side_name(server_side_name)
+    if split_name is None:
+        return
+    versions = index.get(split_name[0], [])
+    if split_name[1:] + (server_side_name,) in versions:
+        versions.remove(split_name[1:] + (server_side_name,))
+    if not versions:
+        index.pop(split_name[0], None)
+
+
+METADATA_BACKENDS['json'] = JsonMetadataBackend
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (alias TEXT PRIMARY KEY, user_id TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS users_by_user_id ON users (user_id);
+CREATE TABLE IF NOT EXISTS versions (
+    user_id TEXT NOT NULL, server_side_name TEXT NOT NULL, name TEXT NOT NULL,
+    timestamp REAL NOT NULL, idx INTEGER NOT NULL, additional_data TEXT NOT NULL,
+    PRIMARY KEY (user_id, server_side_name));
+CREATE INDEX IF NOT EXISTS versions_by_age ON versions (user_id, name, timestamp, idx);
+CREATE TABLE IF NOT EXISTS liveness (
+    user_id TEXT NOT NULL, filename TEXT NOT NULL, is_live INTEGER NOT NULL, archived_at REAL,
+    PRIMARY KEY (user_id, filename));
+CREATE TABLE IF NOT EXISTS changes (
+    user_id TEXT NOT NULL, sequence_number INTEGER NOT NULL, filename TEXT NOT NULL,
+    PRIMARY KEY (user_id, sequence_number));
+CREATE TABLE IF NOT EXISTS usage (user_id TEXT PRIMARY KEY, bytes INTEGER NOT NULL, files INTEGER NOT NULL);
+"""
+LATEST_VERSION_QUERY = """
+SELECT server_side_name FROM versions WHERE user_id = ? AND name = ? ORDER BY timestamp DESC, idx DESC LIMIT 1
+"""
+LATEST_VERSIONS_QUERY = """
+SELECT names.name, (SELECT server_side_name FROM versions
+                    WHERE user_id = names.user_id AND name = names.name ORDER BY timestamp DESC, idx DESC LIMIT 1)
+FROM (SELECT DISTINCT user_id, name FROM versions WHERE user_id = ?) AS names
+"""
+LIVE_FILES_QUERY = """
+SELECT liveness.filename, (SELECT additional_data FROM versions
+                           WHERE user_id = liveness.user_id
+                             AND name = substr(liveness.filename, 1, instr(liveness.filename, '.') - 1)
+                           ORDER BY timestamp DESC, idx DESC LIMIT 1)
+FROM liveness WHERE user_id = ? AND is_live = 1
+"""
+
+CHANGES_SINCE_QUERY = """
+SELECT changes.sequence_number, changes.filename, liveness.is_live
+FROM changes LEFT JOIN liveness ON liveness.user_id = changes.user_id AND liveness.filename = changes.filename
+WHERE changes.user_id = ? AND changes.sequence_number > ? ORDER BY changes.sequence_number
+"""
+
+
+class SqliteMetadataBackend:
+    # One database in WAL mode for all users; every worker process and thread can read and write it concurrently.
+    def __init__(self, database_path=METADATA_DATABASE):
+        self.database_path = str(database_path)
+        self.local = threading.local()  # A connection per thread; sqlite3 connections must not be shared.
+        with self.connection() as connection:
+            connection.executescript(SQLITE_SCHEMA)
+
+    def connection(self):
+        # A connection opened before a fork belongs to the parent; the worker opens its own.
+        if getattr(self.local, 'connection', None) is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    # Users
+    def user_exists(self, userID):
+        return self.connection().execute('SELECT 1 FROM users WHERE alias = ?', (userID,)).fetchone() is not None
+
+    def users(self):
+        return [row[0] for row in self.connection().execute('SELECT DISTINCT user_id FROM users ORDER BY user_id')]
+
+    def register_user(self, userID):
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO users (alias, user_id) VALUES (?, ?)', (userID, userID))
+
+    def unregister_user(self, userID):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM users WHERE alias = ? OR user_id = ?', (userID, userID))
+
+    def forget(self, user: userhandling.UserMethodPack):
+        pass  # Nothing is cached outside the database.
+
+    def compact(self, user: userhandling.UserMethodPack):
+        pass  # Deleted rows are reused by SQLite.
+
+    # Liveness
+    def liveness(self, user: userhandling.UserMethodPack):
+        rows = self.connection().execute('SELECT filename, is_live FROM liveness WHERE user_id = ?', (user.userID,))
+        return {filename: bool(is_live) for filename, is_live in rows}
+
+    def mark_files_as_live(self, filenames, user: userhandling.UserMethodPack):
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')  # Sequence numbers are handed out under the write lock.
+            connection.executemany('INSERT OR REPLACE INTO liveness (user_id, filename, is_live) VALUES (?, ?, 1)',
+                                   [(user.userID, filename) for filename in filenames])
+            self.record_changes(connection, filenames, user)
+
+    def set_file_liveness(self, filename, set_to, user: userhandling.UserMethodPack):
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            cursor = connection.execute('UPDATE liveness SET is_live = ?, archived_at = ? '
+                                        'WHERE user_id = ? AND filename = ?',
+                                        (int(set_to), None if set_to else time.time(), user.userID, filename))
+            if cursor.rowcount != 1:
+                return False
+            self.record_changes(connection, [filename], user)
+            return True
+
+    def archived_files(self, user: userhandling.UserMethodPack):
+        return dict(self.connection().execute('SELECT filename, archived_at FROM liveness '
+                                              'WHERE user_id = ? AND is_live = 0', (user.userID,)))
+
+    def purge_file(self, filename, archived_before, user: userhandling.UserMethodPack):
+        with self.connection() as connection:
+            cursor = connection.execute('DELETE FROM liveness WHERE user_id = ? AND filename = ? '
+                                        'AND is_live = 0 AND archived_at <= ?', (user.userID, filename, archived_before))
+            return cursor.rowcount == 1
+
+    # Change feed
+    def record_changes(self, connection, filenames, user: userhandling.UserMethodPack):
+        cursor = connection.execute('SELECT COALESCE(MAX(sequence_number), 0) FROM changes WHERE user_id = ?',
+                                    (user.userID,)).fetchone()[0]
+        connection.executemany('INSERT INTO changes (user_id, sequence_number, filename) VALUES (?, ?, ?)',
+                               [(user.userID, cursor + offset + 1, filename) for offset, filename in enumerate(filenames)])
+
+    def change_cursor(self, user: userhandling.UserMethodPack):
+        return self.connection().execute('SELECT COALESCE(MAX(sequence_number), 0) FROM changes WHERE user_id = ?',
+                                         (user.userID,)).fetchone()[0]
+
+    def changes_since(self, cursor, user: userhandling.UserMethodPack):
+        rows = self.connection().execute(CHANGES_SINCE_QUERY, (user.userID, cursor)).fetchall()
+        latest_cursor = rows[-1][0] if rows else cursor
+        return latest_cursor, {filename: None if is_live is None else bool(is_live) for _, filename, is_live in rows}
+
+    # Versions and their additional data
+    def store_additional_data(self, entries: dict, user: userhandling.UserMethodPack):
+        rows = []
+        for server_side_name, additional_data in entries.items():
+            name, file_timestamp, file_index = filehandling.split_server_side_name(server_side_name)
+            rows.append((user.userID, server_side_name, name, file_timestamp, file_index, json.dumps(additional_data)))
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO versions '
+                                   '(user_id, server_side_name, name, timestamp, idx, additional_data) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def delete_versions(self, server_side_names, user: userhandling.UserMethodPack):
+        with self.connection() as connection:
+            connection.executemany('DELETE FROM versions WHERE user_id = ? AND server_side_name = ?',
+                                   [(user.userID, server_side_name) for server_side_name in server_side_names])
+
+    def versions(self, user: userhandling.UserMethodPack):
+        versions = {}
+        for name, server_side_name in self.connection().execute('SELECT name, server_side_name FROM versions '
+                                                                'WHERE user_id = ? ORDER BY name, timestamp, idx',
+                                                                (user.userID,)):
+            versions.setdefault(name, []).append(server_side_name)
+        return versions
+
+    def additional_data(self, server_side_name, user: userhandling.UserMethodPack):
+        row = self.connection().execute('SELECT additional_data FROM versions WHERE user_id = ? AND server_side_name = ?',
+                                        (user.userID, server_side_name)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def additional_data_log(self, user: userhandling.UserMethodPack):
+        rows = self.connection().execute('SELECT server_side_name, additional_data FROM versions WHERE user_id = ?',
+                                         (user.userID,))
+        return {server_side_name: json.loads(additional_data) for server_side_name, additional_data in rows}
+
+    def latest_version(self, filename, user: userhandling.UserMethodPack):
+        row = self.connection().execute(LATEST_VERSION_QUERY, (user.userID, filename.split('.')[0])).fetchone()
+        return None if row is None else row[0]
+
+    def latest_versions(self, user: userhandling.UserMethodPack):
+        return dict(self.connection().execute(LATEST_VERSIONS_QUERY, (user.userID,)))
+
+    def live_files(self, user: userhandling.UserMethodPack):
+        live_files = []
+        for name, additional_data in self.connection().execute(LIVE_FILES_QUERY, (user.userID,)):
+            if additional_data is None:  # Live, but no version is stored.
+                continue
+            add_dat = json.loads(additional_data)
+            live_files.append([name, add_dat['nonce1'], add_dat["t"]])
+        return live_files
+
+    # Usage
+    def usage(self, user: userhandling.UserMethodPack):
+        row = self.connection().execute('SELECT bytes, files FROM usage WHERE user_id = ?', (user.userID,)).fetchone()
+        return None if row is None else {'bytes': row[0], 'files': row[1]}
+
+    def add_usage(self, added_bytes, added_files, user: userhandling.UserMethodPack):
+        with self.connection() as connection:  # No row until the usage has been counted.
+            connection.execute('UPDATE usage SET bytes = bytes + ?, files = files + ? WHERE user_id = ?',
+                               (added_bytes, added_files, user.userID))
+
+    def set_usage(self, usage: dict, user: userhandling.UserMethodPack):
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO usage (user_id, bytes, files) VALUES (?, ?, ?)',
+                               (user.userID, usage['bytes'], usage['files']))
+
+
+METADATA_BACKENDS['sqlite'] = SqliteMetadataBackend
+
+
+def copy_metadata(source, destination):
+    # Copies every registered user's metadata from one backend to another, e.g. JSON -> SQLite.
+    for userID in set(source.load_user_catalog().values()):
+        user = userhandling.UserMethodPack(userID)
+        destination.register_user(userID)
+        liveness = source.liveness(user)
+        destination.mark_files_as_live(list(liveness.keys()), user)
+        for filename, is_live in liveness.items():
+            if not is_live:
+                destination.set_file_liveness(filename, False, user)
+        destination.store_additional_data(source.additional_data_log(user), user)
+        usage = source.usage(user)
+        if usage is not None:
+            destination.set_usage(usage, user)
+
+if __name__ == '__main__':
+    copy_metadata(JsonMetadataBackend(), SqliteMetadataBackend())
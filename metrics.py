@@ -0,0 +1,97 @@
+import bisect
+import functools
+import threading
+import time
+
+# In-process histograms of how long requests and their stages take, and counters of bytes moved, exposed in the
+# Prometheus text format on /metrics. Nothing is recorded unless ENABLED is set (app.create_app sets it from the
+# METRICS config); then timed functions cost one flag check. Each worker process of serve.py keeps its own metrics.
+ENABLED = False
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Upper bounds, seconds
+HISTOGRAMS = {}  # dict[(name, labels)->{'buckets': [count per bucket, the last for +Inf], 'sum', 'count'}]
+COUNTERS = {}  # dict[(name, labels)->value]
+METRICS_LOCK = threading.Lock()
+REQUEST_SECONDS = 'cloudio_request_seconds'
+STAGE_SECONDS = 'cloudio_stage_seconds'
+LOCK_WAIT_SECONDS = 'cloudio_lock_wait_seconds'
+LOCK_HOLD_SECONDS = 'cloudio_lock_hold_seconds'
+BYTES_READ = 'cloudio_bytes_read_total'
+BYTES_WRITTEN = 'cloudio_bytes_written_total'
+
+
+def observe(name, seconds, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[key] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def count(name, amount, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+
+def timed(stage):
+    # Decorator: the function's duration is observed as the given stage.
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage)
+        return timed_function
+    return decorate
+
+
+def reset():
+    with METRICS_LOCK:
+        HISTOGRAMS.clear()
+        COUNTERS.clear()
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+    return '{' + ','.join(key + '="' + value + '"' for key, value in escaped) + '}'
+
+
+def exposition():
+    # The Prometheus text format; histogram buckets are cumulative there.
+    with METRICS_LOCK:
+        histograms = {key: {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+                      for key, value in HISTOGRAMS.items()}
+        counters = dict(COUNTERS)
+    lines = []
+    for name in sorted(set(key[0] for key in histograms)):
+        lines.append('# TYPE ' + name + ' histogram')
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(list(BUCKETS) + ['+Inf'], histogram['buckets']):
+                cumulative += bucket
+                lines.append(name + '_bucket' + format_labels(labels, [('le', bound)]) + ' ' + str(cumulative))
+            lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(histogram['sum']))
+            lines.append(name + '_count' + format_labels(labels) + ' ' + str(histogram['count']))
+    for name in sorted(set(key[0] for key in counters)):
+        lines.append('# TYPE ' + name + ' counter')
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(name + format_labels(labels) + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
@@ -1,4 +1,12 @@
+import atexit
+import datetime
+import json
+import os
 import pathlib as pl
+import queue
+import threading
+
+import flask
 PROJECT_NAME = "CloudIOServer"
 
 
@@ -16,16 +24,96 @@ WORK_DIR = get_CloudIOServer_path()
 RESOURCE_DIR = pl.Path.joinpath(WORK_DIR, 'resources')
 UPLOAD_FOLDER = pl.Path.joinpath(WORK_DIR, 'uploads')
 ADMIN_FOLDER = pl.Path.joinpath(WORK_DIR, 'admin')
+BLOB_FOLDER = pl.Path.joinpath(WORK_DIR, 'blobs')  # Deduplicated content of the uploads; see blobstore.py.
+SESSION_FOLDER = pl.Path.joinpath(WORK_DIR, 'sessions')  # Resumable uploads in progress; see uploadsessions.py.
 ERROR_LOG = pl.Path.joinpath(ADMIN_FOLDER, 'error_log.txt')
 USER_CATALOG = pl.Path.joinpath(ADMIN_FOLDER, 'users.txt')
+METADATA_DATABASE = pl.Path.joinpath(ADMIN_FOLDER, 'metadata.sqlite3')  # Used by the SQLite metadata backend.
+LOCK_FOLDER = pl.Path.joinpath(ADMIN_FOLDER, 'locks')  # Lock files, when locking across processes.
+PROFILE_FOLDER = pl.Path.joinpath(ADMIN_FOLDER, 'profiles')  # Written by profiler.py.
+
 
+ERROR_LOG_QUEUE_SIZE = 10000  # Records waiting for the writer; beyond this they are dropped rather than blocking.
+ERROR_LOG_BATCH_SIZE = 500  # Records written per flush at most.
+ERROR_LOG_MAX_BYTES = 16 * 1024 * 1024  # The log is rotated to error_log.txt.1 (.2, ...) once it grows past this.
+ERROR_LOG_BACKUPS = 5
+ERROR_LOG_WRITER = {'queue': None, 'thread': None, 'pid': None, 'dropped': 0}
+ERROR_LOG_WRITER_LOCK = threading.Lock()
 
-def write_to_error_log(s):  # We're imperfect beings and our code may reflect this. Log your errors.
+
+def write_to_error_log(s, userID=None, endpoint=None):  # We're imperfect beings and our code may reflect this. Log your errors.
+    # Queued for a background writer so request threads never wait on the disk.
     if type(s) is not str:
         s = str(s)
-    with open(ERROR_LOG, 'a') as error_log_file:
-        error_log_file.write('\n' + s)  # Write to the error log
+    if userID is None or endpoint is None:
+        request_userID, request_endpoint = describe_current_request()
+        userID = request_userID if userID is None else userID
+        endpoint = request_endpoint if endpoint is None else endpoint
+    record = {'time': datetime.datetime.now().isoformat(), 'userID': userID, 'endpoint': endpoint, 'message': s}
+    try:
+        error_log_queue().put_nowait(record)
+    except queue.Full:
+        ERROR_LOG_WRITER['dropped'] += 1
+
+
+def describe_current_request():
+    if not flask.has_request_context():
+        return None, None
+    return (flask.request.view_args or {}).get('userID'), flask.request.path
+
+
+def error_log_queue():
+    # The writer is started on first use, and again in a forked worker process, which does not inherit threads.
+    if ERROR_LOG_WRITER['pid'] != os.getpid():
+        with ERROR_LOG_WRITER_LOCK:
+            if ERROR_LOG_WRITER['pid'] != os.getpid():
+                ERROR_LOG_WRITER['queue'] = queue.Queue(ERROR_LOG_QUEUE_SIZE)
+                ERROR_LOG_WRITER['thread'] = threading.Thread(target=error_log_writer, args=(ERROR_LOG_WRITER['queue'],),
+                                                              name='error-log-writer', daemon=True)
+                ERROR_LOG_WRITER['thread'].start()
+                ERROR_LOG_WRITER['pid'] = os.getpid()
+    return ERROR_LOG_WRITER['queue']
+
+
+def error_log_writer(record_queue: queue.Queue):
+    while True:
+        records = [record_queue.get()]
+        while len(records) < ERROR_LOG_BATCH_SIZE:
+            try:
+                records.append(record_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            rotate_error_log()
+            with open(ERROR_LOG, 'a') as error_log_file:
+                error_log_file.write(''.join('\n' + json.dumps(record) for record in records))  # Write to the error log
+        except OSError:
+            pass  # Nowhere to log that logging failed, e.g. before the admin folder exists.
+        for _ in records:
+            record_queue.task_done()
+
+
+def rotate_error_log():
+    if not os.path.isfile(ERROR_LOG) or os.path.getsize(ERROR_LOG) < ERROR_LOG_MAX_BYTES:
+        return
+    for backup in range(ERROR_LOG_BACKUPS - 1, 0, -1):
+        if os.path.isfile(str(ERROR_LOG) + '.' + str(backup)):
+            os.replace(str(ERROR_LOG) + '.' + str(backup), str(ERROR_LOG) + '.' + str(backup + 1))
+    os.replace(ERROR_LOG, str(ERROR_LOG) + '.1')
+
+
+def flush_error_log():
+    # Waits until every record queued so far has been written.
+    if ERROR_LOG_WRITER['pid'] == os.getpid():
+        ERROR_LOG_WRITER['queue'].join()
+
+
+atexit.register(flush_error_log)
 
 
 LIVE_FILES_LOG_FILENAME = 'LIVE_FILES.txt'  # dict[name->bool(isLive)]
 ADDITIONAL_DATA_LOG_FILENAME = 'ADD_DATA_LOG.txt'  # dict[avail_name->(filename, timestamp)]
+ARCHIVE_LOG_FILENAME = 'ARCHIVED.txt'  # dict[name->time archived], for the files currently archived
+USAGE_LOG_FILENAME = 'USAGE.txt'  # {'bytes', 'files'} of the versions stored; see quotas.py
+CHANGE_LOG_FILENAME = 'CHANGES.txt'  # dict[str(sequence number)->filename], one entry per upload, archive or resurrect
+JOURNAL_EXTENSION = '.journal'  # Appended to a log's filename; the log's records not yet compacted into it.
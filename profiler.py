@@ -0,0 +1,113 @@
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+import uuid
+
+from pathing import PROFILE_FOLDER
+
+# A sampling profiler for the running server. A background thread looks at the stacks of the threads being profiled
+# every SAMPLE_INTERVAL seconds, either one request's thread (see app.py's profiling header) or every thread serving a
+# request during a time window. The samples are written to admin/profiles as collapsed stacks, one
+# 'outermost;...;innermost count' line per distinct stack, which flamegraph.pl, speedscope and the like read directly.
+SAMPLE_INTERVAL = 0.002
+MAX_WINDOW_SECONDS = 300
+PROFILER = {'thread': None, 'requests': {}, 'window': None}  # requests: thread ident -> Counter of collapsed stacks
+PROFILER_LOCK = threading.Lock()
+
+
+def start_request_profile():
+    with PROFILER_LOCK:
+        PROFILER['requests'][threading.get_ident()] = collections.Counter()
+        start_sampler()
+
+
+def finish_request_profile(name):
+    # Writes the samples of this thread's request; returns the profile's filename, or None if none was running.
+    with PROFILER_LOCK:
+        stacks = PROFILER['requests'].pop(threading.get_ident(), None)
+    if stacks is None:
+        return None
+    return write_profile(stacks, name)
+
+
+def start_window(seconds):
+    # Samples every request served for the next 'seconds'; returns the filename the profile will be written to, or
+    # None if a window is already open.
+    with PROFILER_LOCK:
+        if PROFILER['window'] is not None:
+            return None
+        filename = profile_filename('window')
+        PROFILER['window'] = {'until': time.monotonic() + min(seconds, MAX_WINDOW_SECONDS), 'filename': filename,
+                              'threads': set(), 'stacks': collections.Counter()}
+        start_sampler()
+        return filename
+
+
+def enter_request():
+    if PROFILER['window'] is not None:  # Only locks while a window is open.
+        with PROFILER_LOCK:
+            if PROFILER['window'] is not None:
+                PROFILER['window']['threads'].add(threading.get_ident())
+
+
+def leave_request():
+    if PROFILER['window'] is not None:
+        with PROFILER_LOCK:
+            if PROFILER['window'] is not None:
+                PROFILER['window']['threads'].discard(threading.get_ident())
+
+
+def start_sampler():
+    # Callers hold PROFILER_LOCK.
+    if PROFILER['thread'] is None:
+        PROFILER['thread'] = threading.Thread(target=sampler, name='profiler', daemon=True)
+        PROFILER['thread'].start()
+
+
+def sampler():
+    while True:
+        with PROFILER_LOCK:
+            window = PROFILER['window']
+            if not PROFILER['requests'] and window is None:
+                PROFILER['thread'] = None
+                return
+            frames = sys._current_frames()
+            for ident, stacks in PROFILER['requests'].items():
+                if ident in frames:
+                    stacks[collapse(frames[ident])] += 1
+            if window is not None:
+                for ident in window['threads']:
+                    if ident in frames:
+                        window['stacks'][collapse(frames[ident])] += 1
+                if time.monotonic() >= window['until']:
+                    PROFILER['window'] = None
+        if window is not None and PROFILER['window'] is None:
+            write_profile(window['stacks'], filename=window['filename'])
+        del frames
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(os.path.splitext(os.path.basename(code.co_filename))[0] + '.'
+                     + getattr(code, 'co_qualname', code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def profile_filename(name):
+    return datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '-' + name + '-' + uuid.uuid4().hex[:8] + '.folded'
+
+
+def write_profile(stacks, name=None, filename=None):
+    filename = profile_filename(name) if filename is None else filename
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    with open(os.path.join(PROFILE_FOLDER, filename), 'w') as profile:
+        for stack, samples in stacks.most_common():
+            profile.write(stack + ' ' + str(samples) + '\n')
+    return filename
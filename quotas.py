@@ -0,0 +1,98 @@
+import concurrent.futures
+import os
+
+import filehandling
+import metadata
+import userhandling
+
+# Per user, the bytes and the number of the versions stored. They are counted as versions are stored (filehandling)
+# and deleted (retention), and kept by the metadata backend, so neither the quotas nor the usage endpoint walk the
+# upload directories. Bytes are the versions' sizes; a blob shared by several versions counts once per version.
+# Requests never scan: a user's versions are counted by the retention worker (seed_usage) once, whether it runs in the
+# app, in serve.py's clean up process or on its own (python retention.py), and can be counted again with
+# rebuild_usage, e.g. after a crash between storing a version and counting it. Until then the user's usage is unknown
+# and their quotas are not enforced. Versions stored during a scan may be missed by it.
+# Quotas are per user, None for no limit; app.create_app sets them from the QUOTA_BYTES and QUOTA_FILES config.
+QUOTA_BYTES = None
+QUOTA_FILES = None
+SCAN_THREADS = 16
+
+
+def usage(user: userhandling.UserMethodPack):
+    # {'bytes', 'files'}, or None until the user's versions have been counted.
+    counted = metadata.backend().usage(user)
+    if counted is None and not os.path.isdir(user.upload_directory()):  # Nothing to count, so no scan is needed.
+        counted = {'bytes': 0, 'files': 0}
+        metadata.backend().set_usage(counted, user)
+    return counted
+
+
+def seed_usage(user: userhandling.UserMethodPack):
+    if usage(user) is None:
+        rebuild_usage(user)
+
+
+def rebuild_usage(user: userhandling.UserMethodPack):
+    counted = scan_usage(user)
+    metadata.backend().set_usage(counted, user)
+    return counted
+
+
+def exceeds_quota(added_bytes, added_files, user: userhandling.UserMethodPack):
+    # Would storing this much more take the user over a quota?
+    if QUOTA_BYTES is None and QUOTA_FILES is None:
+        return False
+    counted = usage(user)
+    if counted is None:
+        return False
+    return (QUOTA_BYTES is not None and counted['bytes'] + added_bytes > QUOTA_BYTES) \
+        or (QUOTA_FILES is not None and counted['files'] + added_files > QUOTA_FILES)
+
+
+def scan_usage(user: userhandling.UserMethodPack):
+    # The entries of the upload directory, mostly shards, are scanned in parallel; their stat calls release the GIL.
+    if not os.path.isdir(user.upload_directory()):
+        return {'bytes': 0, 'files': 0}
+    with concurrent.futures.ThreadPoolExecutor(SCAN_THREADS) as executor:
+        counts = list(executor.map(scan_entry, list(os.scandir(user.upload_directory()))))
+    return {'bytes': sum(count[0] for count in counts), 'files': sum(count[1] for count in counts)}
+
+
+def scan_entry(entry: os.DirEntry):
+    # (bytes, files) of the versions at or below an entry of an upload directory, in either layout; see
+    # filehandling.stored_versions. Versions deleted meanwhile are skipped.
+    if filehandling.split_server_side_name(entry.name) is not None:
+        size = file_size(entry)
+        return (0, 0) if size is None else (size, 1)
+    if len(entry.name) != 2 or not entry.is_dir():
+        return 0, 0
+    sizes = []
+    for second_level in scan_directory(entry.path):
+        for name in scan_directory(second_level.path):
+            sizes += [file_size(version) for version in scan_directory(name.path)
+                      if filehandling.split_server_side_name(name.name + '_' + version.name) is not None]
+    sizes = [size for size in sizes if size is not None]
+    return sum(sizes), len(sizes)
+
+
+def scan_directory(path):
+    try:
+        return list(os.scandir(path))
+    except FileNotFoundError:
+        return []
+
+
+def file_size(entry: os.DirEntry):
+    try:
+        return entry.stat().st_size
+    except FileNotFoundError:
+        return None
+
+
+def rebuild_all():
+    for userID in metadata.backend().users():
+        rebuild_usage(userhandling.UserMethodPack(userID))
+
+
+if __name__ == '__main__':
+    rebuild_all()
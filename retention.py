@@ -0,0 +1,136 @@
+import argparse
+import signal
+import threading
+import time
+
+import blobstore
+import filehandling
+import metadata
+import quotas
+import uploadsessions
+import userhandling
+from pathing import write_to_error_log
+
+# Which versions are deleted. The latest version of a file is always kept while the file is live or archived; a version
+# is kept if any of the configured rules keeps it, and everything is kept while no rule is configured. app.create_app
+# sets the rules from the KEEP_LAST_VERSIONS, KEEP_VERSIONS_NEWER_THAN and PURGE_ARCHIVED_AFTER config.
+KEEP_LAST_VERSIONS = None  # Keep this many of the newest versions of each file.
+KEEP_VERSIONS_NEWER_THAN = None  # Keep versions whose timestamp is less than this many seconds old.
+PURGE_ARCHIVED_AFTER = None  # Delete every version of a file once it has been archived for this many seconds.
+RETENTION_INTERVAL = 3600  # Seconds between the worker's passes over all users.
+USER_PAUSE = 0.1  # Seconds the worker rests between users, so a pass never hogs the disk or the locks.
+RETENTION_WORKER = {'thread': None, 'stop': threading.Event()}
+
+
+def versions_to_delete(server_side_names, now):
+    # server_side_names are one file's versions, oldest first.
+    if KEEP_LAST_VERSIONS is None and KEEP_VERSIONS_NEWER_THAN is None:
+        return []
+    kept = set(server_side_names[-1:])
+    if KEEP_LAST_VERSIONS is not None:
+        kept.update(server_side_names[max(len(server_side_names) - KEEP_LAST_VERSIONS, 0):])
+    if KEEP_VERSIONS_NEWER_THAN is not None:
+        kept.update(server_side_name for server_side_name in server_side_names
+                    if filehandling.split_server_side_name(server_side_name)[1] > now - KEEP_VERSIONS_NEWER_THAN)
+    return [server_side_name for server_side_name in server_side_names if server_side_name not in kept]
+
+
+def enforce_retention(user: userhandling.UserMethodPack, now=None):
+    # Deletes the versions the policies no longer keep; returns how many. Metadata goes first, so no reader is
+    # pointed at a version whose file is about to disappear, and the locks are only held for the metadata updates.
+    now = time.time() if now is None else now
+    backend = metadata.backend()
+    versions = backend.versions(user)
+    doomed = []
+    if PURGE_ARCHIVED_AFTER is not None:
+        for filename, archived_at in backend.archived_files(user).items():
+            if archived_at <= now - PURGE_ARCHIVED_AFTER and backend.purge_file(filename, now - PURGE_ARCHIVED_AFTER, user):
+                doomed += versions.pop(filename.split('.')[0], [])
+    for name, server_side_names in versions.items():
+        doomed += versions_to_delete(server_side_names, now)
+    if not doomed:
+        return 0
+    backend.delete_versions(doomed, user)
+    sizes = [filehandling.delete_version(server_side_name, user) for server_side_name in doomed]
+    sizes = [size for size in sizes if size is not None]
+    backend.add_usage(-sum(sizes), -len(sizes), user)
+    return len(doomed)
+
+
+def clean_up_user(user: userhandling.UserMethodPack):
+    quotas.seed_usage(user)
+    deleted = enforce_retention(user)
+    filehandling.remove_abandoned_temporary_files(user)
+    blobstore.collect_garbage(user)
+    uploadsessions.expire_sessions(user)
+    if deleted:
+        metadata.backend().compact(user)
+    return deleted
+
+
+def clean_up_all(stop: threading.Event):
+    # One pass over all users, cut short once stop is set.
+    for userID in metadata.backend().users():
+        if stop.is_set():
+            return
+        try:
+            clean_up_user(userhandling.UserMethodPack(userID))
+        except Exception as error:  # One user's broken files must not stop the clean up of everyone else's.
+            write_to_error_log("Retention failed for user " + userID + ": " + str(error))
+        stop.wait(USER_PAUSE)
+
+
+def retention_worker(stop: threading.Event):
+    while not stop.is_set():
+        clean_up_all(stop)
+        stop.wait(RETENTION_INTERVAL)
+
+
+def start_worker():
+    if RETENTION_WORKER['thread'] is not None and RETENTION_WORKER['thread'].is_alive():
+        return
+    RETENTION_WORKER['stop'] = threading.Event()
+    RETENTION_WORKER['thread'] = threading.Thread(target=retention_worker, args=(RETENTION_WORKER['stop'],),
+                                                  name='retention-worker', daemon=True)
+    RETENTION_WORKER['thread'].start()
+
+
+def stop_worker():
+    RETENTION_WORKER['stop'].set()
+    if RETENTION_WORKER['thread'] is not None:
+        RETENTION_WORKER['thread'].join()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    # The retention rules as command line options, for serve.py and for running this module.
+    parser.add_argument('--keep-last-versions', type=int, help='Newest versions of each file retention keeps.')
+    parser.add_argument('--keep-versions-days', type=float, help='Days retention keeps every version for.')
+    parser.add_argument('--purge-archived-days', type=float,
+                        help='Days a file is archived before retention deletes all its versions.')
+
+
+def arguments_config(args):
+    # The app config for the options of add_arguments.
+    return {'KEEP_LAST_VERSIONS': args.keep_last_versions,
+            'KEEP_VERSIONS_NEWER_THAN': None if args.keep_versions_days is None else args.keep_versions_days * 24 * 3600,
+            'PURGE_ARCHIVED_AFTER': None if args.purge_archived_days is None else args.purge_archived_days * 24 * 3600}
+
+
+if __name__ == '__main__':
+    # The retention worker as a process of its own, for servers started without it, e.g. under gunicorn; see serve.py.
+    # It also counts the users' usage, without which their quotas are not enforced.
+    import app
+    import retention  # The module create_app configures, rather than this __main__ one.
+    parser = argparse.ArgumentParser(description='Run the CloudIO retention worker.')
+    parser.add_argument('--metadata-backend', default='json', choices=['json', 'sqlite'])
+    parser.add_argument('--once', action='store_true', help='Make one pass over all users, then exit.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    app.create_app(dict(arguments_config(args), METADATA_BACKEND=args.metadata_backend, INTER_PROCESS_LOCKS=True,
+                        RETENTION_WORKER=False))
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    if args.once:
+        retention.clean_up_all(stop)
+    else:
+        retention.retention_worker(stop)
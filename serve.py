@@ -0,0 +1,114 @@
+import argparse
+import os
+import signal
+import socket
+import threading
+
+from werkzeug.serving import make_server
+
+import app
+import pathing
+import retention
+
+# Production server: one listening socket shared by a number of forked worker processes, each serving requests on
+# its own threads. Workers share nothing but the files on disk, so the locks are taken inter-process (flock) and
+# every cache is validated against the files it was read from. The supervising process only forks, reaps and
+# respawns; the retention clean up gets a process of its own, so it never runs more than once.
+# Any pre-fork WSGI server can host the app the same way, e.g.
+#   gunicorn -w 4 --threads 8 'app:create_app({"INTER_PROCESS_LOCKS": True, "RETENTION_WORKER": False})'
+# with the retention worker then run separately, by python retention.py; until it has counted a user's usage, their
+# quotas are not enforced (see quotas.py).
+WORKER_PROCESSES = os.cpu_count() or 1
+LISTEN_BACKLOG = 1024
+SUPERVISOR_INTERVAL = 0.5  # Seconds between checks for dead workers; also limits how fast a crashing one respawns.
+
+
+def listen(host, port):
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(LISTEN_BACKLOG)
+    return listener
+
+
+def serve_requests(listener, host, port):
+    server = make_server(host, port, app.app, threaded=True, fd=listener.fileno())
+    server.daemon_threads = False  # So server_close waits for the requests in flight.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+
+
+def clean_up():
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    retention.retention_worker(stop)
+
+
+def spawn(workers, role, target, *args):
+    pid = os.fork()
+    if pid != 0:
+        workers[pid] = role
+        return
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor decides when workers stop.
+        target(*args)
+    except BaseException as error:
+        pathing.write_to_error_log("Worker " + role + " failed: " + str(error))
+        exit_code = 1
+    finally:
+        pathing.flush_error_log()
+        os._exit(exit_code)
+
+
+def serve(host, port, worker_processes, config=None):
+    settings = {'INTER_PROCESS_LOCKS': True, 'RETENTION_WORKER': False}
+    settings.update(config or {})
+    app.create_app(settings)
+    listener = listen(host, port)
+    stopping = threading.Event()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: stopping.set())
+    workers = {}  # pid -> role
+    roles = {'requests': (serve_requests, listener, host, port), 'retention': (clean_up,)}
+    for _ in range(worker_processes):
+        spawn(workers, 'requests', *roles['requests'])
+    spawn(workers, 'retention', *roles['retention'])
+    while not stopping.is_set():
+        stopping.wait(SUPERVISOR_INTERVAL)
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            role = workers.pop(pid)
+            if not stopping.is_set():
+                pathing.write_to_error_log("Worker " + role + " (" + str(pid) + ") exited with status "
+                                           + str(status) + "; restarting it.")
+                spawn(workers, role, *roles[role])
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    for pid in workers:
+        os.waitpid(pid, 0)
+    listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve CloudIO from several worker processes.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--workers', type=int, default=WORKER_PROCESSES, help='Request serving processes.')
+    parser.add_argument('--metadata-backend', default='json', choices=['json', 'sqlite'])
+    parser.add_argument('--metrics', action='store_true', help='Time requests and their stages, for /metrics.')
+    parser.add_argument('--metadata-cache-mb', type=int, default=256,
+                        help='Megabytes of memory each worker keeps parsed logs in, estimated.')
+    parser.add_argument('--quota-mb', type=int, help='Megabytes each user may store.')
+    parser.add_argument('--quota-files', type=int, help='Versions each user may store.')
+    retention.add_arguments(parser)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, dict(retention.arguments_config(args),
+                                                   METADATA_BACKEND=args.metadata_backend, METRICS=args.metrics,
+                                                   METADATA_CACHE_BYTES=args.metadata_cache_mb * 1024 * 1024,
+                                                   QUOTA_BYTES=None if args.quota_mb is None
+                                                   else args.quota_mb * 1024 * 1024,
+                                                   QUOTA_FILES=args.quota_files))
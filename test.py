@@ -1,16 +1,50 @@
+import asyncio
+import hashlib
+import io
 import json
 import os
 import random
+import shutil
 import string
+import tempfile
+import threading
+import time
 import unittest
 
 import numpy as np
 
 import app
+import asgi
+import blobstore
 import filehandling
+import journaling
+import locking
+import metadata
+import metrics
+import pathing
+import quotas
+import retention
+import uploadsessions
 import userhandling
 
 
+def call_asgi(method, path, body_chunks=(), headers=()):
+    # Drives asgi.application like an ASGI server would; returns the status and the whole body.
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in body_chunks]
+    messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers)}
+    asyncio.run(asgi.application(scope, receive, send))
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
 class TestFileNaming(unittest.TestCase):
     def setUp(self):
         self.user = userhandling.UserMethodPack("aaaabbbbcccc")
@@ -18,16 +52,15 @@ class TestFileNaming(unittest.TestCase):
 
     def tearDown(self):
         files_to_rm = []
-        if os.path.isdir(self.user.upload_directory()):
-            files_to_rm = [os.path.join(self.user.upload_directory(), path) for path in os.listdir(self.user.upload_directory())]
         if os.path.isdir(self.user.admin_directory()):
             files_to_rm += [os.path.join(self.user.admin_directory(), path) for path in os.listdir(self.user.admin_directory())]
         for path in files_to_rm:
             os.remove(path)
-        if os.path.isdir(self.user.upload_directory()):
-            os.rmdir(self.user.upload_directory())
+        shutil.rmtree(self.user.upload_directory(), ignore_errors=True)
         if os.path.isdir(self.user.admin_directory()):
             os.rmdir(self.user.admin_directory())
+        shutil.rmtree(self.user.blob_directory(), ignore_errors=True)
+        shutil.rmtree(self.user.session_directory(), ignore_errors=True)
         self.user.unregister()
 
     def test_accepts_acceptable_names(self):
@@ -81,7 +114,7 @@ class TestFileNaming(unittest.TestCase):
             self.create_test_file('AB'+str(i)+'.cio', 5.0)
             self.create_test_file('AB'+str(i)+'.cio', 100.0)
         # get the actual names of the files.
-        filenames_in_dir = os.listdir(self.user.upload_directory())
+        filenames_in_dir = [server_side_name for server_side_name, path in filehandling.stored_versions(self.user)]
         self.assertTrue(len(filenames_in_dir) == 50, str(len(filenames_in_dir)) + " of 50 files created.")
         files_listed_uniquely = list(np.array(filehandling.list_live_files(self.user))[:, 0])
         self.check_server_side_names_are_listed_uniquely(files_listed_uniquely, filenames_in_dir)
@@ -105,6 +138,94 @@ class TestFileNaming(unittest.TestCase):
         self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) == 'A_100.0_0.cio',
                         "Latest should be 'A_100.0_0.cio' but is" + filehandling.latest_filename_version('A.cio', self.user))
 
+    def test_latest_follows_versions_stored_after_first_lookup(self):
+        self.create_test_file('A.cio', 5.0)
+        self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) == 'A_5.0_0.cio')
+        self.create_test_file('A.cio', 5.0)
+        self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) == 'A_5.0_1.cio')
+        self.create_test_file('A.cio', 1.0)
+        self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) == 'A_5.0_1.cio')
+        self.assertTrue(filehandling.latest_filename_version('B.cio', self.user) is None)
+
+    def test_versions_stored_by_another_process_are_noticed(self):
+        lock_folder, locking.LOCK_FOLDER = locking.LOCK_FOLDER, tempfile.mkdtemp()
+        locking.INTER_PROCESS = True
+        try:
+            this_process, other_process = metadata.JsonMetadataBackend(), metadata.JsonMetadataBackend()
+            os.makedirs(self.user.admin_directory(), exist_ok=True)
+            for timestamp, backend in [(1.0, this_process), (2.0, other_process), (3.0, this_process)]:
+                server_side_name = filehandling.filename_to_server_side_name('A.cio', timestamp, 0)
+                with open(filehandling.prepare_version_path(server_side_name, self.user), 'w') as file:
+                    file.write('This is for a test.')
+                backend.store_additional_data({server_side_name: {'t': timestamp, 'n': 'A.cio'}}, self.user)
+                self.assertTrue(this_process.latest_version('A.cio', self.user) == server_side_name)
+                self.assertTrue(other_process.latest_version('A.cio', self.user) == server_side_name)
+        finally:
+            locking.INTER_PROCESS = False
+            shutil.rmtree(locking.LOCK_FOLDER)
+            locking.LOCK_FOLDER = lock_folder
+
+    def test_versions_stored_by_another_process_are_caught_up_without_a_scan(self):
+        lock_folder, locking.LOCK_FOLDER = locking.LOCK_FOLDER, tempfile.mkdtemp()
+        locking.INTER_PROCESS = True
+        stored_versions = filehandling.stored_versions
+        try:
+            this_process, other_process = metadata.JsonMetadataBackend(), metadata.JsonMetadataBackend()
+            os.makedirs(self.user.admin_directory(), exist_ok=True)
+            server_side_names = []
+            for timestamp in [1.0, 2.0]:
+                server_side_names.append(filehandling.filename_to_server_side_name('A.cio', timestamp, 0))
+                with open(filehandling.prepare_version_path(server_side_names[-1], self.user), 'w') as file:
+                    file.write('This is for a test.')
+                if timestamp == 1.0:
+                    this_process.store_additional_data({server_side_names[-1]: {'t': timestamp}}, self.user)
+                    self.assertTrue(this_process.latest_version('A.cio', self.user) == server_side_names[-1])
+            self.assertTrue(other_process.latest_version('A.cio', self.user) == server_side_names[1])
+            filehandling.stored_versions = None  # Catching up must not scan the upload directory again.
+            other_process.store_additional_data({server_side_names[1]: {'t': 2.0}}, self.user)
+            self.assertTrue(this_process.latest_version('A.cio', self.user) == server_side_names[1])
+            other_process.delete_versions([server_side_names[1]], self.user)
+            self.assertTrue(this_process.latest_version('A.cio', self.user) == server_side_names[0])
+        finally:
+            filehandling.stored_versions = stored_versions
+            locking.INTER_PROCESS = False
+            shutil.rmtree(locking.LOCK_FOLDER)
+            locking.LOCK_FOLDER = lock_folder
+
+    def test_version_index_is_built_without_blocking_and_catches_up_on_install(self):
+        backend = metadata.JsonMetadataBackend()
+        os.makedirs(self.user.admin_directory(), exist_ok=True)
+        scanned, stored = threading.Event(), threading.Event()
+        stored_versions = filehandling.stored_versions
+
+        def slow_stored_versions(user):
+            versions = list(stored_versions(user))
+            if user.userID == self.user.userID:
+                scanned.set()
+                stored.wait(5)
+            return versions
+
+        filehandling.stored_versions = slow_stored_versions
+        try:
+            lookup = threading.Thread(target=lambda: backend.latest_version('A.cio', self.user))
+            lookup.start()
+            self.assertTrue(scanned.wait(5))
+            other_user = threading.Thread(
+                target=lambda: backend.latest_version('A.cio', userhandling.UserMethodPack('ddddeeeeffff')))
+            other_user.start()
+            other_user.join(2)
+            self.assertFalse(other_user.is_alive())  # Not kept waiting by this user's build.
+            server_side_name = filehandling.filename_to_server_side_name('A.cio', 1.0, 0)
+            with open(filehandling.prepare_version_path(server_side_name, self.user), 'w') as file:
+                file.write('This is for a test.')
+            backend.store_additional_data({server_side_name: {'t': 1.0}}, self.user)  # Stored after the scan.
+            stored.set()
+            lookup.join()
+            self.assertTrue(backend.latest_version('A.cio', self.user) == server_side_name)
+        finally:
+            stored.set()
+            filehandling.stored_versions = stored_versions
+
     # def test_can_save_file(self):  # TODO: Write this test.
 
     def test_new_files_are_listed_uniquely(self):
@@ -125,7 +246,7 @@ class TestFileNaming(unittest.TestCase):
             os.mkdir(app.UPLOAD_FOLDER)
         if not os.path.isdir(self.user.upload_directory()):
             os.mkdir(self.user.upload_directory())
-        with open(os.path.join(self.user.upload_directory(), avail_filename), 'w') as file:
+        with open(filehandling.prepare_version_path(avail_filename, self.user), 'w') as file:
             file.write('This is for a test.')
         filehandling.store_additional_data(
             avail_filename,
@@ -174,30 +295,545 @@ class TestFileNaming(unittest.TestCase):
         for name in live_files:
             self.assertTrue(name in live_files_with_some_resurrected)
 
+    def test_listed_files_carry_latest_version_timestamp(self):
+        self.create_test_file('A.cio', 1.0)
+        self.create_test_file('A.cio', 100.0)
+        self.create_test_file('B.cio', 5.0)
+        live_files = {name: ts for name, nonce, ts in filehandling.list_live_files(self.user)}
+        self.assertTrue(live_files == {'A.cio': 100.0, 'B.cio': 5.0}, "Listing was " + str(live_files))
+
+    def test_download_streams_raw_latest_version(self):
+        self.create_test_file('ABC.cio', 1.0)
+        self.create_test_file('ABC.cio', 2.0)
+        client = app.app.test_client()
+        response = client.get('/download_file/ABC.cio/' + self.user.userID)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.data == b'This is for a test.')
+        self.assertTrue(json.loads(response.headers['X-Additional-Data'])['t'] == 2.0)
+        partial = client.get('/download_file/ABC.cio/' + self.user.userID, headers={'Range': 'bytes=0-3'})
+        self.assertTrue(partial.status_code == 206 and partial.data == b'This')
+        unchanged = client.get('/download_file/ABC.cio/' + self.user.userID,
+                               headers={'If-None-Match': response.headers['ETag']})
+        self.assertTrue(unchanged.status_code == 304)
+        response.close()
+        partial.close()
+
+    def test_unchanged_files_and_listings_are_not_resent(self):
+        self.create_test_file('ABC.cio', 1.0)
+        client = app.app.test_client()
+        file_response = client.get('/get_file/ABC.cio/' + self.user.userID)
+        list_response = client.get('/list_files/' + self.user.userID)
+        self.assertTrue(file_response.status_code == 200 and list_response.status_code == 200)
+        for path, response in [('/get_file/ABC.cio/', file_response), ('/list_files/', list_response)]:
+            unchanged = client.get(path + self.user.userID, headers={'If-None-Match': response.headers['ETag']})
+            self.assertTrue(unchanged.status_code == 304 and unchanged.data == b'')
+        status, response = call_asgi('GET', '/list_files/' + self.user.userID,
+                                     headers=[(b'if-none-match', list_response.headers['ETag'].encode())])
+        self.assertTrue(status == 304)
+        self.create_test_file('ABC.cio', 1.7)  # Within the same second as the Last-Modified the client holds.
+        changed = client.get('/get_file/ABC.cio/' + self.user.userID,
+                             headers={'If-Modified-Since': file_response.headers['Last-Modified']})
+        self.assertTrue(changed.status_code == 200)
+        self.create_test_file('ABC.cio', 2.0)
+        for path, response in [('/get_file/ABC.cio/', file_response), ('/list_files/', list_response)]:
+            changed = client.get(path + self.user.userID, headers={'If-None-Match': response.headers['ETag']})
+            self.assertTrue(changed.status_code == 200)
+
+    def test_streamed_upload_is_stored_as_latest_version(self):
+        client = app.app.test_client()
+        additional_data = {'t': 7.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+        response = client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'ciphertext',
+                               headers={'X-Additional-Data': json.dumps(additional_data)},
+                               content_type='application/octet-stream')
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.get_json()['sha256'] == hashlib.sha256(b'ciphertext').hexdigest())
+        self.assertTrue(filehandling.latest_filename_version('ABC.cio', self.user) == 'ABC_7.0_0.cio')
+        self.assertTrue(filehandling.load_latest_timestamp('ABC.cio', self.user) == 7.0)
+        self.assertTrue(list(filehandling.stored_versions(self.user))
+                        == [('ABC_7.0_0.cio', filehandling.version_path('ABC_7.0_0.cio', self.user))])
+        mismatched = client.post('/upload_file_stream/ABD.cio/' + self.user.userID, data=b'ciphertext',
+                                 headers={'X-Additional-Data': json.dumps(additional_data)},
+                                 content_type='application/octet-stream')
+        self.assertTrue(mismatched.status_code == 400)
+
+    def test_abandoned_uploads_leave_no_temporary_files(self):
+        class DroppedConnection(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() >= 200000:
+                    raise ConnectionResetError()
+                return super().read(size)
+        os.makedirs(self.user.upload_directory(), exist_ok=True)
+        self.assertRaises(ConnectionResetError, filehandling.save_stream_to_temporary_file,
+                          DroppedConnection(b'0' * 1000000), self.user)
+        self.assertTrue(os.listdir(self.user.upload_directory()) == [])
+        temporary_path, content_hash = filehandling.save_stream_to_temporary_file(io.BytesIO(b'orphan'), self.user)
+        self.assertTrue(filehandling.remove_abandoned_temporary_files(self.user) == 0)  # Maybe still being committed.
+        self.assertTrue(filehandling.remove_abandoned_temporary_files(
+            self.user, time.time() + filehandling.TEMPORARY_FILE_TIMEOUT + 1) == 1)
+        self.assertFalse(os.path.exists(temporary_path))
+
+    def test_taken_version_names_are_never_overwritten(self):
+        additional_data = {'t': 5.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+        for content in [b'first', b'second']:  # Both reserved ABC_5.0_0.cio, as concurrent uploads may.
+            temporary_path, content_hash = filehandling.save_stream_to_temporary_file(io.BytesIO(content), self.user)
+            filehandling.commit_temporary_file(temporary_path, content_hash, 'ABC_5.0_0.cio', additional_data, self.user)
+        for server_side_name, content in [('ABC_5.0_0.cio', b'first'), ('ABC_5.0_1.cio', b'second')]:
+            path, stored_additional_data = filehandling.load_file_path_and_additional_data(server_side_name, self.user)
+            with open(path, 'rb') as file:
+                self.assertTrue(file.read() == content)
+            self.assertTrue(stored_additional_data == additional_data)
+
+    def test_versions_are_stored_when_their_directory_is_removed_meanwhile(self):
+        prepare_version_path = filehandling.prepare_version_path
+        removed = []
+
+        def prepare_then_remove(server_side_name, user):
+            path = prepare_version_path(server_side_name, user)
+            if not removed:  # As deleting the last version of the name in another thread would.
+                removed.append(path)
+                os.rmdir(os.path.dirname(path))
+            return path
+
+        filehandling.prepare_version_path = prepare_then_remove
+        try:
+            temporary_path, content_hash = filehandling.save_stream_to_temporary_file(io.BytesIO(b'first'), self.user)
+            filehandling.commit_temporary_file(temporary_path, content_hash, 'ABC_5.0_0.cio',
+                                               {'t': 5.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}, self.user)
+        finally:
+            filehandling.prepare_version_path = prepare_version_path
+        self.assertTrue(removed)
+        self.assertTrue(filehandling.latest_filename_version('ABC.cio', self.user) == 'ABC_5.0_0.cio')
+        with open(filehandling.find_version_path('ABC_5.0_0.cio', self.user), 'rb') as file:
+            self.assertTrue(file.read() == b'first')
+
+    def test_versions_are_listed_while_others_are_deleted(self):
+        self.create_test_file('ABC00B.cio', 1.0)  # Both in the same first level shard.
+        self.create_test_file('ABC014.cio', 1.0)
+        walk = filehandling.stored_versions(self.user)
+        listed = [next(walk)[0]]
+        filehandling.delete_version(({'ABC00B_1.0_0.cio', 'ABC014_1.0_0.cio'} - set(listed)).pop(), self.user)
+        listed += [server_side_name for server_side_name, path in walk]
+        self.assertTrue(len(listed) == 1)
+
+    def test_uploads_with_unsafe_timestamps_are_rejected(self):
+        client = app.app.test_client()
+        escaped = os.path.normpath(os.path.join(filehandling.version_directory('ABC.cio', self.user),
+                                                '../../../../../../escaped'))  # Where the first 't' would lead.
+        for t in ['../../../../../../escaped/pwn', '1.0', None, True, float('nan')]:
+            additional_data = json.dumps({'t': t, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456})
+            streamed = client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'ciphertext',
+                                   headers={'X-Additional-Data': additional_data},
+                                   content_type='application/octet-stream')
+            uploaded = client.post('/upload_file/' + self.user.userID, content_type='multipart/form-data',
+                                   data={'file_content': (io.BytesIO(b'ciphertext'), 'ABC.cio'),
+                                         'additional_data': (io.BytesIO(additional_data.encode()), 'additional_data')})
+            self.assertTrue(streamed.status_code == 400 and uploaded.status_code == 400)
+        self.assertFalse(os.path.exists(escaped))
+        self.assertTrue(list(filehandling.stored_versions(self.user)) == [])
+        for unsafe_name in ['ABC_../../../../escaped/pwn_0.cio', 'ABC_1.0_0.cio/../../x', '../ABC_1.0_0.cio']:
+            self.assertRaises(Exception, filehandling.version_path, unsafe_name, self.user)
+
+    def test_bulk_upload_commits_accepted_files_and_reports_each(self):
+        client = app.app.test_client()
+        uploads = [('A.cio', 1.0, 'A.cio'), ('B.cio', 2.0, 'B.cio'), ('A.cio', 1.0, 'A.cio'), ('C.cio', 3.0, 'D.cio'),
+                   ('E.cio', 4.0, 5)]
+        data = {'file_content': [(io.BytesIO(b'ciphertext ' + name.encode()), name) for name, t, n in uploads],
+                'additional_data': [(io.BytesIO(json.dumps({'t': t, 'n': n, 'nonce1': 123, 'nonce2': 456}).encode()),
+                                     'additional_data') for name, t, n in uploads]}
+        response = client.post('/upload_files/' + self.user.userID, data=data, content_type='multipart/form-data')
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue([result['status'] for result in response.get_json()['results']] == [200, 200, 200, 400, 400])
+        self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) == 'A_1.0_1.cio')
+        self.assertTrue(sorted(filehandling.list_live_files(self.user)) == [['A.cio', 123, 1.0], ['B.cio', 123, 2.0]])
+        self.assertTrue(filehandling.latest_filename_version('C.cio', self.user) is None)
+        self.assertTrue(filehandling.list_changes_since(0, self.user)[0] == 2)
+        self.assertFalse([entry for entry in os.listdir(self.user.upload_directory())
+                          if entry.startswith(filehandling.TEMPORARY_FILE_PREFIX)])
+
+    def test_failed_bulk_commit_leaves_no_versions_behind(self):
+        uploads = []
+        for name in ['A.cio', 'B.cio']:
+            temporary_path, content_hash = filehandling.save_stream_to_temporary_file(io.BytesIO(name.encode()),
+                                                                                      self.user)
+            uploads.append((name, temporary_path, content_hash, {'t': 1.0, 'n': name, 'nonce1': 123, 'nonce2': 456}))
+        backend = metadata.backend()
+
+        def fail(entries, user):
+            raise OSError("Disk full.")
+
+        backend.store_additional_data = fail
+        try:
+            self.assertRaises(OSError, filehandling.save_files_and_additional_data, uploads, self.user)
+        finally:
+            del backend.store_additional_data
+        self.assertTrue(list(filehandling.stored_versions(self.user)) == [])
+        self.assertTrue(filehandling.latest_filename_version('A.cio', self.user) is None)
+
+    def test_bulk_download_frames_latest_versions(self):
+        self.create_test_file('A.cio', 1.0)
+        self.create_test_file('A.cio', 2.0)
+        self.create_test_file('B.cio', 3.0)
+        client = app.app.test_client()
+        for filenames, expected in [('all', ['A.cio', 'B.cio']), (['B.cio', 'E.cio', 'A.cio'], ['B.cio', 'A.cio'])]:
+            response = client.post('/download_files/' + self.user.userID, json={'filenames': filenames})
+            self.assertTrue(response.status_code == 200)
+            body, frames = response.data, []
+            while True:
+                header_length = filehandling.FRAME_HEADER_LENGTH.unpack_from(body)[0]
+                body = body[filehandling.FRAME_HEADER_LENGTH.size:]
+                if header_length == 0:
+                    break
+                header = json.loads(body[:header_length])
+                frames.append((header['filename'], header['additional_data']['t'],
+                               body[header_length:header_length + header['size']]))
+                body = body[header_length + header['size']:]
+            self.assertTrue(body == b'')
+            self.assertTrue(sorted(frames) == sorted([(name, {'A.cio': 2.0, 'B.cio': 3.0}[name], b'This is for a test.')
+                                                      for name in expected]))
+            if filenames != 'all':
+                self.assertTrue([frame[0] for frame in frames] == expected)  # In the order asked for.
+
+    def test_resumable_upload_is_stored_once_complete(self):
+        client = app.app.test_client()
+        additional_data = {'t': 7.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+        content = os.urandom(200000)
+        session = client.post('/create_upload_session/' + self.user.userID,
+                              json={'filename': 'ABC.cio', 'additional_data': additional_data, 'size': len(content)})
+        self.assertTrue(session.status_code == 200)
+        session_path = session.get_json()['session'] + '/' + self.user.userID
+        for start, end in [(150000, 200000), (0, 50000), (40000, 100000)]:  # Out of order, overlapping, one missing.
+            response = client.put('/upload_chunk/' + session_path + '?offset=' + str(start), data=content[start:end])
+            self.assertTrue(response.status_code == 200)
+        self.assertTrue(client.get('/upload_session/' + session_path).get_json()['received']
+                        == [[0, 100000], [150000, 200000]])
+        self.assertTrue(client.post('/finish_upload_session/' + session_path).status_code == 400)
+        self.assertTrue(client.put('/upload_chunk/' + session_path + '?offset=199999', data=b'xx').status_code == 400)
+        client.put('/upload_chunk/' + session_path + '?offset=100000', data=content[100000:150000])
+        finished = client.post('/finish_upload_session/' + session_path)
+        self.assertTrue(finished.get_json()['sha256'] == hashlib.sha256(content).hexdigest())
+        file_path, stored_additional_data = filehandling.load_file_path_and_additional_data('ABC_7.0_0.cio', self.user)
+        with open(file_path, 'rb') as file:
+            self.assertTrue(file.read() == content)
+        self.assertTrue(stored_additional_data == additional_data)
+        self.assertTrue(client.get('/upload_session/' + session_path).status_code == 404)
+        abandoned = uploadsessions.create_session('DEF.cio', dict(additional_data, n='DEF.cio'), 10, self.user)
+        self.assertTrue(uploadsessions.expire_sessions(self.user) == 0)
+        self.assertTrue(uploadsessions.expire_sessions(self.user, time.time() + uploadsessions.SESSION_TIMEOUT + 1) == 1)
+        self.assertTrue(uploadsessions.load_session(abandoned, self.user) is None)
+        self.assertTrue(os.listdir(self.user.session_directory()) == [])
+
+    def test_sessions_leave_no_lock_files_behind(self):
+        lock_folder, locking.LOCK_FOLDER = locking.LOCK_FOLDER, tempfile.mkdtemp()
+        locking.INTER_PROCESS = True
+        try:
+            additional_data = {'t': 7.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+            for i in range(3):
+                session_id = uploadsessions.create_session('ABC.cio', additional_data, 10, self.user)
+                self.assertTrue(uploadsessions.write_chunk(session_id, 0, io.BytesIO(b'0123456789'), self.user) == 10)
+                if i == 0:
+                    self.assertTrue(uploadsessions.finish_session(session_id, self.user) is not None)
+                    self.assertTrue(uploadsessions.write_chunk(session_id, 0, io.BytesIO(b'0'), self.user) is None)
+                elif i == 1:
+                    self.assertTrue(uploadsessions.delete_session(session_id, self.user))
+            self.assertTrue(uploadsessions.expire_sessions(self.user, time.time() + uploadsessions.SESSION_TIMEOUT + 1)
+                            == 1)
+            self.assertFalse([name for name in os.listdir(locking.LOCK_FOLDER)
+                              if name.startswith('SESSION') or name.startswith('RANGES')])
+        finally:
+            locking.INTER_PROCESS = False
+            shutil.rmtree(locking.LOCK_FOLDER)
+            locking.LOCK_FOLDER = lock_folder
+
+    def test_asgi_upload_is_served_by_get_file(self):
+        boundary = 'cloudioboundary'
+        additional_data = {'t': 7.0, 'n': 'C.cio', 'nonce1': 123, 'nonce2': 456}
+        body = ('--' + boundary + '\r\nContent-Disposition: form-data; name="file_content"; filename="C.cio"\r\n\r\n'
+                + 'ab' * 100000 + '\r\n--' + boundary + '\r\nContent-Disposition: form-data; name="additional_data"; '
+                + 'filename="additional_data"\r\n\r\n' + json.dumps(additional_data) + '\r\n--' + boundary
+                + '--\r\n').encode('utf-8')
+        chunks = [body[i:i + 1000] for i in range(0, len(body), 1000)]  # As a slow client would send it.
+        status, response = call_asgi('POST', '/upload_file/' + self.user.userID, chunks,
+                                     [(b'content-type', b'multipart/form-data; boundary=' + boundary.encode())])
+        self.assertTrue(status == 200)
+        status, response = call_asgi('GET', '/get_file/C.cio/' + self.user.userID)
+        self.assertTrue(status == 200)
+        self.assertTrue(json.loads(response) == {'file': ('ab' * 100000).encode().hex(),
+                                                 'additional_data': additional_data})
+        status, response = call_asgi('GET', '/list_files/' + self.user.userID)
+        self.assertTrue(json.loads(response) == {'file_list': [['C.cio', 123, 7.0]]})
+
+    def test_file_time_is_served_as_text(self):
+        self.create_test_file('ABC.cio', 7.0)
+        response = app.app.test_client().get('/get_file_time/ABC.cio/' + self.user.userID)
+        self.assertTrue(response.status_code == 200 and response.data == b'7.0')
+
+    def test_requests_and_their_stages_are_measured_when_enabled(self):
+        self.create_test_file('ABC.cio', 1.0)
+        client = app.app.test_client()
+        metrics.reset()
+        client.get('/get_file/ABC.cio/' + self.user.userID)
+        self.assertTrue(metrics.exposition() == '\n')  # Disabled.
+        metrics.ENABLED = True
+        try:
+            client.get('/get_file/ABC.cio/' + self.user.userID)
+            client.get('/list_files/' + self.user.userID)
+        finally:
+            metrics.ENABLED = False
+        self.assertTrue(client.get('/metrics').status_code == 404)
+        app.app.config['ADMIN_TOKEN'] = 'admin secret'
+        try:
+            exposition = client.get('/metrics', headers={'X-CloudIO-Admin': 'admin secret'}).get_data(as_text=True)
+        finally:
+            app.app.config['ADMIN_TOKEN'] = None
+        metrics.reset()
+        self.assertTrue('cloudio_request_seconds_count{endpoint="get_file",status="200"} 1' in exposition)
+        self.assertTrue('cloudio_request_seconds_bucket{endpoint="list_files",status="200",le="+Inf"} 1' in exposition)
+        for stage in ['user_exists', 'latest_version', 'hex_encode', 'list_live_files']:
+            self.assertTrue('cloudio_stage_seconds_count{stage="' + stage + '"}' in exposition)
+        self.assertTrue('cloudio_bytes_read_total{stage="get_file"} ' + str(len(b'This is for a test.')) in exposition)
+        if isinstance(metadata.backend(), metadata.JsonMetadataBackend):
+            self.assertTrue('cloudio_lock_hold_seconds_count{lock="LIVE"}' in exposition)
+        self.assertTrue(locking.lock_labels('USAGE' + self.user.userID) == {'lock': 'USAGE'})
+        self.assertFalse(self.user.userID in exposition)
+
+    def test_requests_are_profiled_for_admins_only(self):
+        self.create_test_file('ABC.cio', 1.0)
+        client = app.app.test_client()
+        app.app.config['PROFILE_TOKEN'] = 'admin secret'
+        try:
+            self.assertFalse('X-CloudIO-Profile-File' in client.get('/list_files/' + self.user.userID,
+                                                                    headers={'X-CloudIO-Profile': 'guess'}).headers)
+            self.assertTrue(client.post('/profile_window/1', headers={'X-CloudIO-Profile': 'guess'}).status_code == 404)
+            response = client.get('/list_files/' + self.user.userID, headers={'X-CloudIO-Profile': 'admin secret'})
+            window = client.post('/profile_window/0', headers={'X-CloudIO-Profile': 'admin secret'})
+        finally:
+            app.app.config['PROFILE_TOKEN'] = None
+        self.assertTrue(response.status_code == 200 and window.status_code == 200)
+        for profile_filename in [response.headers['X-CloudIO-Profile-File'], window.get_json()['profile']]:
+            profile_path = os.path.join(pathing.PROFILE_FOLDER, profile_filename)
+            for _ in range(100):  # The window's profile is written by the sampler once the window closes.
+                if os.path.isfile(profile_path):
+                    break
+                time.sleep(0.01)
+            with open(profile_path) as profile:
+                self.assertTrue(all(line.rsplit(' ', 1)[1].strip().isdigit() for line in profile))
+            os.remove(profile_path)
+
+    def test_file_times_are_batched(self):
+        self.create_test_file('ABC.cio', 1.0)
+        self.create_test_file('ABC.cio', 3.0)
+        self.create_test_file('DEF.cio', 2.0)
+        filehandling.archive_file('DEF.cio', self.user)
+        client = app.app.test_client()
+        everything = client.post('/get_file_times/' + self.user.userID, json={'filenames': 'all'}).get_json()
+        self.assertTrue(everything['files'] == {'ABC.cio': {'t': 3.0, 'nonce1': 123, 'nonce2': 456, 'live': True},
+                                                'DEF.cio': {'t': 2.0, 'nonce1': 123, 'nonce2': 456, 'live': False}})
+        some = client.post('/get_file_times/' + self.user.userID, json={'filenames': ['ABC.cio', 'AAA.cio']}).get_json()
+        self.assertTrue(list(some['files'].keys()) == ['ABC.cio'])
+
+    def test_changes_since_cursor_are_listed(self):
+        client = app.app.test_client()
+        self.create_test_file('ABC.cio', 1.0)
+        self.create_test_file('DEF.cio', 2.0)
+        first = client.get('/list_changes/' + self.user.userID).get_json()
+        self.assertTrue(sorted(change[0] for change in first['changes']) == ['ABC.cio', 'DEF.cio'])
+        unchanged = client.get('/list_changes/' + self.user.userID + '?cursor=' + str(first['cursor'])).get_json()
+        self.assertTrue(unchanged == {'cursor': first['cursor'], 'changes': []})
+        filehandling.archive_file('ABC.cio', self.user)
+        self.create_test_file('DEF.cio', 3.0)
+        later = client.get('/list_changes/' + self.user.userID + '?cursor=' + str(first['cursor'])
+                           + '&wait=5').get_json()
+        self.assertTrue(sorted(later['changes']) == [['ABC.cio', False, 123, 1.0], ['DEF.cio', True, 123, 3.0]])
+        self.assertTrue(later['cursor'] > first['cursor'])
+
+    def test_identical_uploads_share_one_blob(self):
+        client = app.app.test_client()
+        content_hash = hashlib.sha256(b'ciphertext').hexdigest()
+        for timestamp in [1.0, 2.0]:
+            additional_data = {'t': timestamp, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+            client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'ciphertext',
+                        headers={'X-Additional-Data': json.dumps(additional_data)},
+                        content_type='application/octet-stream')
+        additional_data = {'t': 3.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+        known = client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'',
+                            headers={'X-Additional-Data': json.dumps(additional_data), 'X-Content-SHA256': content_hash},
+                            content_type='application/octet-stream')
+        self.assertTrue(known.get_json()['sha256'] == content_hash)
+        self.assertTrue(blobstore.references(content_hash, self.user) == 3)
+        with open(filehandling.version_path('ABC_3.0_0.cio', self.user), 'rb') as file:
+            self.assertTrue(file.read() == b'ciphertext')
+        os.remove(filehandling.version_path('ABC_1.0_0.cio', self.user))
+        self.assertTrue(blobstore.collect_garbage(self.user) == 0)
+        os.remove(filehandling.version_path('ABC_2.0_0.cio', self.user))
+        os.remove(filehandling.version_path('ABC_3.0_0.cio', self.user))
+        self.assertTrue(blobstore.collect_garbage(self.user) == len(b'ciphertext'))
+        self.assertFalse(blobstore.has_blob(content_hash, self.user))
+
+    def test_blobs_are_not_collected_while_versions_are_linked(self):
+        temporary_path, content_hash = filehandling.save_stream_to_temporary_file(io.BytesIO(b'ciphertext'), self.user)
+        os.makedirs(os.path.dirname(blobstore.blob_path(content_hash, self.user)))
+        os.replace(temporary_path, blobstore.blob_path(content_hash, self.user))  # Stored, but not linked yet.
+        self.user.acquire_blob_store_lock(shared=True)
+        collector = threading.Thread(target=blobstore.collect_garbage, args=(self.user,))
+        collector.start()
+        collector.join(0.2)
+        self.assertTrue(collector.is_alive())
+        blobstore.link_or_copy(blobstore.blob_path(content_hash, self.user),
+                               filehandling.prepare_version_path('ABC_1.0_0.cio', self.user))
+        self.user.release_blob_store_lock(shared=True)
+        collector.join()
+        self.assertTrue(blobstore.has_blob(content_hash, self.user))
+
+    def test_known_blob_collected_before_it_is_linked_is_read_from_the_body(self):
+        client = app.app.test_client()
+        content_hash = hashlib.sha256(b'ciphertext').hexdigest()
+        additional_data = {'t': 1.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+        client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'ciphertext',
+                    headers={'X-Additional-Data': json.dumps(additional_data)}, content_type='application/octet-stream')
+        blob_size = blobstore.blob_size
+
+        def blob_size_then_collect(found_hash, user):
+            size = blob_size(found_hash, user)
+            os.remove(filehandling.version_path('ABC_1.0_0.cio', self.user))
+            blobstore.collect_garbage(user)
+            return size
+
+        blobstore.blob_size = blob_size_then_collect
+        try:
+            additional_data['t'] = 2.0
+            response = client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'ciphertext',
+                                   headers={'X-Additional-Data': json.dumps(additional_data),
+                                            'X-Content-SHA256': content_hash},
+                                   content_type='application/octet-stream')
+        finally:
+            blobstore.blob_size = blob_size
+        self.assertTrue(response.status_code == 200)
+        with open(filehandling.version_path('ABC_2.0_0.cio', self.user), 'rb') as file:
+            self.assertTrue(file.read() == b'ciphertext')
+
+    def test_retention_keeps_latest_versions_and_purges_archived_files(self):
+        for timestamp in [1.0, 2.0, 3.0, 4.0]:
+            self.create_test_file('ABC.cio', timestamp)
+        self.create_test_file('DEF.cio', 1.0)
+        filehandling.archive_file('DEF.cio', self.user)
+        shard_directory = os.path.dirname(os.path.dirname(filehandling.version_directory('DEF', self.user)))
+        self.assertTrue(os.path.isdir(shard_directory))
+        retention.KEEP_LAST_VERSIONS = 2
+        retention.PURGE_ARCHIVED_AFTER = 0
+        try:
+            self.assertTrue(retention.enforce_retention(self.user, now=time.time() + 1) == 3)
+        finally:
+            retention.KEEP_LAST_VERSIONS = None
+            retention.PURGE_ARCHIVED_AFTER = None
+        self.assertTrue(sorted(name for name, path in filehandling.stored_versions(self.user))
+                        == ['ABC_3.0_0.cio', 'ABC_4.0_0.cio'])
+        self.assertTrue(filehandling.latest_filename_version('ABC.cio', self.user) == 'ABC_4.0_0.cio')
+        self.assertTrue(filehandling.load_additional_data('ABC_1.0_0.cio', self.user) is None)
+        self.assertTrue(filehandling.latest_filename_version('DEF.cio', self.user) is None)
+        self.assertFalse(filehandling.resurrect_file('DEF.cio', self.user))
+        self.assertFalse(os.path.exists(shard_directory), "Empty directories are removed with the last version.")
+
+    def test_usage_is_counted_as_versions_are_stored_and_deleted(self):
+        client = app.app.test_client()
+        self.assertTrue(quotas.usage(self.user) == {'bytes': 0, 'files': 0})  # Scanned the first time.
+        responses = []
+        for timestamp in [1.0, 2.0, 3.0]:
+            if timestamp == 3.0:
+                quotas.QUOTA_FILES = 2
+            try:
+                additional_data = {'t': timestamp, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+                responses.append(client.post('/upload_file_stream/ABC.cio/' + self.user.userID, data=b'0123456789',
+                                             headers={'X-Additional-Data': json.dumps(additional_data)}).status_code)
+            finally:
+                quotas.QUOTA_FILES = None
+        self.assertTrue(responses == [200, 200, 507])
+        quotas.QUOTA_BYTES = 1000
+        try:
+            additional_data = {'t': 4.0, 'n': 'ABC.cio', 'nonce1': 123, 'nonce2': 456}
+            chunked = client.post('/upload_file_stream/ABC.cio/' + self.user.userID,
+                                  input_stream=io.BytesIO(b'0' * 1000000), headers={
+                                      'X-Additional-Data': json.dumps(additional_data), 'Transfer-Encoding': 'chunked'},
+                                  environ_overrides={'CONTENT_LENGTH': '', 'wsgi.input_terminated': True})
+        finally:
+            quotas.QUOTA_BYTES = None
+        self.assertTrue(chunked.status_code == 411)
+        self.assertTrue(quotas.usage(self.user) == {'bytes': 20, 'files': 2})
+        retention.KEEP_LAST_VERSIONS = 1
+        try:
+            retention.enforce_retention(self.user)
+        finally:
+            retention.KEEP_LAST_VERSIONS = None
+        self.assertTrue(quotas.usage(self.user) == quotas.scan_usage(self.user) == {'bytes': 10, 'files': 1})
+        app.app.config['ADMIN_TOKEN'] = 'admin secret'
+        try:
+            self.assertTrue(client.get('/usage', headers={'X-CloudIO-Admin': 'guess'}).status_code == 404)
+            self.assertTrue(client.get('/usage', headers={'X-CloudIO-Profile': 'admin secret'}).status_code == 404)
+            usage = client.get('/usage', headers={'X-CloudIO-Admin': 'admin secret'}).get_json()
+        finally:
+            app.app.config['ADMIN_TOKEN'] = None
+        self.assertTrue(usage['users'][self.user.userID] == {'bytes': 10, 'files': 1})
+
+    def test_usage_of_stored_versions_is_counted_by_the_retention_worker(self):
+        self.create_test_file('ABC.cio', 1.0)
+        self.assertTrue(quotas.usage(self.user) is None)  # Stored before anything was counted; requests do not scan.
+        quotas.QUOTA_FILES = 0
+        try:
+            self.assertFalse(quotas.exceeds_quota(1, 1, self.user))
+            retention.clean_up_all(threading.Event())  # A pass as python retention.py --once makes.
+            self.assertTrue(quotas.exceeds_quota(1, 1, self.user))
+        finally:
+            quotas.QUOTA_FILES = None
+        self.assertTrue(quotas.usage(self.user) == {'bytes': len(b'This is for a test.'), 'files': 1})
+
+    def test_flat_versions_are_found_and_migrated(self):
+        self.create_test_file('ABC.cio', 1.0)
+        os.replace(filehandling.version_path('ABC_1.0_0.cio', self.user),
+                   filehandling.flat_version_path('ABC_1.0_0.cio', self.user))  # As stored before sharding.
+        self.user.forget_cached_metadata()
+        self.assertTrue(filehandling.latest_filename_version('ABC.cio', self.user) == 'ABC_1.0_0.cio')
+        self.assertTrue(filehandling.get_available_name('ABC.cio', 1.0, self.user) == 'ABC_1.0_1.cio')
+        self.assertTrue(filehandling.migrate_to_sharded_layout(self.user) == 1)
+        path, additional_data = filehandling.load_file_path_and_additional_data('ABC_1.0_0.cio', self.user)
+        self.assertTrue(path == filehandling.version_path('ABC_1.0_0.cio', self.user))
+        self.assertFalse(os.path.isfile(filehandling.flat_version_path('ABC_1.0_0.cio', self.user)))
+
     def test_latest_timestamp_is_the_latest_timestamp(self):
         self.create_test_file('ABC.cio', 1234.5678)
         self.assertTrue(1234.5678 == filehandling.load_latest_timestamp('ABC.cio', self.user),
                         "Time logged was not correct.")
 
 
+class TestFileNamingOnSqlite(TestFileNaming):
+    def setUp(self):
+        self.database_directory = tempfile.mkdtemp()
+        self.previous_backend = metadata.backend()
+        metadata.use_backend('sqlite', os.path.join(self.database_directory, 'metadata.sqlite3'))
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        metadata.ACTIVE_BACKEND[:] = [self.previous_backend]
+        shutil.rmtree(self.database_directory)
+
+
 class TestUserHandling(unittest.TestCase):
     def setUp(self) -> None:
-        if not os.path.isfile(userhandling.USER_CATALOG):
+        if not os.path.isfile(pathing.USER_CATALOG):
             self.user_catalog = None
         else:
-            with open(userhandling.USER_CATALOG) as catalog:
+            with open(pathing.USER_CATALOG) as catalog:
                 self.user_catalog = json.load(catalog)
-            os.remove(userhandling.USER_CATALOG)
+            os.remove(pathing.USER_CATALOG)
 
     def tearDown(self) -> None:
-        if os.path.isfile(userhandling.USER_CATALOG):
-            os.remove(userhandling.USER_CATALOG)
+        if os.path.isfile(pathing.USER_CATALOG):
+            os.remove(pathing.USER_CATALOG)
         if self.user_catalog is None:
             pass  # it already doesn't exist.
         else:
             if not os.path.isdir(app.ADMIN_FOLDER):
                 os.mkdir(app.ADMIN_FOLDER)
-            with open(userhandling.USER_CATALOG, 'w') as catalog:
+            with open(pathing.USER_CATALOG, 'w') as catalog:
                 json.dump(self.user_catalog, catalog)
 
     def test_user_exists_once_registered(self):
@@ -207,6 +843,152 @@ class TestUserHandling(unittest.TestCase):
         self.assertTrue(user.exists(), "User should now be registered.")
 
 
+    def test_catalog_replaced_by_another_process_is_noticed(self):
+        user = userhandling.UserMethodPack("aaaaabbbbbccccc")
+        user.register()
+        self.assertTrue(user.exists())
+        with open(str(pathing.USER_CATALOG) + '.other', 'w') as catalog:
+            json.dump({}, catalog)
+        os.replace(str(pathing.USER_CATALOG) + '.other', pathing.USER_CATALOG)
+        self.assertFalse(user.exists(), "User was removed from the catalog on disk.")
+
+class TestJournaling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.directory, 'LOG.txt')
+
+    def tearDown(self) -> None:
+        journaling.forget(self.log_path)
+        shutil.rmtree(self.directory)
+
+    def test_appends_are_replayed_over_legacy_log(self):
+        with open(self.log_path, 'w') as log:
+            json.dump({'A.cio': True, 'B.cio': True}, log)
+        journaling.append(self.log_path, {'B.cio': False})
+        journaling.append(self.log_path, {'C.cio': True})
+        self.assertTrue(journaling.load(self.log_path) == {'A.cio': True, 'B.cio': False, 'C.cio': True})
+        journaling.forget(self.log_path)  # As if read by another process.
+        self.assertTrue(journaling.load(self.log_path) == {'A.cio': True, 'B.cio': False, 'C.cio': True})
+
+    def test_compaction_folds_journal_into_snapshot(self):
+        for i in range(journaling.COMPACTION_THRESHOLD):
+            journaling.append(self.log_path, {'A' + str(i) + '.cio': i})
+        self.assertTrue(os.path.getsize(journaling.journal_path(self.log_path)) == 0)
+        with open(self.log_path, 'r') as log:
+            self.assertTrue(len(json.load(log)) == journaling.COMPACTION_THRESHOLD)
+
+    def test_torn_record_is_skipped(self):
+        journaling.append(self.log_path, {'A.cio': 1})
+        with open(journaling.journal_path(self.log_path), 'ab') as journal:
+            journal.write(b'["B.cio", ')  # Crash mid-write.
+        journaling.append(self.log_path, {'C.cio': 3})
+        journaling.forget(self.log_path)
+        self.assertTrue(journaling.load(self.log_path) == {'A.cio': 1, 'C.cio': 3})
+
+    def test_least_recently_used_logs_are_evicted(self):
+        other_path = os.path.join(self.directory, 'OTHER.txt')
+        maximum = journaling.MAX_CACHED_BYTES
+        try:
+            journaling.append(self.log_path, {'A.cio': 'a' * 100})
+            size = os.path.getsize(journaling.journal_path(self.log_path))
+            journaling.MAX_CACHED_BYTES = 2 * size + 10  # Both logs fit on disk, but not parsed.
+            journaling.append(other_path, {'B.cio': 'b' * 100})
+            self.assertFalse(self.log_path in journaling.REPLAY_STATES)
+            self.assertTrue(journaling.load(self.log_path) == {'A.cio': 'a' * 100}, "Evicted logs are reread.")
+            self.assertFalse(other_path in journaling.REPLAY_STATES)
+            self.assertTrue(journaling.CACHED['bytes'] == journaling.PARSED_SIZE_FACTOR * size)
+        finally:
+            journaling.MAX_CACHED_BYTES = maximum
+            journaling.forget(other_path)
+
+    def test_replay_locks_of_idle_logs_are_evicted(self):
+        log_paths = [os.path.join(self.directory, 'LOG' + str(i) + '.txt') for i in range(locking.MAX_IDLE_LOCKS + 10)]
+        for log_path in log_paths:
+            journaling.append(log_path, {'A.cio': 1})
+        self.assertTrue(len(journaling.REPLAY_LOCKS.locks) <= locking.MAX_IDLE_LOCKS)
+        for log_path in log_paths:
+            journaling.forget(log_path)
+
+
+class TestLocking(unittest.TestCase):
+    def test_readers_share_and_writers_exclude(self):
+        registry = locking.LockRegistry()
+        registry.acquire('LIVEabc', shared=True)
+        other_reader = threading.Thread(target=lambda: (registry.acquire('LIVEabc', shared=True),
+                                                        registry.release('LIVEabc', shared=True)))
+        other_reader.start()
+        other_reader.join(5)
+        self.assertFalse(other_reader.is_alive(), "Readers should not wait on each other.")
+        writer_done = threading.Event()
+        writer = threading.Thread(target=lambda: (registry.acquire('LIVEabc'), writer_done.set(),
+                                                  registry.release('LIVEabc')))
+        writer.start()
+        self.assertFalse(writer_done.wait(0.2), "The writer should wait for the reader.")
+        registry.release('LIVEabc', shared=True)
+        self.assertTrue(writer_done.wait(5))
+        writer.join()
+
+    def test_idle_locks_are_evicted(self):
+        registry = locking.LockRegistry()
+        registry.acquire('held')
+        for i in range(locking.MAX_IDLE_LOCKS + 10):
+            registry.acquire('LIVE' + str(i))
+            registry.release('LIVE' + str(i))
+        self.assertTrue(len(registry.locks) == locking.MAX_IDLE_LOCKS)
+        self.assertTrue('held' in registry.locks)
+        registry.release('held')
+
+
+    def test_inter_process_mode_excludes_other_lock_holders(self):
+        lock_folder, locking.LOCK_FOLDER = locking.LOCK_FOLDER, tempfile.mkdtemp()
+        locking.INTER_PROCESS = True
+        try:
+            this_process, other_process = locking.LockRegistry(), locking.LockRegistry()  # Separate flock holders.
+            this_process.acquire('ADDabc')
+            other_done = threading.Event()
+            other = threading.Thread(target=lambda: (other_process.acquire('ADDabc'), other_done.set(),
+                                                     other_process.release('ADDabc')))
+            other.start()
+            self.assertFalse(other_done.wait(0.2))
+            this_process.release('ADDabc')
+            self.assertTrue(other_done.wait(5))
+            other.join()
+        finally:
+            locking.INTER_PROCESS = False
+            shutil.rmtree(locking.LOCK_FOLDER)
+            locking.LOCK_FOLDER = lock_folder
+
+class TestErrorLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.error_log = pathing.ERROR_LOG
+        pathing.ERROR_LOG = os.path.join(self.directory, 'error_log.txt')
+
+    def tearDown(self) -> None:
+        pathing.flush_error_log()
+        pathing.ERROR_LOG = self.error_log
+        pathing.ERROR_LOG_MAX_BYTES = 16 * 1024 * 1024
+        shutil.rmtree(self.directory)
+
+    def test_records_are_written_by_the_background_writer(self):
+        pathing.write_to_error_log("Something happened.", userID='abc')
+        with app.app.test_request_context('/get_file/A.cio/def'):
+            pathing.write_to_error_log(404)
+        pathing.flush_error_log()
+        with open(pathing.ERROR_LOG) as error_log_file:
+            records = [json.loads(line) for line in error_log_file.read().split('\n') if line]
+        self.assertTrue(records[0]['message'] == "Something happened." and records[0]['userID'] == 'abc')
+        self.assertTrue(records[1]['message'] == '404' and records[1]['endpoint'] == '/get_file/A.cio/def')
+
+    def test_log_is_rotated_once_too_large(self):
+        pathing.ERROR_LOG_MAX_BYTES = 100
+        for i in range(10):
+            pathing.write_to_error_log("Record number " + str(i))
+            pathing.flush_error_log()
+        self.assertTrue(os.path.isfile(str(pathing.ERROR_LOG) + '.1'))
+        self.assertTrue(os.path.getsize(pathing.ERROR_LOG) < 300)
+
+
 def create_test_folders():
     if not os.path.exists(app.ADMIN_FOLDER):  # Create the test folder
         os.mkdir(app.ADMIN_FOLDER)
@@ -0,0 +1,176 @@
+import json
+import os
+import time
+import uuid
+
+import blobstore
+import filehandling
+import journaling
+import locking
+import metrics
+import userhandling
+
+# Resumable uploads. A session is created for one file of a known size, and its chunks are then written straight into
+# place in one sparse file, at their offsets, in any order and in parallel. So finishing needs no concatenation: the
+# file is hashed and committed like any other upload. Per user, in sessions/USER<id>:
+#   <session>.json    the filename, additional data and size, written once at creation
+#   <session>.part    the file being received
+#   <session>.ranges  journaled log of the chunks received, str(offset) -> end
+# Sessions untouched for SESSION_TIMEOUT seconds are deleted by expire_sessions, which the retention worker runs.
+MAX_SESSION_SIZE = 64 * 1024 * 1024 * 1024
+SESSION_TIMEOUT = 24 * 60 * 60
+
+
+def session_path(session_id, extension, user: userhandling.UserMethodPack):
+    return os.path.join(user.session_directory(), session_id + extension)
+
+
+def acquire_session_lock(session_id, user: userhandling.UserMethodPack, shared=False):
+    # Shared while chunks are written, held alone while the session is finished or deleted. Between processes it is a
+    # flock on the session's description, so it goes with the session. False if the session is gone.
+    try:
+        locking.USER_LOCKS.acquire('SESSION' + session_id, shared, session_path(session_id, '.json', user))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release_session_lock(session_id, shared=False):
+    locking.USER_LOCKS.release('SESSION' + session_id, shared)
+
+
+def create_session(filename, additional_data, size, user: userhandling.UserMethodPack):
+    session_id = uuid.uuid4().hex
+    os.makedirs(user.session_directory(), exist_ok=True)
+    with open(session_path(session_id, '.part', user), 'wb') as part:
+        part.truncate(size)  # Sparse; takes no space until written.
+    with open(session_path(session_id, '.json', user), 'w') as info:
+        json.dump({'filename': filename, 'additional_data': additional_data, 'size': size}, info)
+    return session_id
+
+
+def load_session(session_id, user: userhandling.UserMethodPack):
+    try:
+        with open(session_path(session_id, '.json', user), 'r') as info:
+            return json.load(info)
+    except FileNotFoundError:
+        return None
+
+
+def received_ranges(session_id, user: userhandling.UserMethodPack):
+    # The received bytes as sorted, merged [start, end) ranges.
+    ranges = []
+    for start, end in sorted((int(offset), end) for offset, end in
+                             journaling.load(session_path(session_id, '.ranges', user)).items()):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def write_chunk(session_id, offset, stream, user: userhandling.UserMethodPack):
+    # Writes the stream at offset; returns the number of bytes written, or None if there is no such session or the
+    # chunk does not fit in the file. What arrived before a dropped connection is kept and recorded.
+    if not acquire_session_lock(session_id, user, shared=True):
+        return None
+    try:
+        session = load_session(session_id, user)
+        if session is None or offset < 0:
+            return None
+        written = 0
+        part = os.open(session_path(session_id, '.part', user), os.O_WRONLY)
+        try:
+            while True:
+                chunk = stream.read(filehandling.STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if offset + written + len(chunk) > session['size']:
+                    return None
+                os.pwrite(part, chunk, offset + written)
+                written += len(chunk)
+        finally:
+            os.close(part)
+            if written:
+                record_range(session_id, offset, offset + written, user)
+                metrics.count(metrics.BYTES_WRITTEN, written, stage='upload_chunk')
+        return written
+    finally:
+        release_session_lock(session_id, shared=True)
+
+
+def record_range(session_id, start, end, user: userhandling.UserMethodPack):
+    # Chunks written in parallel record their ranges in turn. Callers share the session lock, so the file received is
+    # there to be flocked between processes.
+    locking.USER_LOCKS.acquire('RANGES' + session_id, lock_path=session_path(session_id, '.part', user))
+    ranges_path = session_path(session_id, '.ranges', user)
+    if (journaling.load_entry(ranges_path, str(start)) or 0) < end:
+        journaling.append(ranges_path, {str(start): end})
+    locking.USER_LOCKS.release('RANGES' + session_id)
+
+
+def finish_session(session_id, user: userhandling.UserMethodPack):
+    # Commits the received file as the latest version of the session's file. Returns the content's hash, or None if
+    # there is no such session, bytes are missing, or no name was available.
+    if not acquire_session_lock(session_id, user):
+        return None
+    try:
+        session = load_session(session_id, user)
+        if session is None or received_ranges(session_id, user) != ([[0, session['size']]] if session['size'] else []):
+            return None
+        part_path = session_path(session_id, '.part', user)
+        content_hash = blobstore.hash_file(part_path)
+        avail_filename = filehandling.get_available_name(session['filename'], session['additional_data']['t'], user)
+        if avail_filename is None:
+            return None
+        filehandling.commit_temporary_file(part_path, content_hash, avail_filename, session['additional_data'], user)
+        filehandling.mark_file_as_live(session['filename'], user)
+        delete_session_files(session_id, user)
+        return content_hash
+    finally:
+        release_session_lock(session_id)
+
+
+def delete_session(session_id, user: userhandling.UserMethodPack):
+    if not acquire_session_lock(session_id, user):
+        return False
+    deleted = load_session(session_id, user) is not None
+    delete_session_files(session_id, user)
+    release_session_lock(session_id)
+    return deleted
+
+
+def delete_session_files(session_id, user: userhandling.UserMethodPack):
+    # Callers hold the session lock. The description goes last, so a half deleted session is still found to expire.
+    ranges_path = session_path(session_id, '.ranges', user)
+    for path in [session_path(session_id, '.part', user), ranges_path, journaling.journal_path(ranges_path),
+                 session_path(session_id, '.json', user)]:
+        if os.path.isfile(path):
+            os.remove(path)
+    journaling.forget(ranges_path)
+
+
+def last_activity(session_id, user: userhandling.UserMethodPack):
+    ranges_path = session_path(session_id, '.ranges', user)
+    return max(os.path.getmtime(path) for path in [session_path(session_id, '.json', user),
+                                                     session_path(session_id, '.part', user), ranges_path,
+                                                     journaling.journal_path(ranges_path)] if os.path.isfile(path))
+
+
+def expire_sessions(user: userhandling.UserMethodPack, now=None):
+    # Deletes the sessions abandoned for longer than SESSION_TIMEOUT; returns how many.
+    now = time.time() if now is None else now
+    if not os.path.isdir(user.session_directory()):
+        return 0
+    expired = 0
+    for filename in os.listdir(user.session_directory()):
+        session_id, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        try:
+            if last_activity(session_id, user) > now - SESSION_TIMEOUT:
+                continue
+        except (FileNotFoundError, ValueError):  # Finished or deleted meanwhile.
+            continue
+        expired += delete_session(session_id, user)
+    return expired
@@ -1,13 +1,13 @@
-import json
 import os
 import string
-import threading
 
 import app
 import filehandling
-from pathing import UPLOAD_FOLDER, ADMIN_FOLDER, ADDITIONAL_DATA_LOG_FILENAME, LIVE_FILES_LOG_FILENAME, USER_CATALOG
-LIVE_FILES_LOG_LOCKS = {}
-ADDITIONAL_DATA_LOG_LOCKS = {}
+import locking
+import metadata
+import metrics
+from pathing import UPLOAD_FOLDER, ADMIN_FOLDER, BLOB_FOLDER, SESSION_FOLDER, ADDITIONAL_DATA_LOG_FILENAME, LIVE_FILES_LOG_FILENAME, \
+    CHANGE_LOG_FILENAME, ARCHIVE_LOG_FILENAME, USAGE_LOG_FILENAME
 
 
 class UserMethodPack:
@@ -18,86 +18,77 @@ class UserMethodPack:
 
     def admin_directory(self): return os.path.join(ADMIN_FOLDER, "USER" + self.userID)
 
+    def blob_directory(self): return os.path.join(BLOB_FOLDER, "USER" + self.userID)
+
+    def session_directory(self): return os.path.join(SESSION_FOLDER, "USER" + self.userID)
+
     def add_data_log_path(self):
         return os.path.join(self.admin_directory(), ADDITIONAL_DATA_LOG_FILENAME)
 
     def live_files_log_path(self):
         return os.path.join(self.admin_directory(), LIVE_FILES_LOG_FILENAME)
 
+    def archive_log_path(self):
+        return os.path.join(self.admin_directory(), ARCHIVE_LOG_FILENAME)
+
+    def change_log_path(self):
+        return os.path.join(self.admin_directory(), CHANGE_LOG_FILENAME)
+
+    def usage_log_path(self):
+        return os.path.join(self.admin_directory(), USAGE_LOG_FILENAME)
+
+    @metrics.timed('user_exists')
     def exists(self):
         if not all(s in string.hexdigits for s in self.userID):
             app.write_to_error_log("UserID not in hexdigits.")
             return False
-        if not os.path.isdir(app.ADMIN_FOLDER):
-            return False
-        if not os.path.isfile(USER_CATALOG):
-            return False
-        with open(USER_CATALOG, 'r') as catalog:
-            users = json.load(catalog)
-        return self.userID in users
+        return metadata.backend().user_exists(self.userID)
 
     def register(self):
         if not all(s in string.hexdigits for s in self.userID):
             app.write_to_error_log("UserID not in hexdigits.")
             return False
+        self.forget_cached_metadata()  # Rebuilt from disk on next access.
         if not os.path.isdir(app.ADMIN_FOLDER):
             os.mkdir(app.ADMIN_FOLDER)
-        if not os.path.isfile(USER_CATALOG):
-            with open(USER_CATALOG, 'w') as catalog:
-                json.dump({self.userID: self.userID}, catalog)
-        else:
-            with open(USER_CATALOG, 'r') as catalog:
-                users = json.load(catalog)
-            users[self.userID] = self.userID
-            with open(USER_CATALOG, 'w') as catalog:
-                json.dump(users, catalog)
+        metadata.backend().register_user(self.userID)
 
     def unregister(self):  # Maybe delete content of user when unregistered?
         if not all(s in string.hexdigits for s in self.userID):
             app.write_to_error_log("UserID not in hexdigits.")
             return False
-        if not os.path.isdir(app.ADMIN_FOLDER):
-            return False
-        if not os.path.isfile(USER_CATALOG):
+        if not metadata.backend().user_exists(self.userID):
             return False
         else:
             live_files = filehandling.list_live_files(self)  # archive live files
             for file, nonce, ts in live_files:
                 filehandling.archive_file(file, self)
-            with open(USER_CATALOG, 'r') as catalog:
-                users: dict = json.load(catalog)
-            keysToPop = []
-            for key in users.keys():  # For each key make sure it doesn't point at the user we're deleting, ...
-                if users[key] == self.userID or users[key] not in users.keys():  # ... or at something not contained...
-                    keysToPop.append(key)  # ... as these are all aliases of our user.
-            for key in keysToPop:
-                users.pop(key)
-            with open(USER_CATALOG, 'w') as catalog:
-                json.dump(users, catalog)
-
-    def acquire_live_files_log_lock(self):
-        if self.userID in LIVE_FILES_LOG_LOCKS.keys():
-            lock: threading.Lock = LIVE_FILES_LOG_LOCKS[self.userID]
-            lock.acquire()
-        else:
-            lock = threading.Lock()
-            lock.acquire()
-            LIVE_FILES_LOG_LOCKS[self.userID] = lock
-
-    def release_live_files_log_lock(self):
-        lock: threading.Lock = LIVE_FILES_LOG_LOCKS[self.userID]
-        lock.release()
-
-    def acquire_additional_data_log_lock(self):
-        if self.userID in ADDITIONAL_DATA_LOG_LOCKS.keys():
-            lock: threading.Lock = ADDITIONAL_DATA_LOG_LOCKS[self.userID]
-            lock.acquire()
-        else:
-            lock = threading.Lock()
-            lock.acquire()
-            ADDITIONAL_DATA_LOG_LOCKS[self.userID] = lock
+            metadata.backend().unregister_user(self.userID)
+            self.forget_cached_metadata()
+
+    def forget_cached_metadata(self):
+        metadata.backend().forget(self)
+
+    def acquire_live_files_log_lock(self, shared=False):
+        locking.USER_LOCKS.acquire('LIVE' + self.userID, shared)
+
+    def release_live_files_log_lock(self, shared=False):
+        locking.USER_LOCKS.release('LIVE' + self.userID, shared)
+
+    def acquire_additional_data_log_lock(self, shared=False):
+        locking.USER_LOCKS.acquire('ADD' + self.userID, shared)
+
+    def release_additional_data_log_lock(self, shared=False):
+        locking.USER_LOCKS.release('ADD' + self.userID, shared)
+
+    def acquire_usage_log_lock(self, shared=False):
+        locking.USER_LOCKS.acquire('USAGE' + self.userID, shared)
+
+    def release_usage_log_lock(self, shared=False):
+        locking.USER_LOCKS.release('USAGE' + self.userID, shared)
 
-    def release_additional_data_log_lock(self):
-        lock: threading.Lock = ADDITIONAL_DATA_LOG_LOCKS[self.userID]
-        lock.release()
+    def acquire_blob_store_lock(self, shared=False):
+        locking.USER_LOCKS.acquire('BLOBS' + self.userID, shared)
 
+    def release_blob_store_lock(self, shared=False):
+        locking.USER_LOCKS.release('BLOBS' + self.userID, shared)